@@ -0,0 +1,156 @@
+
+import numpy as np
+from argparse import ArgumentParser
+import time
+import json
+import os
+
+import synthetic_propagator as syn
+syn.use_stand_in()
+import secondary_hist as sh
+import step_1_propagate as s1
+from phase_timer import PhaseTimer
+
+BENCHMARKS = ["classify", "histogram", "propagate"]
+
+
+def synthetic_tracks(prop, muon_energies, propagation_lengths):
+    # the secondaries of the muons without mupair muons
+    return [s1.prop_particle(prop, energy, length) for energy, length in zip(muon_energies, propagation_lengths)]
+
+def best_time(func, repeat):
+    # the minimum is the least disturbed by other processes
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def run_benchmarks(settings_dict, synthetic_config, n_muons, repeat):
+    r"""
+    Time the classification, the histogram filling and the whole propagation
+    of step_1 with the synthetic propagator
+
+    Returns
+    -------
+    results : dict
+        time, muons/s and secondaries/s of every benchmark
+    """
+    prop = syn.SyntheticPropagator(**synthetic_config)
+    muon_energies, propagation_lengths, muon_weights, muon_seeds = \
+        s1.sample_muons(settings_dict, n_muons, s1.muon_stream_key(settings_dict, 1.0))
+    len_bins = np.arange(start=0,
+                        stop=settings_dict["propagation_length_max"],
+                        step=settings_dict["bin_len_step"])
+    loss_bin_edges = np.array(settings_dict["energy_loss_bin_edges"])
+
+    # the same tracks are classified and filled in every repetition
+    tracks = synthetic_tracks(prop, muon_energies, propagation_lengths)
+    n_secondaries = sum(len(secondaries) for secondaries in tracks)
+    classified = [s1.classify_secondaries(secondaries, len_bins) for secondaries in tracks]
+
+    def classify():
+        for secondaries in tracks:
+            s1.classify_secondaries(secondaries, len_bins)
+
+    def histogram():
+        secondary_hist = sh.SecondaryHistAccumulator(loss_bin_edges)
+        for sec_energies, length in zip(classified, propagation_lengths):
+            secondary_hist.fill(sec_energies, 1e4 / length)
+
+    # the timer counts the secondaries of the muons, every muon is propagated with its seed
+    propagate_timers = []
+    def propagate():
+        timer = PhaseTimer()
+        s1.propagate_and_return_secondary_hist(prop, muon_energies, propagation_lengths, muon_seeds,
+                                               loss_bin_edges, len_bins, show_progress=False,
+                                               muon_weights=muon_weights, timer=timer)
+        propagate_timers.append(timer)
+
+    results = {}
+    for name, func in [("classify", classify), ("histogram", histogram), ("propagate", propagate)]:
+        seconds = best_time(func, repeat)
+        if name == "propagate":
+            # the secondaries of the mupair muons are not counted
+            n_benchmark_secondaries = propagate_timers[-1].counters["secondaries"]
+        else:
+            n_benchmark_secondaries = n_secondaries
+        results[name] = {"time": seconds,
+                         "muons_per_second": n_muons / seconds,
+                         "secondaries_per_second": n_benchmark_secondaries / seconds}
+    return results
+
+def compare_baseline(results, baseline):
+    # the speedup of every benchmark, above 1 is faster than the baseline
+    return {name: results[name]["secondaries_per_second"] / baseline["results"][name]["secondaries_per_second"]
+            for name in results if name in baseline["results"]}
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config',
+                        type=str,
+                        dest='settings_file', default="build/settings.json",
+                        help='json file containing the settings')
+    parser.add_argument('-n', '--n_muons',
+                        type=int,
+                        dest='n_muons', default=200,
+                        help='number of muons of every benchmark')
+    parser.add_argument('-r', '--repeat',
+                        type=int,
+                        dest='repeat', default=5,
+                        help='number of repetitions, the fastest one is taken')
+    parser.add_argument('--losses_per_meter',
+                        type=float,
+                        dest='losses_per_meter', default=1.5,
+                        help='mean number of stochastic losses per meter of the synthetic propagator')
+    parser.add_argument('--mupair_fraction',
+                        type=float,
+                        dest='mupair_fraction', default=1e-3,
+                        help='fraction of the synthetic losses which are mupairs')
+    parser.add_argument('--seed',
+                        type=int,
+                        dest='seed', default=0,
+                        help='seed of the synthetic propagator')
+    parser.add_argument('--save',
+                        action='store_true',
+                        dest='save',
+                        help='store the results as the new baseline')
+    args = parser.parse_args()
+
+    with open(args.settings_file) as file:
+        settings_dict = json.load(file)
+
+    synthetic_config = {"losses_per_meter": args.losses_per_meter,
+                        "mupair_fraction": args.mupair_fraction,
+                        "ecut": settings_dict["energy_loss_min"],
+                        "seed": args.seed}
+    results = run_benchmarks(settings_dict, synthetic_config, args.n_muons, args.repeat)
+
+    baseline_file = settings_dict["file_benchmark_baseline"]
+    speedups = {}
+    if os.path.isfile(baseline_file):
+        with open(baseline_file) as file:
+            baseline = json.load(file)
+        if baseline["synthetic_config"] == synthetic_config and baseline["n_muons"] == args.n_muons:
+            speedups = compare_baseline(results, baseline)
+        else:
+            print("the baseline has another synthetic propagator or number of muons, it is not compared")
+
+    print("{:>10} {:>10} {:>12} {:>16} {:>9}".format("benchmark", "time (s)", "muons/s", "secondaries/s", "speedup"))
+    for name in BENCHMARKS:
+        result = results[name]
+        speedup = "{:.3f}".format(speedups[name]) if name in speedups else "-"
+        print("{:>10} {:>10.4f} {:>12.1f} {:>16.1f} {:>9}".format(
+            name, result["time"], result["muons_per_second"], result["secondaries_per_second"], speedup))
+
+    if args.save:
+        with open(baseline_file, "w") as file:
+            json.dump({"synthetic_config": synthetic_config, "n_muons": args.n_muons, "results": results},
+                      fp=file, indent=2, separators=(",", ":"))
+        print("baseline written to {}".format(baseline_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+
+import numpy as np
+from argparse import ArgumentParser
+import os
+import json
+
+import secondary_hist as sh
+import loss_store as ls
+import result_cube as rc
+import step_1_propagate as s1
+from step_0_settings import error_groups
+
+
+def reweight_factors(n_brems, brems_integral, brems_multiplier, reference_multiplier):
+    r"""
+    Event weights to reweight muons propagated with the reference multiplier to another multiplier
+
+    The multiplier scales the stochastic bremsstrahlung cross section, so the ratio
+    of the track probabilities is (m / m_ref)**n_brems * exp(-(m - m_ref) * brems_integral).
+    The changed continuous losses below the cut are neglected.
+
+    Parameters
+    ----------
+    n_brems : array-like
+        number of bremsstrahlung losses of each muon, including its mupair muons
+    brems_integral : array-like
+        bremsstrahlung interaction rate with multiplier 1 integrated along the tracks
+    brems_multiplier, reference_multiplier : float
+        the target and the propagated multiplier
+
+    Returns
+    -------
+    weights : array-like
+        weight of each muon
+    """
+    return np.exp(n_brems * np.log(brems_multiplier / reference_multiplier)
+                  - (brems_multiplier - reference_multiplier) * brems_integral)
+
+def reference_store(settings_dict, style, workers=1):
+    reference = settings_dict["brems_reweight_reference"]
+    path = ls.store_path(settings_dict, style, reference)
+    if not ls.is_store(path):
+        print("propagate the reference multiplier {}".format(reference))
+        s1.propagate_multiplier(settings_dict, style, reference, workers, path)
+
+    store, _ = ls.load_store(path)
+    if "muons_brems_integral" not in store or np.any(np.isnan(store["muons_brems_integral"])):
+        raise ValueError("the loss store {} has no bremsstrahlung exposure, "
+                         "remove it to propagate the reference again".format(path))
+    return store
+
+def reweight_store(settings_dict, store, brems_multiplier):
+    len_bins = np.arange(start=0,
+                        stop=settings_dict["propagation_length_max"],
+                        step=settings_dict["bin_len_step"])
+    loss_bin_edges = np.array(settings_dict["energy_loss_bin_edges"])
+
+    event_weights = reweight_factors(np.asarray(store["muons_n_brems"]),
+                                     np.asarray(store["muons_brems_integral"]),
+                                     brems_multiplier,
+                                     settings_dict["brems_reweight_reference"])
+    # the errors of the histograms are calculated from the sum of the squared weights,
+    # per stratum or replicate like in the propagation
+    secondary_hist = ls.histogram_store(store,
+                                        loss_bin_edges,
+                                        len_bins,
+                                        muon_weights=store["muons_muon_weight"] * event_weights,
+                                        error_groups=error_groups(settings_dict))
+    effective_muons = np.sum(event_weights)**2 / np.sum(event_weights**2)
+    return secondary_hist, effective_muons
+
+def compare_hists(settings_dict, sec_bins, sec_errs, ref_bins, ref_errs):
+    # pulls of the bins, which are filled in one of the histograms
+    result = {}
+    for idx, sec_type in enumerate(settings_dict["secondary_types"]):
+        errs = np.sqrt(sec_errs[idx]**2 + ref_errs[idx]**2)
+        filled = errs > 0
+        pulls = (sec_bins[idx][filled] - ref_bins[idx][filled]) / errs[filled]
+        result[sec_type] = {"chi2": float(np.sum(pulls**2)),
+                            "ndf": int(np.count_nonzero(filled)),
+                            "max_abs_pull": float(np.max(np.abs(pulls))) if len(pulls) > 0 else 0.}
+    return result
+
+def reweight_multipliers(settings_dict, style, workers=1, validate=True, write_text=False):
+    rc.create_cube(settings_dict, style, sh.N_SEC_TYPES)
+    store = reference_store(settings_dict, style, workers)
+    reference = settings_dict["brems_reweight_reference"]
+
+    for brems_multiplier in settings_dict["brems_multiplier_{}_arr".format(style)]:
+        secondary_hist, effective_muons = reweight_store(settings_dict, store, brems_multiplier)
+        sec_bins, sec_errs = secondary_hist.finalize()
+        rc.write_multiplier(settings_dict, style, brems_multiplier, sec_bins, sec_errs,
+                            {"n_muons": secondary_hist.n_muons,
+                             "reweighted_from": reference,
+                             "effective_muons": effective_muons})
+        print("brems_multiplier {} reweighted".format(brems_multiplier))
+
+    if write_text:
+        rc.export_text(settings_dict, style)
+    if not validate:
+        return
+
+    # the validation multipliers are propagated with independent muons
+    report = {"reference": reference, "n_muons": settings_dict["n_muons"], "validation": []}
+    for brems_multiplier in settings_dict["brems_reweight_validation"]:
+        secondary_hist, effective_muons = reweight_store(settings_dict, store, brems_multiplier)
+        sec_bins, sec_errs = secondary_hist.finalize()
+        ref_bins, ref_errs = s1.propagate_multiplier(dict(settings_dict, common_random_numbers=False),
+                                                     style, brems_multiplier, workers).finalize()
+        comparison = compare_hists(settings_dict, sec_bins, sec_errs, ref_bins, ref_errs)
+        report["validation"].append({"brems_multiplier": brems_multiplier,
+                                     "effective_muons": effective_muons,
+                                     "secondary_types": comparison})
+        binned_track = comparison["Binned Track"]
+        print("brems_multiplier {} validated: binned track chi2/ndf {:.4}/{}".format(
+            brems_multiplier, binned_track["chi2"], binned_track["ndf"]))
+
+    with open(settings_dict["step01_file_{}_reweight_report".format(style)], "w") as file:
+        json.dump(report, fp=file, indent=2, separators=(",", ":"))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config',
+                        type=str,
+                        dest='settings_file', default="build/settings.json",
+                        help='json file containing the settings')
+    parser.add_argument('-s', '--style',
+                        type=str,
+                        dest='style', default="buildup",
+                        help='buildup or testing')
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        dest='workers', default=1,
+                        help='number of worker processes propagating the muon chunks')
+    parser.add_argument('-n', '--no-validation',
+                        action='store_false',
+                        dest='validate',
+                        help='do not propagate the validation multipliers')
+    parser.add_argument('-t', '--text',
+                        action='store_true',
+                        dest='write_text',
+                        help='additionally write the histograms of each multiplier as text files')
+    args = parser.parse_args()
+
+    with open(args.settings_file) as file:
+        settings_dict = json.load(file)
+
+    for key in ["step01_path_{}".format(args.style), "step01_path_{}_data".format(args.style)]:
+        if not os.path.isdir(settings_dict[key]):
+            os.makedirs(settings_dict[key])
+
+    # propagate the reference multiplier once and reweight it to all multipliers
+    reweight_multipliers(settings_dict, args.style, args.workers, args.validate, args.write_text)
+
+
+if __name__ == "__main__":
+    main()
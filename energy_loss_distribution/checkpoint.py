@@ -0,0 +1,156 @@
+
+import numpy as np
+import os
+import json
+
+import secondary_hist as sh
+from step_0_settings import PROPAGATION_KEYS, settings_hash
+
+# a checkpoint keeps the sums of every finished chunk of a multiplier, not only their merge,
+# so the chunks are merged in the same order after a restart and the result is identical
+CHECKPOINT_KEYS = PROPAGATION_KEYS + [
+    "n_muons_per_chunk",
+    "bin_len_step",
+    "energy_loss_bin_edges",
+    "bin_len_steps",
+    "n_energy_loss_bins_list",
+    "n_primary_energy_bins",
+    "mupair_max_depth",
+    "mupair_min_energy",
+    "mupair_tracks_per_task",
+    "common_random_numbers",
+    "adaptive_target_rel_error",
+    "adaptive_chunks_per_round",
+    "muon_max_time",
+    "muon_max_secondaries",
+]
+HIST_ARRAYS = ["sum_weights", "sum_weights2", "n_muons"]
+PRIMARY_ARRAYS = ["primary_sum_weights", "primary_sum_weights2", "primary_n_muons"]
+GROUP_ARRAYS = ["group_sum_weights", "group_sum_squares", "group_n_muons"]
+
+
+def checkpoint_file(settings_dict, style, brems_multiplier):
+    return settings_dict["step01_file_{}_checkpoint".format(style)].format(brems_multiplier)
+
+def checkpoint_hash(settings_dict, style, brems_multiplier, store_path=None):
+    return settings_hash(settings_dict,
+                         keys=CHECKPOINT_KEYS,
+                         style=style,
+                         brems_multiplier=brems_multiplier,
+                         store_losses=store_path is not None)
+
+
+def hist_arrays(prefix, secondary_hists):
+    # the accumulators of the chunks stacked along the first axis
+    arrays = {prefix + "loss_bin_edges": secondary_hists[0].loss_bin_edges}
+    names = list(HIST_ARRAYS)
+    if secondary_hists[0].primary_bin_edges is not None:
+        arrays[prefix + "primary_bin_edges"] = secondary_hists[0].primary_bin_edges
+        names += PRIMARY_ARRAYS
+    if secondary_hists[0].error_groups is not None:
+        arrays[prefix + "error_groups"] = np.array(json.dumps(secondary_hists[0].error_groups))
+        names += GROUP_ARRAYS
+    for name in names:
+        arrays[prefix + name] = np.array([getattr(secondary_hist, name) for secondary_hist in secondary_hists])
+    if secondary_hists[0].error_groups is not None:
+        # the open sums of all chunks as (index of the chunk, group, muon id) and sums
+        open_items = [(idx, key, sums) for idx, secondary_hist in enumerate(secondary_hists)
+                      for key, sums in sorted(secondary_hist.open_sums.items())]
+        arrays[prefix + "open_keys"] = np.array([(idx,) + key for idx, key, _ in open_items], dtype=np.int64).reshape(-1, 3)
+        arrays[prefix + "open_sums"] = np.array([sums for _, _, sums in open_items]).reshape(
+            (-1,) + secondary_hists[0].sum_weights.shape)
+    return arrays
+
+def hists_from_arrays(arrays, prefix):
+    primary_bin_edges = arrays.get(prefix + "primary_bin_edges")
+    error_groups = None
+    names = list(HIST_ARRAYS)
+    if primary_bin_edges is not None:
+        names += PRIMARY_ARRAYS
+    if prefix + "error_groups" in arrays:
+        error_groups = json.loads(str(arrays[prefix + "error_groups"]))
+        names += GROUP_ARRAYS
+    secondary_hists = []
+    for idx in range(len(arrays[prefix + "n_muons"])):
+        secondary_hist = sh.SecondaryHistAccumulator(arrays[prefix + "loss_bin_edges"],
+                                                     primary_bin_edges=primary_bin_edges,
+                                                     error_groups=error_groups)
+        for name in names:
+            value = arrays[prefix + name][idx]
+            setattr(secondary_hist, name, value.copy() if np.ndim(value) > 0 else int(value))
+        secondary_hists.append(secondary_hist)
+    if error_groups is not None:
+        for (idx, gidx, muon_id), sums in zip(arrays[prefix + "open_keys"], arrays[prefix + "open_sums"]):
+            secondary_hists[idx].add_open((int(gidx), int(muon_id)), sums)
+    return secondary_hists
+
+
+def write_checkpoint(path, chunks, binning_chunks, info):
+    r"""
+    Write the chunks of a multiplier atomically
+
+    Parameters
+    ----------
+    path : str
+        checkpoint file, the old one is only replaced after the new one is written
+    chunks : dict
+        SecondaryHistAccumulator of every finished chunk, keyed by the chunk index
+    binning_chunks : dict
+        accumulators of the additional binnings of every finished chunk, keyed by the chunk index
+    info : dict
+        json serializable information, e.g. the settings hash and the number of muons
+    """
+    chunk_indices = sorted(chunks)
+    binning_keys = sorted(binning_chunks[chunk_indices[0]]) if chunk_indices[0] in binning_chunks else []
+    info = dict(info, binning_keys=binning_keys)
+
+    arrays = {"chunk_indices": np.array(chunk_indices, dtype=np.int64),
+              "info": np.array(json.dumps(info))}
+    arrays.update(hist_arrays("main_", [chunks[idx] for idx in chunk_indices]))
+    for key in binning_keys:
+        arrays.update(hist_arrays("binning_{}_".format(key), [binning_chunks[idx][key] for idx in chunk_indices]))
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "wb") as file:
+        np.savez(file, **arrays)
+    os.replace(tmp_file, path)
+
+def load_checkpoint(path):
+    with np.load(path) as npz_file:
+        arrays = {key: npz_file[key] for key in npz_file.files}
+    info = json.loads(str(arrays["info"]))
+    chunk_indices = arrays["chunk_indices"].tolist()
+    chunks = dict(zip(chunk_indices, hists_from_arrays(arrays, "main_")))
+    binning_chunks = {idx: {} for idx in chunk_indices}
+    for key in info["binning_keys"]:
+        for idx, secondary_hist in zip(chunk_indices, hists_from_arrays(arrays, "binning_{}_".format(key))):
+            binning_chunks[idx][key] = secondary_hist
+    return chunks, binning_chunks, info
+
+def resume_checkpoint(settings_dict, style, brems_multiplier, store_path=None):
+    # returns None, if there is no checkpoint of the same settings
+    path = checkpoint_file(settings_dict, style, brems_multiplier)
+    if not os.path.isfile(path):
+        return None
+    checkpoint = load_checkpoint(path)
+    if checkpoint[2]["settings_hash"] != checkpoint_hash(settings_dict, style, brems_multiplier, store_path):
+        print("checkpoint of brems_multiplier {} has other settings, it is ignored".format(brems_multiplier))
+        return None
+    print("brems_multiplier {} resumed with {} muons".format(brems_multiplier, checkpoint[2]["n_muons"]))
+    return checkpoint
+
+def remove_checkpoint(settings_dict, style, brems_multiplier):
+    path = checkpoint_file(settings_dict, style, brems_multiplier)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def load_snapshot(path):
+    # the merged histogram of the finished chunks, e.g. to plot it while the propagation is running
+    chunks, _, info = load_checkpoint(path)
+    secondary_hist = sh.SecondaryHistAccumulator(chunks[min(chunks)].loss_bin_edges)
+    for idx in sorted(chunks):
+        secondary_hist.merge(chunks[idx])
+    return secondary_hist, info
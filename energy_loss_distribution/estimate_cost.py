@@ -0,0 +1,319 @@
+
+import numpy as np
+from argparse import ArgumentParser
+import resource
+import time
+import json
+import sys
+import os
+
+import secondary_hist as sh
+import loss_store as ls
+import step_1_propagate as s1
+from phase_timer import PhaseTimer
+from step_0_settings import additional_binnings, binning_settings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "range_distribution"))
+import calculate_propagated_ranges
+
+# the size of a row of the loss store
+MUON_ROW_BYTES = sum(np.dtype(dtype).itemsize for _, dtype in ls.MUON_COLUMNS)
+LOSS_ROW_BYTES = sum(np.dtype(dtype).itemsize for _, dtype in ls.LOSS_COLUMNS)
+# characters of a range written by np.savetxt
+RANGE_TEXT_BYTES = 25
+
+
+def peak_memory():
+    # maximum resident set size of the process in bytes, linux reports it in kB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def fit_power_law(features, values):
+    r"""
+    Least squares fit of log(values) = c_0 + sum_i c_i log(features_i)
+
+    Parameters
+    ----------
+    features : array-like
+        (n, k) array of the positive features of the calibration points
+    values : array-like
+        positive value of every calibration point, e.g. the time per muon
+
+    Returns
+    -------
+    coefficients : np.ndarray
+        constant and the exponents of the features
+    """
+    design = np.column_stack((np.ones(len(values)), np.log(features)))
+    coefficients, _, _, _ = np.linalg.lstsq(design, np.log(values), rcond=None)
+    return coefficients
+
+def predict_power_law(coefficients, features):
+    return np.exp(coefficients[0] + np.log(features).dot(coefficients[1:]))
+
+def calibration_energies(energy_min, energy_max, n_energies=None):
+    # at least two energies and one per decade
+    if n_energies is None:
+        n_energies = max(2, int(np.ceil(np.log10(energy_max / energy_min))) + 1)
+    return np.logspace(np.log10(energy_min), np.log10(energy_max), n_energies)
+
+
+def calibrate_energy_loss(settings_dict, style, muons_per_point, store_losses=False, n_lengths=3):
+    r"""
+    Propagate a few muons on a grid of energies and lengths with the largest multiplier
+
+    Returns
+    -------
+    points : list
+        energy, length, time and number of secondaries per muon of every grid point
+    setup_time : float
+        time to build or load the tables of the propagator
+    binning_time : float
+        time per secondary to fill the additional binnings
+    memory : dict
+        peak memory before and after the propagator is built and after the calibration
+    """
+    brems_multiplier = max(settings_dict["brems_multiplier_{}_arr".format(style)])
+    len_bins = np.arange(start=0,
+                        stop=settings_dict["propagation_length_max"],
+                        step=settings_dict["bin_len_step"])
+    loss_bin_edges = np.array(settings_dict["energy_loss_bin_edges"])
+
+    memory = {"base": peak_memory()}
+    start = time.time()
+    prop = s1.get_propagator(settings_dict, style, brems_multiplier)
+    brems = s1.get_brems_calculator(settings_dict, style) if store_losses else None
+    setup_time = time.time() - start
+    memory["propagator"] = peak_memory()
+
+    # the losses are also kept in memory to fill the additional binnings
+    binnings = additional_binnings(settings_dict)
+    if store_losses or len(binnings) > 0:
+        loss_store = ls.LossStoreWriter()
+    else:
+        loss_store = None
+
+    rng = np.random.default_rng(settings_dict["random_seed"])
+    # the first propagation also initializes the lazily built parts, it is not timed
+    s1.propagate_and_fill_hist(prop, [settings_dict["muon_energy_min"]], [settings_dict["propagation_length_min"]], [1],
+                               sh.SecondaryHistAccumulator(loss_bin_edges), len_bins, show_progress=False)
+    lengths = np.linspace(settings_dict["propagation_length_min"], settings_dict["propagation_length_max"], n_lengths)
+    points = []
+    for energy in calibration_energies(settings_dict["muon_energy_min"], settings_dict["muon_energy_max"]):
+        for length in np.unique(lengths):
+            timer = PhaseTimer()
+            start = time.time()
+            s1.propagate_and_fill_hist(prop,
+                                       np.full(muons_per_point, energy),
+                                       np.full(muons_per_point, length),
+                                       rng.integers(1, 2**31 - 1, muons_per_point),
+                                       sh.SecondaryHistAccumulator(loss_bin_edges),
+                                       len_bins,
+                                       show_progress=False,
+                                       loss_store=loss_store,
+                                       mupair_max_depth=settings_dict.get("mupair_max_depth"),
+                                       mupair_min_energy=settings_dict.get("mupair_min_energy", 0.),
+                                       brems=brems,
+                                       timer=timer)
+            points.append({"energy": energy,
+                           "length": length,
+                           "time_per_muon": (time.time() - start) / muons_per_point,
+                           "secondaries_per_muon": timer.counters.get("secondaries", 0) / float(muons_per_point)})
+
+    binning_time = 0.
+    if len(binnings) > 0:
+        store = loss_store.to_arrays()
+        start = time.time()
+        for bin_len_step, n_energy_loss_bins in binnings:
+            binning_dict = binning_settings(settings_dict, style, bin_len_step, n_energy_loss_bins)
+            ls.histogram_store(store, binning_dict["energy_loss_bin_edges"],
+                               np.arange(start=0, stop=settings_dict["propagation_length_max"], step=bin_len_step))
+        binning_time = (time.time() - start) / max(len(store["losses_energy"]), 1)
+    memory["calibration"] = peak_memory()
+    return points, setup_time, binning_time, memory
+
+def hist_bytes(settings_dict, n_energy_loss_bins):
+    # sum of the weights and their squares, also per primary energy bin
+    n_bins = sh.N_SEC_TYPES * n_energy_loss_bins
+    primary_bin_edges = s1.primary_energy_bin_edges(settings_dict)
+    if primary_bin_edges is not None:
+        n_bins *= len(primary_bin_edges)
+    return 2 * 8 * n_bins
+
+def estimate_energy_loss(settings_dict, styles, workers, muons_per_point, store_losses=False):
+    points = []
+    setup_times = []
+    binning_times = []
+    memory = {}
+    for style in styles:
+        style_points, setup_time, binning_time, memory = calibrate_energy_loss(settings_dict, style, muons_per_point,
+                                                                               store_losses)
+        points += style_points
+        setup_times.append(setup_time)
+        binning_times.append(binning_time)
+    features = [(point["energy"], point["length"]) for point in points]
+    time_coefficients = fit_power_law(features, [point["time_per_muon"] for point in points])
+    secondary_coefficients = fit_power_law(features, [point["secondaries_per_muon"] + 1. for point in points])
+
+    # the mean over the sampled spectrum including the additional binnings,
+    # the adaptive propagation stops at its muon budget
+    n_sample = min(settings_dict["n_muons"], 10000)
+    energies, lengths, _, _ = s1.sample_muons(settings_dict, n_sample, s1.muon_stream_key(settings_dict, 1.0))
+    sample_features = np.column_stack((energies, lengths))
+    time_per_muon = np.mean(predict_power_law(time_coefficients, sample_features))
+    secondaries_per_muon = np.mean(predict_power_law(secondary_coefficients, sample_features) - 1.)
+    time_per_muon += np.mean(binning_times) * secondaries_per_muon
+    if settings_dict.get("adaptive_target_rel_error") is not None:
+        n_muons = settings_dict.get("adaptive_max_muons", settings_dict["n_muons"])
+    else:
+        n_muons = settings_dict["n_muons"]
+    n_multipliers = sum(len(settings_dict["brems_multiplier_{}_arr".format(style)]) for style in styles)
+    cpu_seconds = n_multipliers * (n_muons * time_per_muon + np.mean(setup_times))
+
+    # every worker holds the tables and the losses of its chunk, the parent the chunks of a multiplier
+    binnings = additional_binnings(settings_dict)
+    n_chunks = s1.number_of_chunks(settings_dict)
+    n_muons_per_chunk = settings_dict.get("n_muons_per_chunk", n_muons)
+    chunk_store_bytes = 0
+    if store_losses or len(binnings) > 0:
+        chunk_store_bytes = n_muons_per_chunk * (MUON_ROW_BYTES + secondaries_per_muon * LOSS_ROW_BYTES)
+    chunk_hist_bytes = hist_bytes(settings_dict, settings_dict["n_energy_loss_bins"]) \
+        + sum(hist_bytes(settings_dict, n_energy_loss_bins) for _, n_energy_loss_bins in binnings)
+    worker_memory = memory["calibration"] + chunk_store_bytes
+    parent_memory = memory["propagator"] + n_chunks * chunk_hist_bytes
+
+    # the cubes of all multipliers, the batches of the common random numbers and the loss store
+    output_bytes = 0
+    for style in styles:
+        n_style_multipliers = len(settings_dict["brems_multiplier_{}_arr".format(style)])
+        n_cube_bins = n_style_multipliers * sh.N_SEC_TYPES
+        output_bytes += 2 * 8 * n_cube_bins * settings_dict["n_energy_loss_bins"]
+        if settings_dict.get("common_random_numbers", False):
+            n_batches = min(settings_dict.get("n_common_random_batches", 10), n_chunks)
+            output_bytes += n_batches * 8 * n_cube_bins * settings_dict["n_energy_loss_bins"]
+        primary_bin_edges = s1.primary_energy_bin_edges(settings_dict)
+        if primary_bin_edges is not None:
+            output_bytes += 2 * 8 * n_cube_bins * (len(primary_bin_edges) - 1) * settings_dict["n_energy_loss_bins"]
+        for _, n_energy_loss_bins in binnings:
+            output_bytes += 2 * 8 * n_cube_bins * n_energy_loss_bins
+        if store_losses:
+            output_bytes += n_style_multipliers * n_muons * (MUON_ROW_BYTES + secondaries_per_muon * LOSS_ROW_BYTES)
+
+    return {"kind": "energy_loss",
+            "styles": styles,
+            "n_multipliers": n_multipliers,
+            "n_muons_per_multiplier": n_muons,
+            "time_per_muon": time_per_muon,
+            "secondaries_per_muon": secondaries_per_muon,
+            "table_setup_time": np.mean(setup_times),
+            "cpu_hours": cpu_seconds / 3600.,
+            # the chunks are distributed over the workers
+            "wall_hours": {n_workers: cpu_seconds / 3600. / n_workers for n_workers in workers},
+            "peak_memory": {n_workers: parent_memory + n_workers * worker_memory for n_workers in workers},
+            "output_bytes": output_bytes,
+            "fit": {"time_per_muon": time_coefficients.tolist(),
+                    "secondaries_per_muon": secondary_coefficients.tolist(),
+                    "features": ["energy", "length"]},
+            "calibration_points": points}
+
+
+def calibrate_ranges(settings_dict, muons_per_point):
+    # the first muons of an energy bin per decade, propagated with their seeds
+    entropy = calculate_propagated_ranges.stream_entropy(settings_dict)
+    bin_mids = np.array(settings_dict['prop_energy_bin_mids'])
+    energies = calibration_energies(bin_mids[0], bin_mids[-1])
+    energies = np.unique(bin_mids[np.argmin(np.abs(np.log(bin_mids[:, None] / energies)), axis=0)])
+
+    memory = {"base": peak_memory()}
+    start = time.time()
+    prop = calculate_propagated_ranges.get_propagator(settings_dict)
+    setup_time = time.time() - start
+    memory["propagator"] = peak_memory()
+
+    # the first propagation is not timed like in calibrate_energy_loss
+    calculate_propagated_ranges.propagate(prop, energies[0], 1, [1], show_progress=False)
+    points = []
+    for energy in energies:
+        start = time.time()
+        calculate_propagated_ranges.propagate(prop,
+                                              energy,
+                                              muons_per_point,
+                                              calculate_propagated_ranges.muon_seeds(entropy, energy, muons_per_point),
+                                              show_progress=False)
+        points.append({"energy": energy, "time_per_muon": (time.time() - start) / muons_per_point})
+    memory["calibration"] = peak_memory()
+    return points, setup_time, memory
+
+def estimate_ranges(settings_dict, workers, muons_per_point):
+    points, setup_time, memory = calibrate_ranges(settings_dict, muons_per_point)
+    coefficients = fit_power_law([[point["energy"]] for point in points], [point["time_per_muon"] for point in points])
+
+    oversampling = settings_dict['prop_oversampling']
+    bin_mids = np.array(settings_dict['prop_energy_bin_mids'])
+    bin_times = oversampling * predict_power_law(coefficients, bin_mids[:, None])
+    cpu_seconds = np.sum(bin_times) + setup_time
+    n_ranges = len(bin_mids) * oversampling
+    return {"kind": "ranges",
+            "n_energy_bins": len(bin_mids),
+            "oversampling": oversampling,
+            "table_setup_time": setup_time,
+            "cpu_hours": cpu_seconds / 3600.,
+            # an energy bin is propagated by one worker, the slowest one is the lower limit
+            "wall_hours": {n_workers: max(np.sum(bin_times) / n_workers, np.max(bin_times)) / 3600. + setup_time / 3600.
+                           for n_workers in workers},
+            "peak_memory": {n_workers: memory["propagator"] + n_workers * memory["calibration"] + 2 * 8 * n_ranges
+                            for n_workers in workers},
+            "output_bytes": n_ranges * RANGE_TEXT_BYTES,
+            "fit": {"time_per_muon": coefficients.tolist(), "features": ["energy"]},
+            "calibration_points": points}
+
+
+def print_estimate(settings_file, estimate):
+    print("{} ({})".format(settings_file, estimate["kind"]))
+    print("    cpu time:    {:.3g} h".format(estimate["cpu_hours"]))
+    for n_workers in sorted(estimate["wall_hours"]):
+        print("    {:>4} workers: {:.3g} h wall time, {:.3g} GB peak memory".format(
+            n_workers, estimate["wall_hours"][n_workers], estimate["peak_memory"][n_workers] / 1e9))
+    print("    output size: {:.3g} GB".format(estimate["output_bytes"] / 1e9))
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config',
+                        type=str, nargs='+',
+                        dest='settings_files', default=["build/settings.json"],
+                        help='json files containing the energy loss or range settings')
+    parser.add_argument('-s', '--styles',
+                        type=str, nargs='+',
+                        dest='styles', default=["buildup"],
+                        help='multiplier arrays of the energy loss settings')
+    parser.add_argument('-w', '--workers',
+                        type=int, nargs='+',
+                        dest='workers', default=[1],
+                        help='numbers of worker processes to estimate the wall time and memory for')
+    parser.add_argument('-n', '--muons_per_point',
+                        type=int,
+                        dest='muons_per_point', default=5,
+                        help='number of muons propagated per calibration point')
+    parser.add_argument('--store',
+                        action='store_true',
+                        dest='store_losses',
+                        help='estimate step_1_propagate.py --store')
+    args = parser.parse_args()
+
+    for settings_file in args.settings_files:
+        with open(settings_file) as file:
+            settings_dict = json.load(file)
+        if "brems_multiplier_buildup_arr" in settings_dict:
+            estimate = estimate_energy_loss(settings_dict, args.styles, args.workers, args.muons_per_point,
+                                            args.store_losses)
+            report_file = settings_dict.get("file_cost_estimate",
+                                            os.path.join(settings_dict["build_path"], "cost_estimate.json"))
+        else:
+            estimate = estimate_ranges(settings_dict, args.workers, args.muons_per_point)
+            report_file = os.path.join(os.path.dirname(settings_dict["prop_data_ranges"]), "cost_estimate.json")
+        print_estimate(settings_file, estimate)
+        with open(report_file, "w") as file:
+            json.dump(estimate, fp=file, indent=2, separators=(",", ":"))
+
+
+if __name__ == "__main__":
+    main()
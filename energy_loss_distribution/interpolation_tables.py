@@ -0,0 +1,142 @@
+
+import fcntl
+import hashlib
+import os
+import json
+import shutil
+import time
+from contextlib import contextmanager
+
+# the lock files are kept in a hidden directory of the table directory
+LOCK_DIR = ".locks"
+
+
+@contextmanager
+def table_lock(path_to_tables, key="tables", shared=False):
+    r"""
+    Lock the interpolation tables of a directory between processes
+
+    A propagator, which may build tables, is created with the exclusive lock
+    of the directory, see tables_lock. The warm-up builds different table sets
+    in parallel, they share the directory lock and have an exclusive lock per set.
+    Without a table directory the tables are kept in memory and nothing is locked.
+    """
+    if not path_to_tables:
+        yield
+        return
+
+    lock_dir = os.path.join(os.path.expanduser(path_to_tables), LOCK_DIR)
+    if not os.path.isdir(lock_dir):
+        os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, "{}.lock".format(key)), "a") as file:
+        fcntl.flock(file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+def marker_file(path_to_tables, key):
+    # written after a table set is build by the warm-up
+    return os.path.join(os.path.expanduser(path_to_tables), LOCK_DIR, "{}.json".format(key))
+
+def job_key(job):
+    return hashlib.sha1(json.dumps(job, sort_keys=True).encode("utf-8")).hexdigest()
+
+def propagator_job(path_to_tables, brems_multiplier):
+    # the tables of the propagator of a multiplier
+    return {"kind": "propagator", "path": path_to_tables, "brems_multiplier": brems_multiplier}
+
+def brems_job(path_to_tables):
+    # the tables of the brems cross section
+    return {"kind": "brems", "path": path_to_tables}
+
+@contextmanager
+def tables_lock(job):
+    r"""
+    Lock the tables of a job to create its objects
+
+    After the warm-up marked the table set as built, the tables are only read.
+    The directory and the set are locked shared, so the workers create their
+    propagators at the same time and only wait for a set which is built again.
+    Otherwise the tables may be built and the directory is locked exclusively.
+    """
+    path_to_tables = job["path"]
+    key = job_key(job)
+    if path_to_tables and os.path.isfile(marker_file(path_to_tables, key)):
+        with table_lock(path_to_tables, shared=True):
+            with table_lock(path_to_tables, key, shared=True):
+                yield
+    else:
+        with table_lock(path_to_tables):
+            yield
+
+
+class TableCache(object):
+    r"""
+    Scratch directory of interpolation tables with a size limit
+
+    The tables written while creating an object are recorded under its key.
+    If the directory gets larger than max_size bytes, the tables of the
+    least recently used keys are removed. Tables of the permanent directory
+    should be passed as read only path to the created objects, they are not cached.
+    """
+    INDEX_FILE = "cache_index.json"
+
+    def __init__(self, path, max_size):
+        self.path = os.path.expanduser(path)
+        self.max_size = max_size
+
+    def load_index(self):
+        index_file = os.path.join(self.path, self.INDEX_FILE)
+        if not os.path.isfile(index_file):
+            return {}
+        with open(index_file) as file:
+            return json.load(file)
+
+    def write_index(self, index):
+        index_file = os.path.join(self.path, self.INDEX_FILE)
+        with open(index_file + ".tmp", "w") as file:
+            json.dump(index, fp=file, indent=2, separators=(",", ":"))
+        os.replace(index_file + ".tmp", index_file)
+
+    def table_files(self):
+        return set(name for name in os.listdir(self.path)
+                   if name not in (LOCK_DIR, self.INDEX_FILE, self.INDEX_FILE + ".tmp"))
+
+    def use(self, key, create):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, exist_ok=True)
+        # the new files can only be assigned to the key, if no one else writes tables
+        with table_lock(self.path):
+            index = self.load_index()
+            files_before = self.table_files()
+            created = create()
+            new_files = sorted(self.table_files() - files_before)
+
+            entry = index.setdefault(key, {"files": [], "size": 0})
+            entry["files"] = sorted(set(entry["files"]) | set(new_files))
+            entry["size"] = sum(os.path.getsize(os.path.join(self.path, name))
+                                for name in entry["files"] if os.path.isfile(os.path.join(self.path, name)))
+            entry["last_used"] = time.time()
+            self.evict(index, key)
+            self.write_index(index)
+        return created
+
+    def evict(self, index, current_key):
+        # the current tables are kept, also if they alone exceed the limit
+        for key in sorted(index, key=lambda key: index[key]["last_used"]):
+            if sum(entry["size"] for entry in index.values()) <= self.max_size:
+                break
+            if key == current_key:
+                continue
+            for name in index[key]["files"]:
+                file_name = os.path.join(self.path, name)
+                if os.path.isdir(file_name):
+                    shutil.rmtree(file_name)
+                elif os.path.isfile(file_name):
+                    os.remove(file_name)
+            del index[key]
+
+    def cleanup(self):
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
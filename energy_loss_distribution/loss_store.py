@@ -0,0 +1,408 @@
+
+import numpy as np
+from argparse import ArgumentParser
+import shutil
+import glob
+import os
+import json
+
+import secondary_hist as sh
+import result_cube as rc
+from step_0_settings import PROPAGATION_KEYS, settings_hash, error_groups
+
+# every propagated muon is stored with its id, energy, propagation length, weight
+# and its bremsstrahlung exposure (the number of brems losses and the integrated
+# brems rate of all its tracks, nan if it was not calculated),
+# every loss with its muon id, the track it belongs to (0 is the muon itself,
+# the mupair muons are counted up, the mupair muons below the limits are not propagated
+# and stored as a mupair loss of track UNPROPAGATED_TRACK), its type code, energy and position
+MUON_COLUMNS = [
+    ("muon_id", np.int64),
+    ("muon_energy", np.float64),
+    ("propagation_length", np.float64),
+    ("muon_weight", np.float64),
+    ("n_brems", np.int64),
+    ("brems_integral", np.float64),
+]
+LOSS_COLUMNS = [
+    ("muon_id", np.int64),
+    ("track_id", np.int32),
+    ("type_code", np.int8),
+    ("energy", np.float64),
+    ("x", np.float64),
+    ("y", np.float64),
+    ("z", np.float64),
+]
+TABLES = [("muons", MUON_COLUMNS), ("losses", LOSS_COLUMNS)]
+INDEX_FILE = "index.json"
+UNPROPAGATED_TRACK = -1
+# settings which change the stored muons and losses of a multiplier
+STORE_KEYS = PROPAGATION_KEYS + [
+    "common_random_numbers",
+    "mupair_max_depth",
+    "mupair_min_energy",
+    "muon_max_time",
+    "muon_max_secondaries",
+    "adaptive_target_rel_error",
+    "adaptive_max_muons",
+    "adaptive_chunks_per_round",
+]
+
+
+def store_path(settings_dict, style, brems_multiplier):
+    # the store is addressed by the settings of the propagation,
+    # so it is found again after changing the binning or the other multipliers
+    store_hash = settings_hash(settings_dict,
+                               keys=STORE_KEYS,
+                               style=style,
+                               brems_multiplier=brems_multiplier)
+    return os.path.join(settings_dict["step01_path_{}_store".format(style)], store_hash)
+
+def chunk_path(path, chunk_idx):
+    return os.path.join(path, "chunk_{:06d}".format(chunk_idx))
+
+def mupair_part_file(path, chunk_idx, part_key):
+    # the losses of mupair muons of a chunk propagated in another task,
+    # the key is the id of the parent muon and the path of the first mupair muon in its cascade
+    muon_id, child_path = part_key
+    return "{}_mupair_{:012d}_{}.npz".format(chunk_path(path, chunk_idx), muon_id,
+                                             "-".join("{:04d}".format(idx) for idx in child_path))
+
+def mupair_part_files(path, chunk_idx):
+    return sorted(glob.glob(chunk_path(path, chunk_idx) + "_mupair_*.npz"))
+
+def remove_mupair_parts(path, chunk_idx):
+    for part_file in mupair_part_files(path, chunk_idx):
+        os.remove(part_file)
+
+def column_file(path, table, name):
+    return os.path.join(path, "{}_{}.npy".format(table, name))
+
+
+class LossStoreWriter(object):
+    def __init__(self, first_muon_id=0):
+        self.columns = {table: {name: [] for name, _ in columns} for table, columns in TABLES}
+        self.muon_id = first_muon_id - 1
+        self.track_id = 0
+        self.n_muon_tracks = 0
+
+    def add_muon(self, muon_energy, propagation_length, muon_weight=1.):
+        self.muon_id += 1
+        self.track_id = 0
+        self.n_muon_tracks = len(self.columns["losses"]["muon_id"])
+        self.columns["muons"]["muon_id"].append(self.muon_id)
+        self.columns["muons"]["muon_energy"].append(muon_energy)
+        self.columns["muons"]["propagation_length"].append(propagation_length)
+        self.columns["muons"]["muon_weight"].append(muon_weight)
+        self.columns["muons"]["n_brems"].append(0)
+        self.columns["muons"]["brems_integral"].append(np.nan)
+
+    def remove_muon(self):
+        # removes the last muon and its losses, its id is not used again
+        for name, _ in MUON_COLUMNS:
+            self.columns["muons"][name].pop()
+        for name, _ in LOSS_COLUMNS:
+            del self.columns["losses"][name][self.n_muon_tracks:]
+
+    def add_unpropagated(self, energies):
+        # the mupair muons below the limits are kept as mupair losses of the muon
+        n_losses = len(energies)
+        columns = self.columns["losses"]
+        columns["muon_id"].append(np.full(n_losses, self.muon_id))
+        columns["track_id"].append(np.full(n_losses, UNPROPAGATED_TRACK))
+        columns["type_code"].append(np.full(n_losses, sh.MUPAIR, dtype=np.int8))
+        columns["energy"].append(np.asarray(energies, dtype=np.float64))
+        for name in ["x", "y", "z"]:
+            columns[name].append(np.zeros(n_losses))
+
+    def add_brems_exposure(self, n_brems, brems_integral):
+        # the exposure of the mupair muons is added to their parent muon
+        columns = self.columns["muons"]
+        columns["n_brems"][-1] += n_brems
+        columns["brems_integral"][-1] = np.nan_to_num(columns["brems_integral"][-1]) + brems_integral
+
+    def add_track(self, type_codes, energies, positions):
+        n_losses = len(type_codes)
+        columns = self.columns["losses"]
+        columns["muon_id"].append(np.full(n_losses, self.muon_id))
+        columns["track_id"].append(np.full(n_losses, self.track_id))
+        columns["type_code"].append(type_codes)
+        columns["energy"].append(energies)
+        columns["x"].append(positions[:, 0])
+        columns["y"].append(positions[:, 1])
+        columns["z"].append(positions[:, 2])
+        self.track_id += 1
+
+    def to_arrays(self):
+        # the columns in the form of a loaded store
+        store = {}
+        for table, columns in TABLES:
+            for name, dtype in columns:
+                values = self.columns[table][name]
+                if table == "losses" and len(values) > 0:
+                    values = np.concatenate(values)
+                store["{}_{}".format(table, name)] = np.array(values, dtype=dtype)
+        return store
+
+    def write(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for key, values in self.to_arrays().items():
+            table, name = key.split("_", 1)
+            np.save(column_file(path, table, name), values)
+
+    def write_part(self, file_name):
+        # the mupair parts are only kept until they are merged into their chunk, see merge_mupair_parts
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        np.savez(file_name, **self.to_arrays())
+
+
+def merge_mupair_parts(path, chunk_idx):
+    r"""
+    Add the mupair parts of a chunk to the chunk
+
+    The losses of a part are sorted behind the losses of their parent muon,
+    their tracks are numbered after its tracks and the bremsstrahlung
+    exposure of the part is added to the parent muon.
+    """
+    part_files = mupair_part_files(path, chunk_idx)
+    if len(part_files) == 0:
+        return
+    store = {"{}_{}".format(table, name): np.load(column_file(chunk_path(path, chunk_idx), table, name))
+             for table, columns in TABLES for name, _ in columns}
+    muon_ids = store["muons_muon_id"]
+    loss_columns = [[store["losses_{}".format(name)]] for name, _ in LOSS_COLUMNS]
+    next_track_ids = {}
+    for part_file in part_files:
+        with np.load(part_file) as part_arrays:
+            part = dict(part_arrays)
+        # a part holds the mupair muons of a single muon
+        muon_id = part["muons_muon_id"][0]
+        muon_idx = np.searchsorted(muon_ids, muon_id)
+        store["muons_n_brems"][muon_idx] += part["muons_n_brems"][0]
+        if not np.isnan(part["muons_brems_integral"][0]):
+            store["muons_brems_integral"][muon_idx] = \
+                np.nan_to_num(store["muons_brems_integral"][muon_idx]) + part["muons_brems_integral"][0]
+
+        # the tracks of a part are counted from 1, they follow the tracks of the muon
+        if muon_id not in next_track_ids:
+            next_track_ids[muon_id] = np.max(store["losses_track_id"][store["losses_muon_id"] == muon_id], initial=0) + 1
+        track_ids = part["losses_track_id"].copy()
+        propagated = track_ids != UNPROPAGATED_TRACK
+        track_ids[propagated] += next_track_ids[muon_id] - 1
+        next_track_ids[muon_id] = np.max(track_ids[propagated], initial=next_track_ids[muon_id] - 1) + 1
+        part["losses_track_id"] = track_ids
+        for columns, (name, _) in zip(loss_columns, LOSS_COLUMNS):
+            columns.append(part["losses_{}".format(name)])
+
+    # the stable sort keeps the tracks of a muon in their order
+    loss_columns = [np.concatenate(columns) for columns in loss_columns]
+    order = np.argsort(loss_columns[0], kind="stable")
+    for columns, (name, _) in zip(loss_columns, LOSS_COLUMNS):
+        store["losses_{}".format(name)] = columns[order]
+    for key, values in store.items():
+        table, name = key.split("_", 1)
+        np.save(column_file(chunk_path(path, chunk_idx), table, name), values)
+    remove_mupair_parts(path, chunk_idx)
+
+def consolidate_store(path, n_chunks, metadata):
+    # concatenate the columns of all chunks in chunk order
+    chunk_paths = [chunk_path(path, idx) for idx in range(n_chunks)]
+    for idx in range(n_chunks):
+        merge_mupair_parts(path, idx)
+    for table, columns in TABLES:
+        for name, dtype in columns:
+            parts = [np.load(column_file(chunk, table, name), mmap_mode='r') for chunk in chunk_paths]
+            column = np.lib.format.open_memmap(column_file(path, table, name),
+                                               mode='w+',
+                                               dtype=dtype,
+                                               shape=(sum(len(part) for part in parts),))
+            start = 0
+            for part in parts:
+                column[start:start + len(part)] = part
+                start += len(part)
+            column.flush()
+            metadata["n_{}".format(table)] = start
+            del column
+    for chunk in chunk_paths:
+        shutil.rmtree(chunk)
+
+    with open(os.path.join(path, INDEX_FILE), "w") as file:
+        json.dump(metadata, fp=file, indent=2, separators=(",", ":"))
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+def load_store(path):
+    with open(os.path.join(path, INDEX_FILE)) as file:
+        metadata = json.load(file)
+    store = {}
+    for table, columns in TABLES:
+        for name, _ in columns:
+            # older stores do not have all columns
+            if os.path.isfile(column_file(path, table, name)):
+                store["{}_{}".format(table, name)] = np.load(column_file(path, table, name), mmap_mode='r')
+    return store, metadata
+
+
+def histogram_losses(store, row_slice, len_bins, secondary_hist, muon_weights=None, open_muon_ids=None):
+    muon_ids = store["muons_muon_id"]
+    propagation_lengths = store["muons_propagation_length"]
+    if muon_weights is None:
+        muon_weights = store["muons_muon_weight"]
+    loss_muon_ids = np.asarray(store["losses_muon_id"][row_slice])
+    track_ids = np.asarray(store["losses_track_id"][row_slice])
+    type_codes = np.asarray(store["losses_type_code"][row_slice])
+    energies = np.asarray(store["losses_energy"][row_slice])
+    positions = np.column_stack((store["losses_x"][row_slice],
+                                 store["losses_y"][row_slice],
+                                 store["losses_z"][row_slice]))
+    if len(type_codes) == 0:
+        return
+
+    # the mupair muons which were not propagated only count as mupair loss of their muon,
+    # they are filled together with the other losses, so all losses of a muon are added at once
+    unpropagated = track_ids == UNPROPAGATED_TRACK
+    unpropagated_rows = np.flatnonzero(unpropagated)
+    kept_rows = np.flatnonzero(~unpropagated)
+    type_indices = np.full(len(unpropagated_rows), sh.MUPAIR)
+    loss_energies = energies[unpropagated_rows]
+    rows = unpropagated_rows
+    if len(kept_rows) > 0:
+        kept_muon_ids = loss_muon_ids[kept_rows]
+        track_ids = track_ids[kept_rows]
+        type_codes = type_codes[kept_rows]
+        kept_energies = energies[kept_rows]
+        positions = positions[kept_rows]
+
+        # the losses of the tracks are stored one after another
+        new_track = np.r_[True, (kept_muon_ids[1:] != kept_muon_ids[:-1]) | (track_ids[1:] != track_ids[:-1])]
+        track_starts = np.flatnonzero(new_track)
+        track_ends = np.r_[track_starts[1:], len(type_codes)]
+        binned_energies, binned_tracks = sh.bin_track_rows(track_starts,
+                                                           track_ends,
+                                                           type_codes,
+                                                           kept_energies,
+                                                           positions,
+                                                           len_bins)
+        binned_rows = track_starts[binned_tracks]
+
+        # the mupair losses are propagated as muons, their losses are counted in their
+        # types and additionally all together in the mupair type
+        is_grouped = (type_codes < sh.BINNED_TRACK) & (type_codes != sh.MUPAIR)
+        grouped_rows = np.flatnonzero(is_grouped)
+        child_rows = np.flatnonzero(is_grouped & (track_ids > 0))
+        binned_child = track_ids[binned_rows] > 0
+
+        type_indices = np.concatenate((type_codes[grouped_rows].astype(np.int64),
+                                       np.full(len(child_rows), sh.MUPAIR),
+                                       np.full(len(binned_rows), sh.BINNED_TRACK),
+                                       np.full(np.count_nonzero(binned_child), sh.MUPAIR),
+                                       type_indices))
+        loss_energies = np.concatenate((kept_energies[grouped_rows],
+                                        kept_energies[child_rows],
+                                        binned_energies,
+                                        binned_energies[binned_child],
+                                        loss_energies))
+        rows = np.concatenate((kept_rows[np.concatenate((grouped_rows, child_rows,
+                                                         binned_rows, binned_rows[binned_child]))],
+                               unpropagated_rows))
+
+    # norm to 100 m propagated distance
+    muon_indices = np.searchsorted(muon_ids, loss_muon_ids[rows])
+    weights = muon_weights[muon_indices] * 1e4 / propagation_lengths[muon_indices]
+    secondary_hist.fill_losses(type_indices, loss_energies, weights,
+                               np.asarray(store["muons_muon_energy"])[muon_indices],
+                               loss_muon_ids[rows],
+                               open_muon_ids)
+
+def histogram_store(store, loss_bin_edges, len_bins, n_muons_per_block=10000, muon_weights=None, primary_bin_edges=None,
+                    error_groups=None, count_muons=True, open_muon_ids=None):
+    # without count_muons only the losses are added, e.g. of the mupair muons of a muon counted in another histogram,
+    # the sums of these muons and of the open_muon_ids are incomplete and are kept open
+    secondary_hist = sh.SecondaryHistAccumulator(loss_bin_edges, primary_bin_edges=primary_bin_edges, error_groups=error_groups)
+    muon_ids = store["muons_muon_id"]
+    loss_muon_ids = store["losses_muon_id"]
+    if not count_muons:
+        open_muon_ids = muon_ids
+    # process blocks of muons to keep the memory bounded
+    for start in range(0, len(muon_ids), n_muons_per_block):
+        first_id = muon_ids[start]
+        last_id = muon_ids[min(start + n_muons_per_block, len(muon_ids)) - 1]
+        row_start = np.searchsorted(loss_muon_ids, first_id, side='left')
+        row_stop = np.searchsorted(loss_muon_ids, last_id, side='right')
+        histogram_losses(store, slice(row_start, row_stop), len_bins, secondary_hist, muon_weights, open_muon_ids)
+    if not count_muons:
+        return secondary_hist
+    secondary_hist.n_muons = len(muon_ids)
+    if primary_bin_edges is not None:
+        secondary_hist.primary_n_muons = np.bincount(secondary_hist.primary_index(store["muons_muon_energy"]),
+                                                     minlength=len(primary_bin_edges) - 1)
+    if error_groups is not None:
+        secondary_hist.group_n_muons = np.bincount(secondary_hist.group_index(store["muons_muon_energy"], muon_ids),
+                                                   minlength=len(secondary_hist.group_n_muons))
+    return secondary_hist
+
+
+def rehistogram_store(settings_dict, style, write_text=False):
+    rc.create_cube(settings_dict, style, sh.N_SEC_TYPES)
+    len_bins = np.arange(start=0,
+                        stop=settings_dict["propagation_length_max"],
+                        step=settings_dict["bin_len_step"])
+    loss_bin_edges = np.array(settings_dict["energy_loss_bin_edges"])
+    # the split by primary energy is refilled, if it was created by the propagation
+    primary_file = settings_dict.get("step01_file_{}_{}".format(style, rc.PRIMARY_CUBE))
+    if primary_file is not None and os.path.isfile(primary_file):
+        primary_bin_edges = rc.load_metadata(settings_dict, style, rc.PRIMARY_CUBE)["primary_bin_edges"]
+    else:
+        primary_bin_edges = None
+
+    for brems_multiplier in settings_dict["brems_multiplier_{}_arr".format(style)]:
+        path = store_path(settings_dict, style, brems_multiplier)
+        if not is_store(path):
+            print("no loss store for brems_multiplier {}".format(brems_multiplier))
+            continue
+        store, _ = load_store(path)
+        secondary_hist = histogram_store(store, loss_bin_edges, len_bins, primary_bin_edges=primary_bin_edges,
+                                         error_groups=error_groups(settings_dict))
+        sec_bins, sec_errs = secondary_hist.finalize()
+        rc.write_multiplier(settings_dict, style, brems_multiplier, sec_bins, sec_errs)
+        if primary_bin_edges is not None:
+            primary_bins, primary_errs = secondary_hist.finalize_primary()
+            rc.write_multiplier(settings_dict, style, brems_multiplier, primary_bins, primary_errs,
+                                {"primary_n_muons": secondary_hist.primary_n_muons.tolist()},
+                                rc.PRIMARY_CUBE)
+        print("brems_multiplier {} rehistogrammed".format(brems_multiplier))
+
+    if write_text:
+        rc.export_text(settings_dict, style)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config',
+                        type=str,
+                        dest='settings_file', default="build/settings.json",
+                        help='json file containing the settings')
+    parser.add_argument('-s', '--style',
+                        type=str,
+                        dest='style', default="buildup",
+                        help='buildup or testing')
+    parser.add_argument('-t', '--text',
+                        action='store_true',
+                        dest='write_text',
+                        help='additionally write the histograms of each multiplier as text files')
+    args = parser.parse_args()
+
+    with open(args.settings_file) as file:
+        settings_dict = json.load(file)
+
+    if not os.path.isdir(settings_dict["step01_path_{}_data".format(args.style)]):
+        os.makedirs(settings_dict["step01_path_{}_data".format(args.style)])
+
+    # histogram the stored losses with the binning of the settings file
+    rehistogram_store(settings_dict, args.style, args.write_text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+from argparse import ArgumentParser
+import os
+import json
+
+import secondary_hist as sh
+import result_cube as rc
+import loss_store as ls
+import checkpoint as cp
+import step_1_propagate as s1
+from phase_timer import PhaseTimer
+
+
+def load_shards(settings_dict, style):
+    r"""
+    Load the chunks of all shards and check that they belong together
+
+    Returns the chunks, the chunks of the additional binnings and the timing of every multiplier
+    and whether the losses were stored. Raises a ValueError, if a shard is missing,
+    was propagated with other settings or a chunk is missing or propagated twice.
+    """
+    shards_path = settings_dict["step01_path_{}_shards".format(style)]
+    shard_infos = []
+    if os.path.isdir(shards_path):
+        for name in sorted(os.listdir(shards_path)):
+            info_file = os.path.join(shards_path, name, "shard.json")
+            if os.path.isfile(info_file):
+                with open(info_file) as file:
+                    shard_infos.append((os.path.join(shards_path, name), json.load(file)))
+    if len(shard_infos) == 0:
+        raise ValueError("no finished shards in {}".format(shards_path))
+
+    n_shards = set(info["n_shards"] for _, info in shard_infos)
+    if len(n_shards) > 1:
+        raise ValueError("the shards were split into different numbers of shards: {}".format(sorted(n_shards)))
+    n_shards = n_shards.pop()
+    missing = sorted(set(range(n_shards)) - set(info["shard"] for _, info in shard_infos))
+    if len(missing) > 0:
+        raise ValueError("the shards {} of {} are missing".format(missing, n_shards))
+    store_losses = shard_infos[0][1]["store_losses"]
+    expected_hash = s1.shard_hash(settings_dict, style, store_losses)
+    other_settings = [info["shard"] for _, info in shard_infos if info["settings_hash"] != expected_hash]
+    if len(other_settings) > 0:
+        raise ValueError("the shards {} were propagated with other settings".format(other_settings))
+
+    chunk_hists = {}
+    binning_chunk_hists = {}
+    timers = {}
+    for path, info in shard_infos:
+        for shard_file in info["files"].values():
+            chunks, binning_chunks, chunk_info = cp.load_checkpoint(os.path.join(path, shard_file))
+            brems_multiplier = chunk_info["brems_multiplier"]
+            duplicates = set(chunks) & set(chunk_hists.get(brems_multiplier, {}))
+            if len(duplicates) > 0:
+                raise ValueError("the chunks {} of brems_multiplier {} are in several shards".format(
+                    sorted(duplicates), brems_multiplier))
+            chunk_hists.setdefault(brems_multiplier, {}).update(chunks)
+            binning_chunk_hists.setdefault(brems_multiplier, {}).update(binning_chunks)
+            timers.setdefault(brems_multiplier, PhaseTimer(settings_dict["n_slowest_muons"])).merge(PhaseTimer.from_dict(chunk_info["timing"]))
+
+    n_chunks = s1.number_of_chunks(settings_dict)
+    for brems_multiplier in settings_dict["brems_multiplier_{}_arr".format(style)]:
+        n_missing = n_chunks - len(chunk_hists.get(brems_multiplier, {}))
+        if n_missing > 0:
+            raise ValueError("{} chunks of brems_multiplier {} are missing".format(n_missing, brems_multiplier))
+    return chunk_hists, binning_chunk_hists, timers, store_losses
+
+def merge_shards(settings_dict, style, write_text=False, settings_file="build/settings.json"):
+    chunk_hists, binning_chunk_hists, timers, store_losses = load_shards(settings_dict, style)
+
+    # the merged shards replace the existing results
+    s1.create_outputs(settings_dict, style, overwrite=True)
+    if settings_dict.get("common_random_numbers", False):
+        n_batches = min(settings_dict.get("n_common_random_batches", 10), s1.number_of_chunks(settings_dict))
+        rc.create_cube(settings_dict, style, sh.N_SEC_TYPES, True, n_batches)
+    else:
+        n_batches = None
+
+    for brems_multiplier in settings_dict["brems_multiplier_{}_arr".format(style)]:
+        if store_losses:
+            store_path = ls.store_path(settings_dict, style, brems_multiplier)
+        else:
+            store_path = None
+        s1.finish_chunks(settings_dict, style, brems_multiplier, chunk_hists[brems_multiplier],
+                         binning_chunk_hists[brems_multiplier], store_path, n_batches, timers[brems_multiplier],
+                         settings_file)
+
+    if write_text:
+        rc.export_text(settings_dict, style)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config',
+                        type=str,
+                        dest='settings_file', default="build/settings.json",
+                        help='json file containing the settings')
+    parser.add_argument('-s', '--style',
+                        type=str,
+                        dest='style', default="buildup",
+                        help='buildup or testing')
+    parser.add_argument('-t', '--text',
+                        action='store_true',
+                        dest='write_text',
+                        help='additionally write the histograms of each multiplier as text files')
+    args = parser.parse_args()
+
+    with open(args.settings_file) as file:
+        settings_dict = json.load(file)
+
+    if not os.path.isdir(settings_dict["step01_path"]):
+        os.mkdir(settings_dict["step01_path"])
+
+    # combine the shards of step_1_propagate.py --shard into the histograms of all multipliers
+    merge_shards(settings_dict, args.style, args.write_text, args.settings_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+
+import os
+import time
+import json
+import heapq
+import numpy as np
+from contextlib import contextmanager
+
+# log binned latencies between 1 us and 10^4 s, the quantiles are exact to about 2 %
+LATENCY_MIN_EXP = -6
+LATENCY_MAX_EXP = 4
+LATENCY_BINS_PER_DECADE = 100
+
+
+# a copy is kept in range_distribution/latency_log.py for the range propagation
+class LatencyLog(object):
+    r"""
+    Distribution of the time per muon and the slowest muons
+
+    The histogram of the latencies and the slowest muons of independent
+    chunks can be merged. Every slow muon keeps the information given
+    to record, e.g. its energy, length and seed to replay it.
+    """
+    def __init__(self, n_slowest=10):
+        self.n_slowest = n_slowest
+        self.counts = np.zeros((LATENCY_MAX_EXP - LATENCY_MIN_EXP) * LATENCY_BINS_PER_DECADE + 2, dtype=np.int64)
+        self.max_time = 0.
+        self.slowest = []
+        self.n_pushed = 0
+
+    def bin_index(self, seconds):
+        if seconds <= 0:
+            return 0
+        idx = int(np.floor((np.log10(seconds) - LATENCY_MIN_EXP) * LATENCY_BINS_PER_DECADE)) + 1
+        return min(max(idx, 0), len(self.counts) - 1)
+
+    def record(self, seconds, **muon):
+        self.counts[self.bin_index(seconds)] += 1
+        self.max_time = max(self.max_time, seconds)
+        self.push(seconds, muon)
+
+    def push(self, seconds, muon):
+        # min heap of the slowest muons, the counter avoids comparing the dicts of equal times
+        entry = (seconds, self.n_pushed, muon)
+        self.n_pushed += 1
+        if len(self.slowest) < self.n_slowest:
+            heapq.heappush(self.slowest, entry)
+        elif self.slowest and seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.max_time = max(self.max_time, other.max_time)
+        for seconds, _, muon in sorted(other.slowest, key=lambda entry: entry[:2]):
+            self.push(seconds, muon)
+        return self
+
+    def quantile(self, q):
+        n_muons = self.counts.sum()
+        if n_muons == 0:
+            return 0.
+        idx = np.searchsorted(np.cumsum(self.counts), q * n_muons)
+        # the upper edge of the bin, but never above the slowest muon
+        upper_edge = 10**(LATENCY_MIN_EXP + idx / float(LATENCY_BINS_PER_DECADE))
+        return min(upper_edge, self.max_time)
+
+    def to_dict(self):
+        return {"n_slowest": self.n_slowest,
+                "counts": self.counts.tolist(),
+                "max_time": self.max_time,
+                "slowest": [[seconds, muon] for seconds, _, muon in sorted(self.slowest, key=lambda entry: entry[:2])]}
+
+    @classmethod
+    def from_dict(cls, state):
+        latency = cls(state["n_slowest"])
+        latency.counts = np.array(state["counts"], dtype=np.int64)
+        latency.max_time = state["max_time"]
+        for seconds, muon in state["slowest"]:
+            latency.push(seconds, muon)
+        return latency
+
+    def summary(self, replay=None):
+        r"""
+        Quantiles of the time per muon and the slowest muons, slowest first
+
+        Parameters
+        ----------
+        replay : callable, optional
+            returns the command to replay a slow muon from its information
+        """
+        slowest = []
+        for seconds, _, muon in sorted(self.slowest, key=lambda entry: (-entry[0], entry[1])):
+            muon = dict(muon, time=seconds)
+            if replay is not None:
+                muon["replay"] = replay(muon)
+            slowest.append(muon)
+        return {"n_muons": int(self.counts.sum()),
+                "p50": self.quantile(0.5),
+                "p99": self.quantile(0.99),
+                "p999": self.quantile(0.999),
+                "max": self.max_time,
+                "slowest": slowest}
+
+
+
+class PhaseTimer(object):
+    r"""
+    Cumulative wall time and number of calls of named phases
+
+    Timers of independent chunks can be merged. The counters count
+    e.g. the secondaries to normalize them to the number of muons.
+    The latencies of the single muons are kept in a LatencyLog.
+    """
+    def __init__(self, n_slowest=10):
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        self.n_muons = 0
+        self.latency = LatencyLog(n_slowest)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds, calls=1):
+        self.times[name] = self.times.get(name, 0.) + seconds
+        self.calls[name] = self.calls.get(name, 0) + calls
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        for name in other.times:
+            self.add(name, other.times[name], other.calls[name])
+        for name, value in other.counters.items():
+            self.count(name, value)
+        self.n_muons += other.n_muons
+        self.latency.merge(other.latency)
+        return self
+
+    def to_dict(self):
+        return {"times": self.times, "calls": self.calls, "counters": self.counters, "n_muons": self.n_muons,
+                "latency": self.latency.to_dict()}
+
+    @classmethod
+    def from_dict(cls, state):
+        timer = cls()
+        timer.times = dict(state["times"])
+        timer.calls = dict(state["calls"])
+        timer.counters = dict(state["counters"])
+        timer.n_muons = state["n_muons"]
+        timer.latency = LatencyLog.from_dict(state["latency"])
+        return timer
+
+    def summary(self, replay=None):
+        total_time = sum(self.times.values())
+        n_muons = max(self.n_muons, 1)
+        phases = {}
+        for name, seconds in self.times.items():
+            phases[name] = {"time": seconds,
+                            "calls": self.calls[name],
+                            "time_per_muon": seconds / n_muons,
+                            "fraction": seconds / total_time if total_time > 0 else 0.}
+        return {"n_muons": self.n_muons,
+                "total_time": total_time,
+                "time_per_muon": total_time / n_muons,
+                "phases": phases,
+                "counters": self.counters,
+                "counters_per_muon": {name: value / float(n_muons) for name, value in self.counters.items()},
+                "latency": self.latency.summary(replay)}
+
+    def write(self, path, replay=None, **extra):
+        summary = self.summary(replay)
+        summary.update(extra)
+        tmp_file = path + ".tmp"
+        with open(tmp_file, "w") as file:
+            json.dump(summary, fp=file, indent=2, separators=(",", ":"))
+        os.replace(tmp_file, path)
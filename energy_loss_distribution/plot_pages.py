@@ -0,0 +1,46 @@
+
+import matplotlib as mpl
+mpl.use('Agg')
+from matplotlib.backends.backend_pdf import PdfPages
+import matplotlib.pyplot as plt
+from multiprocessing import Pool
+
+# a worker process is replaced after this many figures,
+# so the memory of the workers stays bounded
+FIGURES_PER_WORKER = 20
+
+
+def save_page(task):
+    create_figure, args, file_name = task
+    fig = create_figure(*args)
+    fig.savefig(file_name)
+    plt.close(fig)
+    return file_name
+
+def render_pages(create_figure, page_args, file_names, workers=1, pdf_file=None):
+    r"""
+    Render one figure per entry of page_args
+
+    create_figure has to be a module level function returning the figure,
+    the pages are either saved into file_names or all into one multi-page pdf_file.
+    """
+    if pdf_file is not None:
+        # a pdf file can only be written by one process,
+        # but every figure is closed after its page is written
+        with PdfPages(pdf_file) as pdf:
+            for args in page_args:
+                fig = create_figure(*args)
+                pdf.savefig(fig)
+                plt.close(fig)
+        return
+
+    tasks = [(create_figure, args, file_name) for args, file_name in zip(page_args, file_names)]
+    if workers > 1 and len(tasks) > 1:
+        pool = Pool(min(workers, len(tasks)), maxtasksperchild=FIGURES_PER_WORKER)
+        for _ in pool.imap_unordered(save_page, tasks):
+            pass
+        pool.close()
+        pool.join()
+    else:
+        for task in tasks:
+            save_page(task)
@@ -0,0 +1,110 @@
+
+import numpy as np
+from argparse import ArgumentParser
+import cProfile
+import pstats
+import json
+
+import secondary_hist as sh
+import loss_store as ls
+import step_1_propagate as s1
+from phase_timer import PhaseTimer
+from step_0_settings import additional_binnings
+
+
+def replay_muon(settings_dict, style, brems_multiplier, energy, length, seed, store_losses=False, profile=None):
+    r"""
+    Propagate one muon of step_1 again, e.g. a slow muon of the timing file
+
+    The seed, energy and length of the muon give the same track,
+    the losses are filled like in propagate_chunk. The mupair muons
+    are all propagated here, also the ones handed over to other tasks.
+
+    Parameters
+    ----------
+    profile : str, optional
+        sort key of the cProfile statistics printed after the propagation
+    """
+    len_bins = np.arange(start=0,
+                        stop=settings_dict["propagation_length_max"],
+                        step=settings_dict["bin_len_step"])
+    brems = s1.get_brems_calculator(settings_dict, style) if store_losses else None
+    if store_losses or len(additional_binnings(settings_dict)) > 0:
+        loss_store = ls.LossStoreWriter(0)
+    else:
+        loss_store = None
+    # the tables are built or loaded before the propagation is timed
+    prop = s1.get_propagator(settings_dict, style, brems_multiplier)
+
+    timer = PhaseTimer()
+    profiler = cProfile.Profile() if profile is not None else None
+    if profiler is not None:
+        profiler.enable()
+    s1.propagate_and_fill_hist(prop,
+                               [energy],
+                               [length],
+                               [seed],
+                               sh.SecondaryHistAccumulator(np.array(settings_dict["energy_loss_bin_edges"])),
+                               len_bins,
+                               show_progress=False,
+                               loss_store=loss_store,
+                               mupair_max_depth=settings_dict.get("mupair_max_depth"),
+                               mupair_min_energy=settings_dict.get("mupair_min_energy", 0.),
+                               brems=brems,
+                               timer=timer)
+    if profiler is not None:
+        profiler.disable()
+        pstats.Stats(profiler).sort_stats(profile).print_stats(30)
+    return timer
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config',
+                        type=str,
+                        dest='settings_file', default="build/settings.json",
+                        help='json file containing the settings')
+    parser.add_argument('-s', '--style',
+                        type=str,
+                        dest='style', default="buildup",
+                        help='buildup or testing')
+    parser.add_argument('-m', '--multiplier',
+                        type=float,
+                        dest='brems_multiplier', required=True,
+                        help='brems multiplier of the propagator')
+    parser.add_argument('-e', '--energy',
+                        type=float,
+                        dest='energy', required=True,
+                        help='initial energy of the muon in MeV')
+    parser.add_argument('-l', '--length',
+                        type=float,
+                        dest='length', required=True,
+                        help='propagation length of the muon in cm')
+    parser.add_argument('--seed',
+                        type=int,
+                        dest='seed', required=True,
+                        help='seed of the muon')
+    parser.add_argument('--store',
+                        action='store_true',
+                        dest='store_losses',
+                        help='also calculate the bremsstrahlung exposure like step_1_propagate.py --store')
+    parser.add_argument('-p', '--profile',
+                        type=str,
+                        dest='profile', default=None, nargs='?', const='cumulative',
+                        help='profile the propagation and print the statistics sorted by this key')
+    args = parser.parse_args()
+
+    with open(args.settings_file) as file:
+        settings_dict = json.load(file)
+
+    timer = replay_muon(settings_dict, args.style, args.brems_multiplier, args.energy, args.length, args.seed,
+                        args.store_losses, args.profile)
+    summary = timer.summary()
+    slowest = summary["latency"]["slowest"][0]
+    print("{} secondaries, {} mupairs in {:.4g} s".format(slowest["n_secondaries"], slowest["n_mupairs"], slowest["time"]))
+    for name, phase in sorted(summary["phases"].items(), key=lambda item: -item[1]["time"]):
+        print("{:>16}: {:.4g} s ({:.1%})".format(name, phase["time"], phase["fraction"]))
+
+
+if __name__ == "__main__":
+    main()
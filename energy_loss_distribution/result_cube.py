@@ -0,0 +1,132 @@
+
+import numpy as np
+import os
+import json
+
+# the histograms of all multipliers are stored in one array
+# indexed [value/error, multiplier, secondary type, loss bin]
+VALUES = 0
+ERRORS = 1
+# with common random numbers the histograms of batches of the same muons
+# are stored in a second array indexed [batch, multiplier, secondary type, loss bin]
+BATCH_CUBE = "batch_cube"
+# the histograms split by the energy of the primary muon are stored in a third array
+# indexed [value/error, multiplier, primary energy bin, secondary type, loss bin]
+PRIMARY_CUBE = "primary_cube"
+
+
+def cube_files(settings_dict, style, kind="cube"):
+    cube_file = settings_dict["step01_file_{}_{}".format(style, kind)]
+    return cube_file, os.path.splitext(cube_file)[0] + ".json"
+
+def write_metadata(metadata_file, metadata):
+    tmp_file = metadata_file + ".tmp"
+    with open(tmp_file, "w") as file:
+        json.dump(metadata, fp=file, indent=2, separators=(",", ":"))
+    os.replace(tmp_file, metadata_file)
+
+def load_metadata(settings_dict, style, kind="cube"):
+    _, metadata_file = cube_files(settings_dict, style, kind)
+    with open(metadata_file) as file:
+        return json.load(file)
+
+def create_array(settings_dict, style, kind, shape, axes, overwrite=False, **extra_metadata):
+    cube_file, metadata_file = cube_files(settings_dict, style, kind)
+    multipliers = settings_dict["brems_multiplier_{}_arr".format(style)]
+
+    if os.path.isfile(cube_file) and os.path.isfile(metadata_file) and not overwrite:
+        metadata = load_metadata(settings_dict, style, kind)
+        if metadata["multipliers"] == multipliers \
+           and metadata["energy_loss_bin_edges"] == settings_dict["energy_loss_bin_edges"] \
+           and tuple(metadata["shape"]) == shape \
+           and all(metadata.get(key) == value for key, value in extra_metadata.items()):
+            return metadata
+
+    cube = np.lib.format.open_memmap(cube_file, mode="w+", dtype=np.float64, shape=shape)
+    cube.flush()
+    del cube
+    metadata = {
+        "shape": list(shape),
+        "axes": axes,
+        "multipliers": multipliers,
+        "secondary_types": settings_dict["secondary_types"],
+        "energy_loss_bin_edges": settings_dict["energy_loss_bin_edges"],
+        "energy_loss_bin_mids": settings_dict["energy_loss_bin_mids"],
+        "filled": [False] * len(multipliers),
+        # number of muons and achieved precision of each multiplier
+        "info": [None] * len(multipliers),
+    }
+    metadata.update(extra_metadata)
+    write_metadata(metadata_file, metadata)
+    return metadata
+
+def create_cube(settings_dict, style, n_sec_types, overwrite=False, n_batches=None):
+    n_multipliers = len(settings_dict["brems_multiplier_{}_arr".format(style)])
+    if n_batches is None:
+        return create_array(settings_dict, style, "cube",
+                            (2, n_multipliers, n_sec_types, settings_dict["n_energy_loss_bins"]),
+                            ["value/error", "multiplier", "secondary type", "loss bin"],
+                            overwrite)
+    return create_array(settings_dict, style, BATCH_CUBE,
+                        (n_batches, n_multipliers, n_sec_types, settings_dict["n_energy_loss_bins"]),
+                        ["batch", "multiplier", "secondary type", "loss bin"],
+                        overwrite)
+
+def create_primary_cube(settings_dict, style, n_sec_types, primary_bin_edges, sampling_masses, overwrite=False):
+    # the sampling masses are the probabilities of the primary energy bins
+    # in the sampled spectrum, they are needed to reweight to another spectrum
+    n_multipliers = len(settings_dict["brems_multiplier_{}_arr".format(style)])
+    return create_array(settings_dict, style, PRIMARY_CUBE,
+                        (2, n_multipliers, len(primary_bin_edges) - 1, n_sec_types, settings_dict["n_energy_loss_bins"]),
+                        ["value/error", "multiplier", "primary energy bin", "secondary type", "loss bin"],
+                        overwrite,
+                        primary_bin_edges=list(primary_bin_edges),
+                        sampling_masses=list(sampling_masses))
+
+def is_filled(metadata, brems_multiplier):
+    return metadata["filled"][metadata["multipliers"].index(brems_multiplier)]
+
+def write_multiplier(settings_dict, style, brems_multiplier, sec_bins, sec_errs, info=None, kind="cube"):
+    cube_file, metadata_file = cube_files(settings_dict, style, kind)
+    metadata = load_metadata(settings_dict, style, kind)
+    midx = metadata["multipliers"].index(brems_multiplier)
+
+    cube = np.load(cube_file, mmap_mode="r+")
+    cube[VALUES, midx] = sec_bins
+    cube[ERRORS, midx] = sec_errs
+    cube.flush()
+    del cube
+
+    metadata["filled"][midx] = True
+    metadata.setdefault("info", [None] * len(metadata["multipliers"]))[midx] = info
+    write_metadata(metadata_file, metadata)
+
+def write_batches(settings_dict, style, brems_multiplier, batch_bins):
+    cube_file, metadata_file = cube_files(settings_dict, style, BATCH_CUBE)
+    metadata = load_metadata(settings_dict, style, BATCH_CUBE)
+    midx = metadata["multipliers"].index(brems_multiplier)
+
+    cube = np.load(cube_file, mmap_mode="r+")
+    cube[:, midx] = batch_bins
+    cube.flush()
+    del cube
+
+    metadata["filled"][midx] = True
+    write_metadata(metadata_file, metadata)
+
+def load_cube(settings_dict, style, kind="cube"):
+    cube_file, _ = cube_files(settings_dict, style, kind)
+    return np.load(cube_file, mmap_mode="r"), load_metadata(settings_dict, style, kind)
+
+def multiplier_hist(cube, metadata, brems_multiplier):
+    midx = metadata["multipliers"].index(brems_multiplier)
+    return cube[VALUES, midx], cube[ERRORS, midx]
+
+def export_text(settings_dict, style):
+    # the old text files, one for the values and one for the errors of each multiplier
+    cube, metadata = load_cube(settings_dict, style)
+    for midx, brems_multiplier in enumerate(metadata["multipliers"]):
+        if not metadata["filled"][midx]:
+            continue
+        np.savetxt(settings_dict["step01_file_{}_data".format(style)].format(brems_multiplier), cube[VALUES, midx])
+        np.savetxt(settings_dict["step01_file_{}_err_data".format(style)].format(brems_multiplier), cube[ERRORS, midx])
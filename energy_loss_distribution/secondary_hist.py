@@ -0,0 +1,356 @@
+
+import numpy as np
+
+# type codes of the secondaries, the first ones are the indices
+# of the secondary groups returned by classify_secondary_columns
+EPAIR = 0
+BREMS = 1
+IONIZ = 2
+PHOTO = 3
+DECAY = 4
+MUPAIR = 5
+MUPAIR_MUON = 6
+WEAK = 7
+BINNED_TRACK = 8
+N_SEC_TYPES = 9
+# codes which are not part of a secondary group
+NEUTRINO = 9
+UNKNOWN_PARTICLE = 10
+UNKNOWN = 11
+
+# codes of secondaries with the particle id (decay products and mupair muons)
+PARTICLE_CODES = (DECAY, MUPAIR_MUON, NEUTRINO, UNKNOWN_PARTICLE)
+# the single muons will further be propagated and the neutrino energies don't count,
+# therefore don't count them in the binned energy losses
+NOT_BINNED_CODES = (MUPAIR_MUON, NEUTRINO)
+# lookup tables of the codes, faster than np.isin for the short tracks
+IS_PARTICLE_CODE = np.isin(np.arange(UNKNOWN + 1), PARTICLE_CODES)
+IS_NOT_BINNED_CODE = np.isin(np.arange(UNKNOWN + 1), NOT_BINNED_CODES)
+GROUP_CODES = np.arange(BINNED_TRACK + 1)
+
+
+def distance_on_line(start, direction, point):
+    # the norm of a single vector without the overhead of np.linalg.norm
+    return np.dot(point - start, direction) / np.sqrt(np.dot(direction, direction))
+
+def bin_track_energies(type_codes, energies, positions, len_bins):
+    if len(type_codes) == 1 or type_codes[0] in PARTICLE_CODES:
+        # only one interaction or directly a decay
+        # add the single cascade
+        return energies[:1].copy()
+
+    start_point = positions[0]
+    direction = positions[-1] - start_point
+    start_len = np.sqrt(np.dot(start_point, start_point))
+
+    all_lengths = start_len + distance_on_line(start_point, direction, positions)
+
+    # like np.digitize for increasing bins, the secondaries which are not binned
+    # are added with zero energy, the empty bins are removed anyway
+    len_indices = np.searchsorted(len_bins, all_lengths, side='right')
+    bincount = np.bincount(len_indices, np.where(IS_NOT_BINNED_CODE[type_codes], 0., energies))
+    return bincount[bincount > 0]
+
+def bin_track_rows(track_starts, track_ends, type_codes, energies, positions, len_bins):
+    # same as bin_track_energies, but for many tracks stored one after another,
+    # returns the binned energies and the index of their track
+    n_tracks = len(track_starts)
+    n_rows = track_ends - track_starts
+    do_len_binning = (n_rows > 1) & ~IS_PARTICLE_CODE[type_codes[track_starts]]
+
+    track_indices = np.repeat(np.arange(n_tracks), n_rows)
+    start_points = positions[track_starts]
+    directions = positions[track_ends - 1] - start_points
+    start_lens = np.linalg.norm(start_points, axis=1)
+    direction_lens = np.linalg.norm(directions, axis=1)
+
+    mask = do_len_binning[track_indices] & ~IS_NOT_BINNED_CODE[type_codes]
+    row_tracks = track_indices[mask]
+    all_lengths = start_lens[row_tracks] + np.einsum('ij,ij->i',
+                                                     positions[mask] - start_points[row_tracks],
+                                                     directions[row_tracks]) / direction_lens[row_tracks]
+
+    n_len_indices = len(len_bins) + 1
+    len_keys = row_tracks * n_len_indices + np.digitize(all_lengths, len_bins)
+    unique_keys, inverse = np.unique(len_keys, return_inverse=True)
+    bincount = np.bincount(inverse.ravel(), energies[mask], minlength=len(unique_keys))
+    keep = bincount > 0
+
+    # tracks with only one interaction or directly a decay are a single cascade
+    single_tracks = np.flatnonzero(~do_len_binning)
+    binned_energies = np.concatenate((bincount[keep], energies[track_starts[single_tracks]]))
+    binned_tracks = np.concatenate((unique_keys[keep] // n_len_indices, single_tracks))
+    return binned_energies, binned_tracks
+
+def classify_secondary_columns(type_codes, energies, positions, len_bins):
+    r"""
+    Sort the secondaries of one propagated muon into the secondary groups
+
+    Parameters
+    ----------
+    type_codes : array-like
+        type code of each secondary
+    energies : array-like
+        energy of each secondary
+    positions : array-like
+        (n, 3) array of the secondary positions
+    len_bins : array-like
+        edges of the length bins for the binned track
+
+    Returns
+    -------
+    secondaries : list
+        arrays of the energies in the groups epair, brems, ioniz, photo, decay,
+        mupair, mupair muons, weak and binned track
+    """
+    # the stable sort keeps the order of the secondaries inside the groups
+    order = np.argsort(type_codes, kind='stable')
+    group_edges = np.searchsorted(type_codes[order], GROUP_CODES).tolist()
+    sorted_energies = energies[order]
+    secondaries = [sorted_energies[start:stop] for start, stop in zip(group_edges[:-1], group_edges[1:])]
+    secondaries.append(bin_track_energies(type_codes, energies, positions, len_bins))
+    return secondaries
+
+
+class SecondaryHistAccumulator(object):
+    r"""
+    Sum of weights and sum of squared weights per secondary type and loss bin
+
+    The bins are right open, except the last one, like in np.histogram.
+    Accumulators of independent muon samples can be merged,
+    finalize returns the histogram per muon and its error.
+    If primary_bin_edges are given, the sums are additionally split
+    by the energy of the primary muon.
+
+    The muons of a stratified or a halton sample are not independent,
+    with error_groups ("strata", energy edges of the strata) or
+    ("replicates", number of replicates) the sums are also kept per group
+    and the errors are estimated from the variance inside the strata
+    or the spread of the independently shifted replicates.
+    The variance inside the strata needs the squares of the sums per muon.
+    The sums of muons, whose losses are filled in several parts, e.g. with
+    mupair muons propagated in other tasks, are kept open by their muon id
+    until the variance is calculated.
+    """
+    def __init__(self, loss_bin_edges, n_sec_types=N_SEC_TYPES, primary_bin_edges=None, error_groups=None):
+        self.loss_bin_edges = np.asarray(loss_bin_edges, dtype=float)
+        self.n_sec_types = n_sec_types
+        self.nbins = len(self.loss_bin_edges) - 1
+        self.sum_weights = np.zeros((n_sec_types, self.nbins))
+        self.sum_weights2 = np.zeros((n_sec_types, self.nbins))
+        self.n_muons = 0
+        self.init_primary(primary_bin_edges)
+        self.init_groups(error_groups)
+
+    def init_primary(self, primary_bin_edges):
+        if primary_bin_edges is None:
+            self.primary_bin_edges = None
+            return
+        self.primary_bin_edges = np.asarray(primary_bin_edges, dtype=float)
+        shape = (len(self.primary_bin_edges) - 1, self.n_sec_types, self.nbins)
+        self.primary_sum_weights = np.zeros(shape)
+        self.primary_sum_weights2 = np.zeros(shape)
+        self.primary_n_muons = np.zeros(shape[0], dtype=np.int64)
+
+    def init_groups(self, error_groups):
+        if error_groups is None:
+            self.error_groups = None
+            return
+        kind, groups = error_groups
+        if kind == "strata":
+            self.error_groups = (kind, [float(edge) for edge in groups])
+            n_groups = len(groups) - 1
+        elif kind == "replicates":
+            self.error_groups = (kind, int(groups))
+            n_groups = int(groups)
+        else:
+            raise KeyError("error groups {} are not known".format(kind))
+        shape = (n_groups, self.n_sec_types, self.nbins)
+        self.group_sum_weights = np.zeros(shape)
+        self.group_sum_squares = np.zeros(shape)
+        self.group_n_muons = np.zeros(n_groups, dtype=np.int64)
+        self.open_sums = {}
+
+    def group_index(self, primary_energies, muon_ids):
+        # the strata are given by the energy, the replicates interleave the muon indices
+        kind, groups = self.error_groups
+        if kind == "strata":
+            indices = np.searchsorted(groups, primary_energies, side='right') - 1
+            return np.clip(indices, 0, len(groups) - 2)
+        return np.asarray(muon_ids) % groups
+
+    def primary_index(self, primary_energies):
+        # the primary energies are sampled between the outer edges
+        indices = np.searchsorted(self.primary_bin_edges, primary_energies, side='right') - 1
+        return np.clip(indices, 0, len(self.primary_bin_edges) - 2)
+
+    def flat_indices(self, type_indices, energies):
+        bin_indices = np.searchsorted(self.loss_bin_edges, energies, side='right') - 1
+        bin_indices[energies == self.loss_bin_edges[-1]] = self.nbins - 1
+        mask = (bin_indices >= 0) & (bin_indices < self.nbins)
+        return type_indices[mask] * self.nbins + bin_indices[mask], mask
+
+    def count(self, sec_energies):
+        energies = np.concatenate(sec_energies)
+        type_indices = np.repeat(np.arange(len(sec_energies)),
+                                 [len(energies_tmp) for energies_tmp in sec_energies])
+        flat_indices, _ = self.flat_indices(type_indices, energies)
+        counts = np.bincount(flat_indices, minlength=self.n_sec_types * self.nbins)
+        return counts.reshape(self.n_sec_types, self.nbins)
+
+    def fill(self, sec_energies, weight=1., primary_energy=None, count_muon=True, muon_id=None, complete=True):
+        # all secondaries of one muon have the same weight,
+        # so the counts of all types are added at once,
+        # the losses of mupair muons propagated in another task are added without counting the muon,
+        # the sums of incomplete muons are kept open
+        primary = self.primary_bin_edges is not None and primary_energy is not None
+        if primary:
+            pidx = self.primary_index(primary_energy)
+        if self.error_groups is not None:
+            gidx = self.group_index(primary_energy, muon_id)
+        if count_muon:
+            self.n_muons += 1
+            if primary:
+                self.primary_n_muons[pidx] += 1
+            if self.error_groups is not None:
+                self.group_n_muons[gidx] += 1
+        if len(sec_energies) == 0:
+            return
+        counts = self.count(sec_energies)
+        self.sum_weights += weight * counts
+        self.sum_weights2 += weight**2 * counts
+        if primary:
+            self.primary_sum_weights[pidx] += weight * counts
+            self.primary_sum_weights2[pidx] += weight**2 * counts
+        if self.error_groups is not None:
+            self.group_sum_weights[gidx] += weight * counts
+            if complete:
+                self.group_sum_squares[gidx] += (weight * counts)**2
+            else:
+                self.add_open((gidx, muon_id), weight * counts)
+
+    def add_open(self, key, sums):
+        if key in self.open_sums:
+            self.open_sums[key] = self.open_sums[key] + sums
+        else:
+            self.open_sums[key] = np.array(sums, dtype=float)
+
+    def fill_split(self, sum_weights, sum_weights2, flat_indices, split_indices, weights):
+        # add the weights to sums which are split along their first axis
+        shape = sum_weights.shape
+        flat_indices = flat_indices + split_indices * self.n_sec_types * self.nbins
+        sum_weights += np.bincount(flat_indices, weights, minlength=np.prod(shape)).reshape(shape)
+        sum_weights2 += np.bincount(flat_indices, weights**2, minlength=np.prod(shape)).reshape(shape)
+
+    def fill_groups(self, flat_indices, group_indices, muon_ids, weights, open_muon_ids=None):
+        # the sums of the weights of every muon are squared,
+        # without the muon ids every entry counts as an own muon
+        shape = self.group_sum_weights.shape
+        flat_indices = flat_indices + group_indices * self.n_sec_types * self.nbins
+        self.group_sum_weights += np.bincount(flat_indices, weights, minlength=np.prod(shape)).reshape(shape)
+        if muon_ids is not None:
+            muon_keys, inverse = np.unique(np.asarray(muon_ids, dtype=np.int64) * np.prod(shape) + flat_indices,
+                                           return_inverse=True)
+            weights = np.bincount(inverse.ravel(), weights)
+            flat_indices = muon_keys % np.prod(shape)
+            if open_muon_ids is not None:
+                key_muon_ids = muon_keys // np.prod(shape)
+                is_open = np.isin(key_muon_ids, open_muon_ids)
+                for muon_id in np.unique(key_muon_ids[is_open]):
+                    rows = is_open & (key_muon_ids == muon_id)
+                    open_sums = np.bincount(flat_indices[rows], weights[rows], minlength=np.prod(shape)).reshape(shape)
+                    # the muon is in a single group
+                    gidx = flat_indices[rows][0] // (self.n_sec_types * self.nbins)
+                    self.add_open((int(gidx), int(muon_id)), open_sums[gidx])
+                flat_indices = flat_indices[~is_open]
+                weights = weights[~is_open]
+        self.group_sum_squares += np.bincount(flat_indices, weights**2, minlength=np.prod(shape)).reshape(shape)
+
+    def fill_losses(self, type_indices, energies, weights, primary_energies=None, muon_ids=None, open_muon_ids=None):
+        # losses of several muons with individual weights,
+        # the muons have to be counted separately,
+        # the sums of the open muons are kept open
+        flat_indices, mask = self.flat_indices(type_indices, energies)
+        self.fill_split(self.sum_weights, self.sum_weights2, flat_indices, 0, weights[mask])
+        if self.error_groups is not None:
+            group_indices = self.group_index(None if primary_energies is None else primary_energies[mask],
+                                             None if muon_ids is None else muon_ids[mask])
+            self.fill_groups(flat_indices, group_indices, None if muon_ids is None else muon_ids[mask], weights[mask],
+                             open_muon_ids)
+        if self.primary_bin_edges is None or primary_energies is None:
+            return
+        self.fill_split(self.primary_sum_weights, self.primary_sum_weights2, flat_indices,
+                        self.primary_index(primary_energies[mask]), weights[mask])
+
+    def merge(self, other):
+        if not np.array_equal(self.loss_bin_edges, other.loss_bin_edges):
+            raise ValueError('can only merge histograms with the same loss bins')
+        if self.primary_bin_edges is None and other.primary_bin_edges is not None and self.n_muons == 0:
+            self.init_primary(other.primary_bin_edges)
+        if (self.primary_bin_edges is None) != (other.primary_bin_edges is None) or \
+           (self.primary_bin_edges is not None and not np.array_equal(self.primary_bin_edges, other.primary_bin_edges)):
+            raise ValueError('can only merge histograms with the same primary energy bins')
+        if self.error_groups is None and other.error_groups is not None and self.n_muons == 0:
+            self.init_groups(other.error_groups)
+        if self.error_groups != other.error_groups:
+            raise ValueError('can only merge histograms with the same error groups')
+        self.sum_weights += other.sum_weights
+        self.sum_weights2 += other.sum_weights2
+        self.n_muons += other.n_muons
+        if self.primary_bin_edges is not None:
+            self.primary_sum_weights += other.primary_sum_weights
+            self.primary_sum_weights2 += other.primary_sum_weights2
+            self.primary_n_muons += other.primary_n_muons
+        if self.error_groups is not None:
+            self.group_sum_weights += other.group_sum_weights
+            self.group_sum_squares += other.group_sum_squares
+            self.group_n_muons += other.group_n_muons
+            for key, sums in other.open_sums.items():
+                self.add_open(key, sums)
+        return self
+
+    def variance(self):
+        r"""
+        Variance of the sums of the weights
+
+        The squared weights of the entries estimate the variance of
+        independent muons. For strata the variance between the strata
+        is removed, strata with a single muon keep the squared sums.
+        For replicates it is the spread of the means per muon of the
+        replicates, it needs at least two filled replicates.
+        """
+        if self.error_groups is None:
+            return self.sum_weights2
+        n_muons = self.group_n_muons[:, np.newaxis, np.newaxis].astype(float)
+        if self.error_groups[0] == "strata":
+            sum_squares = self.group_sum_squares.copy()
+            for (gidx, _), sums in self.open_sums.items():
+                sum_squares[gidx] += sums**2
+            # n / (n - 1) * (sum x**2 - (sum x)**2 / n) of the sums x of the muons of every stratum
+            between = np.zeros_like(self.group_sum_weights)
+            np.divide(self.group_sum_weights**2, n_muons, out=between, where=n_muons > 1)
+            scale = np.where(n_muons > 1, n_muons / np.maximum(n_muons - 1., 1.), 1.)
+            return np.clip(np.sum(scale * (sum_squares - between), axis=0), 0., None)
+        filled = self.group_n_muons > 0
+        if np.count_nonzero(filled) < 2:
+            return self.sum_weights2
+        means = self.group_sum_weights[filled] / n_muons[filled]
+        return np.var(means, axis=0, ddof=1) / np.count_nonzero(filled) * float(self.n_muons)**2
+
+    def max_rel_error(self, type_indices, min_entries=1.):
+        # only bins with at least min_entries effective entries are taken into account,
+        # so single entries in the tails do not dominate
+        sum_weights = self.sum_weights[type_indices]
+        sum_weights2 = self.sum_weights2[type_indices]
+        filled = sum_weights > 0
+        filled[filled] = sum_weights[filled]**2 / sum_weights2[filled] >= min_entries
+        if not np.any(filled):
+            return np.inf
+        return np.max(np.sqrt(self.variance()[type_indices][filled]) / sum_weights[filled])
+
+    def finalize(self):
+        return self.sum_weights / float(self.n_muons), np.sqrt(self.variance()) / float(self.n_muons)
+
+    def finalize_primary(self):
+        # normed to all muons, so the sum over the primary bins is the histogram of finalize
+        return self.primary_sum_weights / float(self.n_muons), np.sqrt(self.primary_sum_weights2) / float(self.n_muons)
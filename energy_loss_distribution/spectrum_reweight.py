@@ -0,0 +1,93 @@
+
+import numpy as np
+from argparse import ArgumentParser
+import json
+
+import result_cube as rc
+
+
+def powerlaw_masses(bin_edges, spectral_index):
+    r"""
+    Probabilities of the bins in a power law spectrum between the outer bin edges
+
+    Parameters
+    ----------
+    bin_edges : array-like
+        edges of the primary energy bins
+    spectral_index : float
+        index of the power law, 1 is uniform in log10 of the energy
+
+    Returns
+    -------
+    masses : array-like
+        probability of each bin
+    """
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    if spectral_index == 1:
+        cdf = np.log(bin_edges)
+    else:
+        cdf = bin_edges**(1. - spectral_index)
+    return np.diff(cdf) / (cdf[-1] - cdf[0])
+
+def reweight_spectrum(primary_cube, metadata, spectral_index):
+    r"""
+    Histograms of all multipliers for another primary spectrum
+
+    Every primary energy bin is weighted with the ratio of its probability
+    in the new spectrum and in the sampled spectrum. Within a bin the spectra
+    are assumed to have the same shape, so the primary bins should be narrow
+    compared to the change of the ratio.
+
+    Returns
+    -------
+    sec_bins, sec_errs : array-like
+        arrays of shape (multiplier, secondary type, loss bin)
+    """
+    ratios = powerlaw_masses(metadata["primary_bin_edges"], spectral_index) / np.array(metadata["sampling_masses"])
+    ratios = ratios[:, np.newaxis, np.newaxis]
+    sec_bins = np.sum(ratios * primary_cube[rc.VALUES], axis=1)
+    sec_errs = np.sqrt(np.sum(ratios**2 * primary_cube[rc.ERRORS]**2, axis=1))
+    return sec_bins, sec_errs
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config',
+                        type=str,
+                        dest='settings_file', default="build/settings.json",
+                        help='json file containing the settings')
+    parser.add_argument('-s', '--style',
+                        type=str,
+                        dest='style', default="buildup",
+                        help='buildup or testing')
+    parser.add_argument('-g', '--spectral-index',
+                        type=float,
+                        dest='spectral_index', required=True,
+                        help='index of the new power law spectrum, 1 for the log10 uniform spectrum')
+    parser.add_argument('-o', '--output',
+                        type=str,
+                        dest='output', default=None,
+                        help='npz file of the reweighted histograms')
+    args = parser.parse_args()
+
+    with open(args.settings_file) as file:
+        settings_dict = json.load(file)
+
+    primary_cube, metadata = rc.load_cube(settings_dict, args.style, rc.PRIMARY_CUBE)
+    sec_bins, sec_errs = reweight_spectrum(primary_cube, metadata, args.spectral_index)
+
+    output = args.output
+    if output is None:
+        output = settings_dict["step01_file_{}_spectrum".format(args.style)].format(args.spectral_index)
+    np.savez(output,
+             values=sec_bins,
+             errors=sec_errs,
+             spectral_index=args.spectral_index,
+             multipliers=metadata["multipliers"],
+             filled=metadata["filled"],
+             secondary_types=metadata["secondary_types"],
+             energy_loss_bin_edges=metadata["energy_loss_bin_edges"])
+
+
+if __name__ == "__main__":
+    main()
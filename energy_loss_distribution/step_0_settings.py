@@ -1,8 +1,88 @@
 
+import hashlib
 import json
 import numpy as np
 import os
 
+# settings which change the propagated muons, the binning settings are not part of it
+PROPAGATION_KEYS = [
+    "random_seed",
+    "n_muons",
+    "muon_energy_min",
+    "muon_energy_max",
+    "powerlaw_sampler",
+    "spectral_index",
+    "propagation_length_min",
+    "propagation_length_max",
+    "muon_sampler",
+    "n_energy_strata",
+    "n_halton_replicates",
+]
+
+
+def settings_hash(settings_dict, keys=PROPAGATION_KEYS, **extra):
+    hash_dict = {key: settings_dict.get(key) for key in keys}
+    hash_dict.update(extra)
+    hash_str = json.dumps(hash_dict, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(hash_str.encode("utf-8")).hexdigest()
+
+
+def energy_loss_bins(energy_loss_min, energy_loss_max, n_bins):
+    # log10 bins and their log10 centers
+    bin_arr = np.logspace(np.log10(energy_loss_min),
+                          np.log10(energy_loss_max),
+                          num = 2 * n_bins + 1)
+    return bin_arr[::2], bin_arr[1::2]
+
+
+def binning_key(bin_len_step, n_energy_loss_bins):
+    return "len{:g}_loss{:d}".format(bin_len_step, n_energy_loss_bins)
+
+
+def additional_binnings(settings_dict):
+    # all combinations of the length steps and loss resolutions except the main binning
+    main_key = binning_key(settings_dict["bin_len_step"], settings_dict["n_energy_loss_bins"])
+    binnings = []
+    for bin_len_step in settings_dict.get("bin_len_steps", []):
+        for n_energy_loss_bins in settings_dict.get("n_energy_loss_bins_list", []):
+            if binning_key(bin_len_step, n_energy_loss_bins) != main_key:
+                binnings.append((bin_len_step, n_energy_loss_bins))
+    return binnings
+
+
+def binning_settings(settings_dict, style, bin_len_step, n_energy_loss_bins):
+    # the settings of an additional binning, its cube is written into the binnings directory
+    key = binning_key(bin_len_step, n_energy_loss_bins)
+    energy_loss_bin_edges, energy_loss_bin_mids = energy_loss_bins(settings_dict["energy_loss_min"],
+                                                                   settings_dict["muon_energy_max"],
+                                                                   n_energy_loss_bins)
+    binning_dict = dict(settings_dict)
+    binning_dict["bin_len_step"] = bin_len_step
+    binning_dict["n_energy_loss_bins"] = n_energy_loss_bins
+    binning_dict["energy_loss_bin_edges"] = energy_loss_bin_edges.tolist()
+    binning_dict["energy_loss_bin_mids"] = energy_loss_bin_mids.tolist()
+    binning_dict["step01_file_{}_cube".format(style)] = os.path.join(settings_dict["step01_path_{}_binnings".format(style)],
+                                                                     "losses_cube_{}.npy".format(key))
+    return binning_dict
+
+
+def strata_energy_edges(settings_dict):
+    # strata of the same width in log10 of the muon energy
+    return np.logspace(np.log10(settings_dict["muon_energy_min"]),
+                       np.log10(settings_dict["muon_energy_max"]),
+                       settings_dict["n_energy_strata"] + 1)
+
+
+def error_groups(settings_dict):
+    # the groups of muons to estimate the errors of the stratified and the halton sampler,
+    # see SecondaryHistAccumulator, the random muons are independent
+    sampler = settings_dict.get("muon_sampler", "random")
+    if sampler == "stratified":
+        return "strata", strata_energy_edges(settings_dict).tolist()
+    if sampler == "halton":
+        return "replicates", settings_dict["n_halton_replicates"]
+    return None
+
 
 def create_settings_dict():
     settings_dict = {}
@@ -39,21 +119,70 @@ def create_settings_dict():
     brems_multiplier_test_arr = (multiplier_max - multiplier_min) * np.random.random(n_tests_multiplier) + multiplier_min
     settings_dict["brems_multiplier_testing_arr"] = brems_multiplier_test_arr.tolist()
 
+    # the multiplier which is propagated to reweight it to all others
+    # and the multiplier which are propagated to validate the reweighting
+    settings_dict["brems_reweight_reference"] = 1.0
+    settings_dict["brems_reweight_validation"] = [0.7, 1.3]
+
     # set muon energies between its randomly sampled in log10 (power law)
     settings_dict["n_muons"] = int(1e3)
+    # the random streams of the muons are derived from the seed, the other settings,
+    # the multiplier and the index of the muon
+    settings_dict["random_seed"] = 123
+    # propagate the same muons with the same random streams for every multiplier,
+    # this correlates the multipliers and reduces the variance of the bin differences
+    settings_dict["common_random_numbers"] = False
+    # the chunks are merged into batches to estimate the errors of the correlated fits
+    settings_dict["n_common_random_batches"] = 10
+    # the muons of muon pairs are propagated up to this generation (None: no limit)
+    # and above this energy in MeV, the others only count as mupair loss
+    settings_dict["mupair_max_depth"] = None
+    settings_dict["mupair_min_energy"] = 0.
+    # a task propagates at most this many mupair muons of a muon, the rest of the cascade
+    # is handed over to further tasks of all processes (None: the task of the chunk propagates all)
+    settings_dict["mupair_tracks_per_task"] = 50
+    # muons are propagated in chunks, which can be processed in parallel,
+    # without a target the results only change in the last bits with the chunk size
+    settings_dict["n_muons_per_chunk"] = 100
+    # if a target is set, chunks are propagated until all filled bins of the
+    # chosen types reach the relative error or the muon or time (s) budget is used up
+    settings_dict["adaptive_target_rel_error"] = None
+    settings_dict["adaptive_secondary_types"] = ["Binned Track"]
+    # bins with less effective entries are not taken into account
+    settings_dict["adaptive_min_entries"] = 10
+    settings_dict["adaptive_max_muons"] = int(1e5)
+    settings_dict["adaptive_max_time"] = None
+    # the target is checked after every round of this many chunks, independent of the number of processes
+    settings_dict["adaptive_chunks_per_round"] = 4
+    # the finished chunks are written to a checkpoint at most every interval (s) to resume
+    # an interrupted run, None disables the checkpoints
+    settings_dict["checkpoint_interval"] = 600.
+    # muons exceeding the wall time (s) or number of secondaries including the mupair muons
+    # are quarantined and left out of the histograms, they are checked after every track, None disables
+    settings_dict["muon_max_time"] = None
+    settings_dict["muon_max_secondaries"] = None
+    # number of slowest muons of a multiplier logged with their replay command in the timing file
+    settings_dict["n_slowest_muons"] = 10
     settings_dict["n_energy_loss_bins"] = 20
     settings_dict["muon_energy_min"] = 1e7 # MeV
     settings_dict["muon_energy_max"] = 3e7 # MeV
     settings_dict["energy_loss_min"] = 500. # MeV - this is the ecut
     settings_dict["powerlaw_sampler"] = True # - choose between powerlaw or logspace sample
     settings_dict["spectral_index"] = 3.0 # - if powerlaw sampler is used
+    # sample energies and lengths "random", "stratified" in log10 energy strata or with a "halton" sequence
+    settings_dict["muon_sampler"] = "random"
+    settings_dict["n_energy_strata"] = 10 # - if stratified sampler is used
+    # the halton points are split into replicates with independent random shifts,
+    # their spread gives the errors
+    settings_dict["n_halton_replicates"] = 8 # - if halton sampler is used
+    # the histograms are also split in log10 bins of the primary energy,
+    # to reweight them to another spectrum (None: not split)
+    settings_dict["n_primary_energy_bins"] = 10
 
     # set loss bins
-    bin_arr = np.logspace(np.log10(settings_dict["energy_loss_min"]),
-                          np.log10(settings_dict["muon_energy_max"]),
-                          num = 2 * settings_dict["n_energy_loss_bins"] + 1)
-    energy_loss_bin_edges = bin_arr[::2]
-    energy_loss_bin_mids = bin_arr[1::2]
+    energy_loss_bin_edges, energy_loss_bin_mids = energy_loss_bins(settings_dict["energy_loss_min"],
+                                                                   settings_dict["muon_energy_max"],
+                                                                   settings_dict["n_energy_loss_bins"])
     settings_dict["energy_loss_bin_edges"] = energy_loss_bin_edges.tolist()
     settings_dict["energy_loss_bin_mids"] = energy_loss_bin_mids.tolist()
 
@@ -61,6 +190,11 @@ def create_settings_dict():
     settings_dict["propagation_length_min"] = 1e4 # cm
     settings_dict["propagation_length_max"] = 1e5# cm
     settings_dict["bin_len_step"] = 1500. # cm
+    # all combinations of these length steps and numbers of loss bins are filled
+    # in the same propagation, additionally to the main binning above,
+    # e.g. [500., 1000., 1500., 2000.] and [20, 40]
+    settings_dict["bin_len_steps"] = [] # cm
+    settings_dict["n_energy_loss_bins_list"] = []
 
     # set secondary types
     settings_dict["secondary_types"] = [
@@ -71,7 +205,7 @@ def create_settings_dict():
         "Decay Electron",
         'MuPair',
         'MuPair_secondaries',
-        'Weak'
+        'Weak',
         "Binned Track",
     ]
 
@@ -79,6 +213,12 @@ def create_settings_dict():
     settings_dict["path_interpolation_tables_buildup"] = "~/.local/share/PROPOSAL/tables"
     # the tables for the random test multiplier shouldn't be stored
     settings_dict["path_interpolation_tables_testing"] = ""
+    # only read the tables, e.g. after they are build with warmup_tables.py
+    settings_dict["interpolation_tables_readonly"] = False
+    # the tables of the test multipliers are cached in a scratch directory up to this size in bytes,
+    # it is removed after all test multipliers are propagated, if cleanup is set
+    settings_dict["table_cache_max_size"] = int(2e9)
+    settings_dict["table_cache_cleanup"] = True
 
     # create build directory in current path
     current_path = os.getcwd()
@@ -88,6 +228,9 @@ def create_settings_dict():
     if not os.path.isdir(settings_dict["build_path"]):
         os.mkdir(settings_dict["build_path"])
 
+    settings_dict["path_interpolation_tables_testing_cache"] = os.path.join(settings_dict["build_path"],
+                                                                            "table_cache")
+
     # set directory for step 01
     settings_dict["step01_path"] = os.path.join(settings_dict["build_path"],
                                                 "step01")
@@ -98,13 +241,43 @@ def create_settings_dict():
                                                                         "data")
         settings_dict["step01_path_{}_plots".format(idx)] = os.path.join(settings_dict["step01_path_{}".format(idx)],
                                                                          "plots")
+        settings_dict["step01_path_{}_store".format(idx)] = os.path.join(settings_dict["step01_path_{}".format(idx)],
+                                                                         "store")
+        settings_dict["step01_path_{}_binnings".format(idx)] = os.path.join(settings_dict["step01_path_{}".format(idx)],
+                                                                            "binnings")
+        settings_dict["step01_path_{}_checkpoints".format(idx)] = os.path.join(settings_dict["step01_path_{}".format(idx)],
+                                                                               "checkpoints")
+        settings_dict["step01_path_{}_shards".format(idx)] = os.path.join(settings_dict["step01_path_{}".format(idx)],
+                                                                          "shards")
+        settings_dict["step01_path_{}_quarantine".format(idx)] = os.path.join(settings_dict["step01_path_{}".format(idx)],
+                                                                              "quarantine")
 
         settings_dict["step01_file_{}_data".format(idx)] = os.path.join(settings_dict["step01_path_{}_data".format(idx)],
                                                                         "losses_bins_{:.4}.txt")
         settings_dict["step01_file_{}_err_data".format(idx)] = os.path.join(settings_dict["step01_path_{}_data".format(idx)],
                                                                         "losses_err_{:.4}.txt")
+        settings_dict["step01_file_{}_timing".format(idx)] = os.path.join(settings_dict["step01_path_{}_data".format(idx)],
+                                                                          "timing_{:.4}.json")
+        settings_dict["step01_file_{}_quarantine".format(idx)] = os.path.join(settings_dict["step01_path_{}_data".format(idx)],
+                                                                              "quarantine_{:.4}.jsonl")
+        settings_dict["step01_file_{}_cube".format(idx)] = os.path.join(settings_dict["step01_path_{}_data".format(idx)],
+                                                                        "losses_cube.npy")
+        settings_dict["step01_file_{}_batch_cube".format(idx)] = os.path.join(settings_dict["step01_path_{}_data".format(idx)],
+                                                                              "losses_batch_cube.npy")
+        settings_dict["step01_file_{}_primary_cube".format(idx)] = os.path.join(settings_dict["step01_path_{}_data".format(idx)],
+                                                                                "losses_primary_cube.npy")
+        settings_dict["step01_file_{}_spectrum".format(idx)] = os.path.join(settings_dict["step01_path_{}_data".format(idx)],
+                                                                            "losses_spectrum_{}.npz")
+        settings_dict["step01_file_{}_reweight_report".format(idx)] = os.path.join(settings_dict["step01_path_{}_data".format(idx)],
+                                                                                   "reweight_report.json")
         settings_dict["step01_file_{}_plots".format(idx)] = os.path.join(settings_dict["step01_path_{}_plots".format(idx)],
                                                                          "losses_spectrum_{:.4}.pdf")
+        settings_dict["step01_file_{}_checkpoint".format(idx)] = os.path.join(settings_dict["step01_path_{}_checkpoints".format(idx)],
+                                                                              "checkpoint_{!r}.npz")
+        settings_dict["step01_file_{}_snapshot_plots".format(idx)] = os.path.join(settings_dict["step01_path_{}_plots".format(idx)],
+                                                                                  "snapshot_{:.4}.pdf")
+        settings_dict["step01_file_{}_plots_all".format(idx)] = os.path.join(settings_dict["step01_path_{}_plots".format(idx)],
+                                                                             "losses_spectra.pdf")
         settings_dict["step01_file_multiplier_compare_{}_plot".format(idx)] = os.path.join(settings_dict["step01_path_{}_plots".format(idx)],
                                                                          "multiplier_compare.pdf")
 
@@ -115,8 +288,12 @@ def create_settings_dict():
                                                       "plots")
     settings_dict["step02_file_plots"] = os.path.join(settings_dict["step02_path_plots"],
                                                       "bin_diff_fit_{}.pdf")
+    settings_dict["step02_file_plots_all"] = os.path.join(settings_dict["step02_path_plots"],
+                                                          "bin_diff_fit_all.pdf")
     settings_dict["step02_file_param_bin_diff"] = os.path.join(settings_dict["step02_path"],
                                                                "param_bin_diff.txt")
+    settings_dict["step02_file_param_fit"] = os.path.join(settings_dict["step02_path"],
+                                                          "param_fit.npz")
 
     # set directory for step 03
     settings_dict["step03_path"] = os.path.join(settings_dict["build_path"],
@@ -128,6 +305,10 @@ def create_settings_dict():
     settings_dict["step03_file_pullplot"] = os.path.join(settings_dict["step03_path"],
                                                          "pull_dist.pdf")
 
+    settings_dict["file_table_warmup"] = os.path.join(settings_dict["build_path"], "table_warmup.json")
+    settings_dict["file_benchmark_baseline"] = os.path.join(settings_dict["build_path"], "benchmark_baseline.json")
+    settings_dict["file_cost_estimate"] = os.path.join(settings_dict["build_path"], "cost_estimate.json")
+
     with open(os.path.join(settings_dict["build_path"], "settings.json"), "w") as file:
         json.dump(settings_dict, fp=file, indent=2, separators=(",", ":"))
 
@@ -1,27 +1,195 @@
 
 import pyPROPOSAL as pp
 import numpy as np
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from functools import partial
+from collections import deque
+from multiprocessing import Pool
+from queue import Queue
 from tqdm import tqdm
+import shutil
 import os
 import json
+import time
 
+import secondary_hist as sh
+import loss_store as ls
+import result_cube as rc
+import interpolation_tables as it
+import checkpoint as cp
+from phase_timer import PhaseTimer
+from step_0_settings import PROPAGATION_KEYS, additional_binnings, binning_key, binning_settings, settings_hash, \
+    strata_energy_edges, error_groups
 
-def distance_on_line(start, direction, point):
-    return - np.dot(start - point, direction) / np.linalg.norm(direction)
+# tags of the streams derived from the stream key of a multiplier,
+# the streams of every single muon and the stream shared by the muons sampled together
+MUON_STREAM = 0
+SAMPLE_STREAM = 1
 
-def random_logspace_sampler(start, end, num):
-    return 10**(np.random.uniform(np.log10(start), np.log10(end), num))
 
-def random_powerlaw_sampler(xlow, xhig, num, gamma=3.7):
-    u = np.random.uniform(size=int(num))
+def muon_stream_key(settings_dict, brems_multiplier):
+    r"""
+    Key of the random streams of the muons of a multiplier
 
+    Every muon gets its own stream derived from the settings of the propagation,
+    the multiplier and the index of the muon, so its sample and its propagation
+    do not depend on the number of workers or shards and the order of the multipliers.
+    The number of muons is not part of the key, so more muons extend the sample.
+    With common random numbers all multipliers share the same streams.
+    """
+    entropy = int(settings_hash(settings_dict, keys=[key for key in PROPAGATION_KEYS if key != "n_muons"]), 16)
+    if settings_dict.get("common_random_numbers", False):
+        return entropy, 0
+    return entropy, int(np.float64(brems_multiplier).view(np.uint64))
+
+def muon_random_words(stream_key, first_muon_idx, n_muons, n_words):
+    # counter based, the words of a muon only depend on the key and the index of the muon
+    entropy, multiplier_word = stream_key
+    words = [np.random.SeedSequence(entropy, spawn_key=(multiplier_word, MUON_STREAM, idx)).generate_state(n_words, np.uint64)
+             for idx in range(first_muon_idx, first_muon_idx + n_muons)]
+    return np.array(words, dtype=np.uint64).reshape(n_muons, n_words)
+
+def sample_generator(stream_key, first_muon_idx):
+    # the generator of the numbers shared by the muons sampled together, e.g. the latin hypercube permutations
+    entropy, multiplier_word = stream_key
+    return np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(multiplier_word, SAMPLE_STREAM, first_muon_idx)))
+
+def powerlaw_inverse_cdf(u, xlow, xhig, gamma=3.7):
     if gamma == 1:
         return np.exp(u * np.log(xhig / xlow)) * xlow
     else:
         radicant = (u * (xhig**(1. - gamma) - xlow**(1. - gamma)) + xlow**(1. - gamma))
         return radicant**(1. / (1. - gamma))
 
+def powerlaw_cdf(x, xlow, xhig, gamma=3.7):
+    if gamma == 1:
+        return np.log(x / xlow) / np.log(xhig / xlow)
+    else:
+        return (x**(1. - gamma) - xlow**(1. - gamma)) / (xhig**(1. - gamma) - xlow**(1. - gamma))
+
+def halton_sequence(num, base, start=1):
+    indices = np.arange(start, start + num)
+    sequence = np.zeros(num)
+    factor = 1.
+    while np.any(indices > 0):
+        factor /= base
+        sequence += factor * (indices % base)
+        indices //= base
+    return sequence
+
+def halton_sampler(num, rng=np.random):
+    # randomly shifted 2d halton sequence, so every run gets other points
+    points = np.column_stack((halton_sequence(num, 2), halton_sequence(num, 3)))
+    return (points + rng.uniform(size=2)) % 1.
+
+def stratified_sampler(num, strata_edges, uniforms, rng=np.random):
+    # the unit interval of the first dimension is split into strata
+    # and each stratum gets the same number of points,
+    # inside the strata both dimensions are latin hypercube sampled,
+    # the uniforms of shape (num, 2) are the positions inside the hypercube cells
+    n_strata = len(strata_edges) - 1
+    n_per_stratum = np.full(n_strata, num // n_strata)
+    n_per_stratum[:num % n_strata] += 1
+
+    points = np.empty((num, 2))
+    weights = np.empty(num)
+    start = 0
+    for idx, n_points in enumerate(n_per_stratum):
+        if n_points == 0:
+            continue
+        low, high = strata_edges[idx], strata_edges[idx + 1]
+        stop = start + n_points
+        u = (rng.permutation(n_points) + uniforms[start:stop, 0]) / n_points
+        points[start:stop, 0] = low + (high - low) * u
+        points[start:stop, 1] = (rng.permutation(n_points) + uniforms[start:stop, 1]) / n_points
+        # probability of the stratum over its fraction of the points
+        weights[start:stop] = (high - low) * num / n_points
+        start = stop
+    return points, weights
+
+def sampling_spectral_index(settings_dict):
+    # the log10 uniform sampling is a power law with index 1
+    if settings_dict["powerlaw_sampler"]:
+        return settings_dict["spectral_index"]
+    return 1.
+
+def primary_energy_bin_edges(settings_dict):
+    n_bins = settings_dict.get("n_primary_energy_bins")
+    if not n_bins:
+        return None
+    return np.logspace(np.log10(settings_dict["muon_energy_min"]),
+                       np.log10(settings_dict["muon_energy_max"]),
+                       n_bins + 1)
+
+def sampling_masses(settings_dict, bin_edges):
+    # probability of each primary energy bin in the sampled spectrum,
+    # the sampling weights of the stratified sampler keep this spectrum
+    cdf = powerlaw_cdf(bin_edges,
+                       settings_dict["muon_energy_min"],
+                       settings_dict["muon_energy_max"],
+                       sampling_spectral_index(settings_dict))
+    return np.diff(cdf)
+
+def sample_muons(settings_dict, n_muons, stream_key, first_muon_idx=0):
+    r"""
+    Sample the energies, propagation lengths and propagation seeds of muons
+
+    Parameters
+    ----------
+    settings_dict : dict
+        settings of the muon sampler
+    n_muons : int
+        number of muons, which are sampled together
+    stream_key : tuple
+        key of the random streams of the multiplier, see muon_stream_key
+    first_muon_idx : int
+        index of the first muon in the streams of the multiplier
+
+    Returns
+    -------
+    muon_energies, propagation_lengths, muon_weights, muon_seeds : np.ndarray
+    """
+    energy_min = settings_dict["muon_energy_min"]
+    energy_max = settings_dict["muon_energy_max"]
+    length_min = settings_dict["propagation_length_min"]
+    length_max = settings_dict["propagation_length_max"]
+    sampler = settings_dict.get("muon_sampler", "random")
+
+    words = muon_random_words(stream_key, first_muon_idx, n_muons, 3)
+    uniforms = (words[:, :2] >> np.uint64(11)) * 2.**-53
+    muon_seeds = (words[:, 2] % np.uint64(2**31 - 1)).astype(np.int64)
+    rng = sample_generator(stream_key, first_muon_idx)
+
+    # sample the unit square and transform it with the inverse cdf of the spectrum
+    gamma = sampling_spectral_index(settings_dict)
+    if sampler == "random":
+        points = uniforms
+        muon_weights = np.ones(n_muons)
+    elif sampler == "stratified":
+        strata_edges = powerlaw_cdf(strata_energy_edges(settings_dict), energy_min, energy_max, gamma)
+        strata_edges[0], strata_edges[-1] = 0., 1.
+        points, muon_weights = stratified_sampler(n_muons, strata_edges, uniforms, rng)
+        # the strata are mixed, otherwise the chunks and the batches of the
+        # common random numbers would each contain only a single stratum
+        order = rng.permutation(n_muons)
+        points, muon_weights = points[order], muon_weights[order]
+    elif sampler == "halton":
+        # the replicates interleave the muon indices like in SecondaryHistAccumulator.group_index,
+        # every replicate is a halton sequence with its own random shift
+        n_replicates = settings_dict["n_halton_replicates"]
+        replicates = np.arange(first_muon_idx, first_muon_idx + n_muons) % n_replicates
+        points = np.empty((n_muons, 2))
+        for replicate in range(n_replicates):
+            in_replicate = replicates == replicate
+            points[in_replicate] = halton_sampler(np.count_nonzero(in_replicate), rng)
+        muon_weights = np.ones(n_muons)
+    else:
+        raise KeyError('muon_sampler is not correct')
+
+    muon_energies = powerlaw_inverse_cdf(points[:, 0], energy_min, energy_max, gamma)
+    propagation_lengths = length_min + (length_max - length_min) * points[:, 1]
+    return muon_energies, propagation_lengths, muon_weights, muon_seeds
+
 def create_propagator(path_to_interpolation_tables="~/.local/share/PROPOSAL/tables",
                       brems_multiplier=1.0,
                       brems_param_name='BremsKelnerKokoulinPetrukhin',
@@ -32,7 +200,9 @@ def create_propagator(path_to_interpolation_tables="~/.local/share/PROPOSAL/tabl
                       lpm=True,
                       mupair_interaction=True,
                       mupair_singlemuons=False,
-                      weak_interaction=False):
+                      weak_interaction=False,
+                      readonly=False,
+                      readonly_path=None):
     particle_def=pp.particle.MuMinusDef.get()
     geometry = pp.geometry.Sphere(pp.Vector3D(), 1.e20, 0.0)
 
@@ -54,8 +224,10 @@ def create_propagator(path_to_interpolation_tables="~/.local/share/PROPOSAL/tabl
     sector_def.crosssection_defs.photo_def.parametrization = pp.parametrization.photonuclear.PhotoFactory.get().get_enum_from_str(photo_param_name)
 
     interpolation_def = pp.InterpolationDef()
-    interpolation_def.path_to_tables = path_to_interpolation_tables
-    interpolation_def.path_to_tables_readonly = path_to_interpolation_tables
+    # read only tables are never written, missing tables are build in memory
+    interpolation_def.path_to_tables = "" if readonly else path_to_interpolation_tables
+    # tables of another directory can be read additionally
+    interpolation_def.path_to_tables_readonly = readonly_path or path_to_interpolation_tables
 
     prop = pp.Propagator(particle_def,
                         [sector_def],
@@ -63,106 +235,129 @@ def create_propagator(path_to_interpolation_tables="~/.local/share/PROPOSAL/tabl
                         interpolation_def)
     return prop
 
-def classify_secondaries(secondaries, len_bins):
-    ioniz_energies = []
-    epair_energies = []
-    brems_energies = []
-    photo_energies = []
-    decay_energies = []
-    binned_energies = []
-    mupair_secondary_energies = []
-    mupair_muon_energies = []
-    weak_energies = []
-
-    if len(secondaries) == 1:
-        # only one interaction
-        do_len_binning = False
-    elif secondaries[0].id == pp.particle.Data.Particle:
-        # directly a decay
-        do_len_binning = False
-    else:
-        do_len_binning = True
-        start_point = np.array([secondaries[0].position.x,
-                                secondaries[0].position.y,
-                                secondaries[0].position.z])
-        end_point = np.array([secondaries[-1].position.x,
-                              secondaries[-1].position.y,
-                              secondaries[-1].position.z])
-        direction = end_point - start_point
-        start_len = np.linalg.norm(start_point)
-
-    all_energies = []
-    all_lengths = []
-    is_single_muon_from_mupair = False
+def create_brems_calculator(path_to_interpolation_tables="~/.local/share/PROPOSAL/tables",
+                            brems_param_name='BremsKelnerKokoulinPetrukhin',
+                            ecut=500,
+                            vcut=-1,
+                            lpm=True,
+                            readonly=False):
+    # the stochastic bremsstrahlung cross section of the propagator with multiplier 1
+    brems_def = pp.parametrization.bremsstrahlung.BremsDefinition()
+    brems_def.parametrization = pp.parametrization.bremsstrahlung.BremsFactory.get().get_enum_from_str(brems_param_name)
+    brems_def.lpm_effect = lpm
+    brems_def.multiplier = 1.0
+
+    interpolation_def = pp.InterpolationDef()
+    interpolation_def.path_to_tables = "" if readonly else path_to_interpolation_tables
+    interpolation_def.path_to_tables_readonly = path_to_interpolation_tables
+
+    return pp.parametrization.bremsstrahlung.BremsFactory.get().create_bremsstrahlung_interpol(
+        pp.particle.MuMinusDef.get(),
+        pp.medium.Ice(1.0),
+        pp.EnergyCutSettings(ecut, vcut),
+        brems_def,
+        interpolation_def)
+
+SECONDARY_ID_CODES = {
+    pp.particle.Data.Epair: sh.EPAIR,
+    pp.particle.Data.Brems: sh.BREMS,
+    pp.particle.Data.DeltaE: sh.IONIZ,
+    pp.particle.Data.NuclInt: sh.PHOTO,
+    pp.particle.Data.MuPair: sh.MUPAIR,
+    pp.particle.Data.WeakInt: sh.WEAK,
+}
+
+PARTICLE_NAME_CODES = {
+    # mupair particle output
+    pp.particle.MuMinusDef.get().name: sh.MUPAIR_MUON,
+    pp.particle.MuPlusDef.get().name: sh.MUPAIR_MUON,
+    # decay
+    pp.particle.EMinusDef.get().name: sh.DECAY,
+    pp.particle.EPlusDef.get().name: sh.DECAY,
+}
+
+def particle_type_code(particle_def):
+    name = particle_def.name
+    if name in PARTICLE_NAME_CODES:
+        return PARTICLE_NAME_CODES[name]
+    elif name[:2] == 'Nu':
+        # neutrino energies dont count
+        return sh.NEUTRINO
+    print("unknown decay particle")
+    print(pp.particle.Data.Particle, particle_def)
+    return sh.UNKNOWN_PARTICLE
+
+# the secondary ids sorted for the lookup of their codes, the last id catches the larger ones,
+# the codes are kept as index type, they are converted to int8 when the store is written
+SECONDARY_IDS = np.array(sorted(SECONDARY_ID_CODES) + [np.inf])
+SECONDARY_CODES = np.array([SECONDARY_ID_CODES[sec_id] for sec_id in sorted(SECONDARY_ID_CODES)] + [sh.UNKNOWN],
+                           dtype=np.intp)
+
+def secondaries_to_columns(secondaries):
+    # the attributes are read in a single pass, every position is only requested once,
+    # the ids of the particles are exactly represented as float
+    values = []
+    extend = values.extend
     for sec in secondaries:
-        if sec.id == pp.particle.Data.Epair:
-            epair_energies.append(sec.energy)
-        elif sec.id == pp.particle.Data.Brems:
-            brems_energies.append(sec.energy)
-        elif sec.id == pp.particle.Data.DeltaE:
-            ioniz_energies.append(sec.energy)
-        elif sec.id == pp.particle.Data.NuclInt:
-            photo_energies.append(sec.energy)
-        elif sec.id == pp.particle.Data.MuPair:
-            mupair_secondary_energies.append(sec.energy)
-        elif sec.id == pp.particle.Data.Particle:
-            # mupair particle output
-            if sec.particle_def == pp.particle.MuMinusDef.get():
-                mupair_muon_energies.append(sec.energy)
-                is_single_muon_from_mupair = True
-            elif sec.particle_def == pp.particle.MuPlusDef.get():
-                mupair_muon_energies.append(sec.energy)
-                is_single_muon_from_mupair = True
-            # decay
-            elif sec.particle_def == pp.particle.EMinusDef.get():
-                decay_energies.append(sec.energy)
-            elif sec.particle_def == pp.particle.EPlusDef.get():
-                decay_energies.append(sec.energy)
-            elif sec.particle_def.name[:2] == 'Nu':
-                # neutrino energies dont count
-                continue
-            else:
-                print("unknown decay particle")
-                print(sec.id, sec.particle_def)
-        elif sec.id == pp.particle.Data.WeakInt:
-            weak_energies.append(sec.energy)
+        pos = sec.position
+        extend((sec.id, sec.energy, pos.x, pos.y, pos.z))
+    columns = np.fromiter(values, dtype=float, count=len(values)).reshape(-1, 5)
+
+    ids = columns[:, 0]
+    indices = np.searchsorted(SECONDARY_IDS, ids)
+    type_codes = np.where(SECONDARY_IDS[indices] == ids, SECONDARY_CODES[indices], sh.UNKNOWN)
+    for idx in np.flatnonzero(type_codes == sh.UNKNOWN):
+        if ids[idx] == pp.particle.Data.Particle:
+            type_codes[idx] = particle_type_code(secondaries[idx].particle_def)
         else:
             print("unknown secondary type")
-            print(sec.id)
+            print(int(ids[idx]))
 
-        if do_len_binning:
-            if is_single_muon_from_mupair:
-                # the single muons will further be propagated
-                # therefore don't count them in the binned energy losses
-                is_single_muon_from_mupair = False
-                continue
+    return type_codes, columns[:, 1], columns[:, 2:]
 
-            posi = np.array([sec.position.x,
-                             sec.position.y,
-                             sec.position.z])
-            porp_len = start_len + distance_on_line(start_point, direction, posi)
-            all_lengths.append(porp_len)
-            all_energies.append(sec.energy)
-
-    if do_len_binning:
-        len_indices = np.digitize(all_lengths, len_bins)
-        bincount = np.bincount(len_indices, all_energies)
-        binned_energies.extend(bincount[bincount>0].tolist())
-    else:
-        # add the single cascade
-        binned_energies.append(secondaries[0].energy)
-
-    secondaries = [epair_energies,
-                   brems_energies,
-                   ioniz_energies,
-                   photo_energies,
-                   decay_energies,
-                   mupair_secondary_energies,
-                   mupair_muon_energies,
-                   weak_energies,
-                   binned_energies
-    ]
-    return secondaries
+def classify_secondaries(secondaries, len_bins, loss_store=None):
+    type_codes, energies, positions = secondaries_to_columns(secondaries)
+    if loss_store is not None:
+        loss_store.add_track(type_codes, energies, positions)
+    return sh.classify_secondary_columns(type_codes, energies, positions, len_bins)
+
+def brems_exposure(brems, energy, secondaries, final_energy, final_distance):
+    r"""
+    Number of bremsstrahlung losses and the integrated bremsstrahlung
+    interaction rate with multiplier 1 along one propagated track
+
+    The probability of the track with multiplier m is proportional to
+    m**n_brems * exp(-m * brems_integral), this is used to reweight
+    the track to another multiplier.
+    """
+    interactions = [sec for sec in secondaries if sec.id != pp.particle.Data.Particle]
+    n_brems = sum(1 for sec in interactions if sec.id == pp.particle.Data.Brems)
+
+    # the rate is integrated with the trapezoidal rule between the stochastic losses,
+    # the energy decreases continuously from after a loss to before the next one
+    distances = [0.]
+    energies_after = [energy]
+    energies_before = []
+    for sec in interactions:
+        distances.append(np.sqrt(sec.position.x**2 + sec.position.y**2 + sec.position.z**2))
+        energies_before.append(sec.parent_particle_energy)
+        energies_after.append(sec.parent_particle_energy - sec.energy)
+    distances.append(max(final_distance, distances[-1]))
+    energies_before.append(max(final_energy, pp.particle.MuMinusDef.get().mass))
+
+    rates_after = np.array([brems.calculate_dNdx(e) for e in energies_after])
+    rates_before = np.array([brems.calculate_dNdx(e) for e in energies_before])
+    brems_integral = np.sum(0.5 * (rates_after + rates_before) * np.diff(distances))
+    return n_brems, brems_integral
+
+def track_brems_exposure(prop, brems, energy, secondaries, loss_store):
+    # the propagator still holds the final state of the track
+    n_brems, brems_integral = brems_exposure(brems,
+                                             energy,
+                                             secondaries,
+                                             prop.particle.energy,
+                                             prop.particle.propagated_distance)
+    loss_store.add_brems_exposure(n_brems, brems_integral)
 
 def prop_particle(prop, energy, max_propagation_len=1e20):
     prop.particle.position = pp.Vector3D(0, 0, 0)
@@ -174,113 +369,958 @@ def prop_particle(prop, energy, max_propagation_len=1e20):
     return prop.propagate(max_propagation_len)
 
 
-def propagate_and_return_secondary_hist(prop, muon_energies, propagation_lengths, loss_bin_edges, len_bins):
-    n_sec_types = 9
-    nbins = len(loss_bin_edges)-1
-    secondary_bins = np.zeros((n_sec_types, nbins))
-    secondary_errs = np.zeros((n_sec_types, nbins))
+class MuonLimitExceeded(Exception):
+    pass
 
-    for idx in tqdm(range(len(muon_energies))):
-        secondaries = prop_particle(prop, muon_energies[idx], propagation_lengths[idx])
+class MuonWatchdog(object):
+    r"""
+    Wall time and number of secondaries of the muon being propagated
 
-        if len(secondaries) < 1:
+    A single track can not be interrupted, so the limits are checked after every
+    track of the muon and its mupair muons and MuonLimitExceeded is raised.
+    """
+    def __init__(self, max_time=None, max_secondaries=None):
+        self.max_time = max_time
+        self.max_secondaries = max_secondaries
+        self.start()
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.n_secondaries = 0
+
+    def elapsed_time(self):
+        return time.perf_counter() - self.start_time
+
+    def check(self, n_secondaries):
+        self.n_secondaries += n_secondaries
+        if self.max_secondaries is not None and self.n_secondaries > self.max_secondaries:
+            raise MuonLimitExceeded("max_secondaries")
+        if self.max_time is not None and self.elapsed_time() > self.max_time:
+            raise MuonLimitExceeded("max_time")
+
+def muon_watchdog(settings_dict):
+    max_time = settings_dict.get("muon_max_time")
+    max_secondaries = settings_dict.get("muon_max_secondaries")
+    if max_time is None and max_secondaries is None:
+        return None
+    return MuonWatchdog(max_time, max_secondaries)
+
+def mupair_seed(muon_seed, path):
+    # every mupair muon has its own random stream derived from the seed of its muon
+    # and its path in the cascade, so it is the same in every task
+    words = np.random.SeedSequence(int(muon_seed), spawn_key=tuple(path)).generate_state(1, np.uint64)
+    return int(words[0] % np.uint64(2**31 - 1))
+
+def propagate_mupair_queue(prop, queue, muon_seed, propagation_length, len_bins, loss_store=None, max_depth=None, min_energy=0., brems=None, watchdog=None, max_tracks=None):
+    r"""
+    Propagate the mupair muons of one muon from a queue
+
+    The mupair muons they produce are appended to the queue. The ones beyond
+    the depth or below the energy limit are not propagated, their energy is
+    only counted as mupair loss. After max_tracks tracks the rest of the queue
+    is returned to be propagated by other tasks, so a long cascade does not
+    block the chunk of its muon.
+
+    Parameters
+    ----------
+    queue : deque
+        (energy, depth, path) of the mupair muons, the path are the indices
+        of the mupair losses in the tracks from the muon to the mupair muon
+    muon_seed : int
+        seed of the muon, see mupair_seed
+
+    Returns
+    -------
+    child_energies : list
+        classified secondaries of every propagated track
+    unpropagated : list
+        energies of the mupair muons, which were not propagated
+    queue : deque
+        the mupair muons left for other tasks
+    """
+    child_energies = []
+    unpropagated = []
+    n_tracks = 0
+    while queue and (max_tracks is None or n_tracks < max_tracks):
+        energy, depth, path = queue.popleft()
+        if energy < min_energy or (max_depth is not None and depth > max_depth):
+            unpropagated.append(energy)
             continue
+        n_tracks += 1
+        pp.RandomGenerator.get().set_seed(mupair_seed(muon_seed, path))
+        secs2 = prop_particle(prop, energy, propagation_length)
+        if watchdog is not None:
+            watchdog.check(len(secs2))
+        if loss_store is not None and brems is not None:
+            track_brems_exposure(prop, brems, energy, secs2, loss_store)
+        if len(secs2) < 1:
+            continue
+        sec_energies2 = classify_secondaries(secs2, len_bins, loss_store)
+        child_energies.append(sec_energies2)
+        queue.extend((energy2, depth + 1, path + (kdx,)) for kdx, energy2 in enumerate(sec_energies2[sh.MUPAIR]))
+    if loss_store is not None and len(unpropagated) > 0:
+        loss_store.add_unpropagated(unpropagated)
+    return child_energies, unpropagated, queue
+
+def mupair_batches(queue, batch_size):
+    # the mupair muons left in the queue are handed over in batches of the tracks of a task
+    queue = list(queue)
+    return [queue[start:start + batch_size] for start in range(0, len(queue), batch_size)]
+
+def attribute_mupair_energies(sec_energies, child_energies, unpropagated):
+    # the losses of the mupair muons are attributed to the parent muon,
+    # they are added to their types and all together to the mupair type,
+    # the not propagated mupair muons only count in the mupair type
+    sum_2nd_mus = [np.asarray(unpropagated, dtype=float)]
+    for sec_energies2 in child_energies:
+        for kdx in range(sh.N_SEC_TYPES):
+            if kdx != sh.MUPAIR:
+                sec_energies[kdx] = np.append(sec_energies[kdx], sec_energies2[kdx])
+                sum_2nd_mus.append(sec_energies2[kdx])
+    sec_energies[sh.MUPAIR] = np.concatenate(sum_2nd_mus)
+    return sec_energies
+
+def propagate_and_fill_hist(prop, muon_energies, propagation_lengths, muon_seeds, secondary_hist, len_bins, show_progress=True, loss_store=None, muon_weights=None, mupair_max_depth=None, mupair_min_energy=0., brems=None, timer=None, watchdog=None, quarantine=None,
+                            mupair_tracks_per_task=None, spilled_mupairs=None, first_muon_id=0):
+    if muon_weights is None:
+        muon_weights = np.ones(len(muon_energies))
+    # the phases are timed per muon, the mupair phase contains the propagation
+    # and classification of the mupair muons,
+    # the mupair muons left after mupair_tracks_per_task tracks are appended
+    # to spilled_mupairs as (index of the muon, list of (energy, depth, path))
+    if timer is None:
+        timer = PhaseTimer()
+
+    for idx in tqdm(range(len(muon_energies)), disable=not show_progress):
+        start = time.perf_counter()
+        timer.n_muons += 1
+        if loss_store is not None:
+            loss_store.add_muon(muon_energies[idx], propagation_lengths[idx], muon_weights[idx])
+        if watchdog is not None:
+            watchdog.start()
+
+        n_mupairs = 0
+        sec_energies = []
+        queue = deque()
+        try:
+            # every muon has its own random stream, independent of the chunking
+            with timer.phase("propagate"):
+                pp.RandomGenerator.get().set_seed(int(muon_seeds[idx]))
+                secondaries = prop_particle(prop, muon_energies[idx], propagation_lengths[idx])
+            timer.count("secondaries", len(secondaries))
+            if watchdog is not None:
+                watchdog.check(len(secondaries))
+            if loss_store is not None and brems is not None:
+                with timer.phase("brems_exposure"):
+                    track_brems_exposure(prop, brems, muon_energies[idx], secondaries, loss_store)
+
+            if len(secondaries) > 0:
+                with timer.phase("classify"):
+                    sec_energies = classify_secondaries(secondaries, len_bins, loss_store)
+                n_mupairs = len(sec_energies[sh.MUPAIR])
+                if n_mupairs > 0:
+                    timer.count("mupairs", n_mupairs)
+                    with timer.phase("mupair"):
+                        queue.extend((energy, 1, (kdx,)) for kdx, energy in enumerate(sec_energies[sh.MUPAIR]))
+                        child_energies, unpropagated, queue = propagate_mupair_queue(prop,
+                                                                                     queue,
+                                                                                     muon_seeds[idx],
+                                                                                     propagation_lengths[idx],
+                                                                                     len_bins,
+                                                                                     loss_store,
+                                                                                     mupair_max_depth,
+                                                                                     mupair_min_energy,
+                                                                                     brems,
+                                                                                     watchdog,
+                                                                                     mupair_tracks_per_task)
+                        sec_energies = attribute_mupair_energies(sec_energies, child_energies, unpropagated)
+        except MuonLimitExceeded as error:
+            # the muon is left out of the histograms, the store and the number of muons
+            if loss_store is not None:
+                loss_store.remove_muon()
+            timer.count("quarantined")
+            if quarantine is not None:
+                quarantine.append({"energy": float(muon_energies[idx]),
+                                   "length": float(propagation_lengths[idx]),
+                                   "weight": float(muon_weights[idx]),
+                                   "seed": int(muon_seeds[idx]),
+                                   "limit": str(error),
+                                   "n_secondaries": watchdog.n_secondaries,
+                                   "time": watchdog.elapsed_time()})
+            continue
+
+        # norm to 100 m propagated distance
+        weight = muon_weights[idx] * 1e4 / propagation_lengths[idx]
+        with timer.phase("fill"):
+            # the losses of the spilled mupair muons are added by their tasks
+            secondary_hist.fill(sec_energies, weight, muon_energies[idx], muon_id=first_muon_id + idx,
+                                complete=not queue)
+        if spilled_mupairs is not None:
+            if queue:
+                spilled_mupairs.append((idx, list(queue)))
+
+        # the seed, energy and length are enough to propagate the muon again
+        timer.latency.record(time.perf_counter() - start,
+                             energy=float(muon_energies[idx]),
+                             length=float(propagation_lengths[idx]),
+                             seed=int(muon_seeds[idx]),
+                             n_secondaries=len(secondaries),
+                             n_mupairs=n_mupairs)
+
+    return secondary_hist
+
 
-        sec_energies = classify_secondaries(secondaries, len_bins)
-
-        # midx = 0
-        sum_2nd_mus = []
-        while(len(sec_energies[5]) > 0):
-            # midx += 1
-            # print('muon iter: {}'.format(midx))
-            for jdx in sec_energies[5]:
-                secs2 = prop_particle(prop, jdx, propagation_lengths[idx])
-                if len(secs2) < 1:
-                    continue
-                sec_energies2 = classify_secondaries(secs2, len_bins)
-                for kdx in range(len(sec_energies2)):
-                    if kdx != 5:
-                        sec_energies[kdx].extend(sec_energies2[kdx])
-                        sum_2nd_mus.extend(sec_energies2[kdx])
-                    else:
-                        sec_energies[kdx] = sec_energies2[kdx]
-            if len(sec_energies[5]) > 0:
-                print('nmuons left: {}'.format(sec_energies[5]))
-        # del sec_energies[5]
-        sec_energies[5] = sum_2nd_mus
-
-
-        for jdx in range(n_sec_types):
-            # norm to 100 m propagated distance
-            weights = 1e4 / propagation_lengths[idx] * np.ones(len(sec_energies[jdx]))
-            secondary_bins_tmp = np.histogram(sec_energies[jdx],
-                                                bins=loss_bin_edges,
-                                                weights=weights,
-                                                density=False)[0]
-            sec_err_tmp = np.histogram(sec_energies[jdx],
-                                                bins=loss_bin_edges,
-                                                weights=weights**2,
-                                                density=False)[0]
-            secondary_bins[jdx] += secondary_bins_tmp
-            secondary_errs[jdx] += sec_err_tmp
-    
-    secondary_errs = np.sqrt(secondary_errs)
+def propagate_and_return_secondary_hist(prop, muon_energies, propagation_lengths, muon_seeds, loss_bin_edges, len_bins, show_progress=True, muon_weights=None, timer=None):
+    secondary_hist = propagate_and_fill_hist(prop,
+                                             muon_energies,
+                                             propagation_lengths,
+                                             muon_seeds,
+                                             sh.SecondaryHistAccumulator(loss_bin_edges),
+                                             len_bins,
+                                             show_progress,
+                                             muon_weights=muon_weights,
+                                             timer=timer)
 
     # returns histogramed secondaries per muon per 100 meter
-    return secondary_bins / float(len(muon_energies)), secondary_errs / float(len(muon_energies))
+    return secondary_hist.finalize()
 
 
-def create_secondaries_hist(settings_dict, overwrite, style):
-    if not os.path.isdir(settings_dict["step01_path_{}".format(style)]):
-        os.mkdir(settings_dict["step01_path_{}".format(style)])
-    if not os.path.isdir(settings_dict["step01_path_{}_data".format(style)]):
-        os.mkdir(settings_dict["step01_path_{}_data".format(style)])
+# the propagator of the last multiplier is kept per process,
+# because building it is expensive and a worker gets many chunks of one multiplier
+_propagator_cache = {}
+
+def get_propagator(settings_dict, style, brems_multiplier):
+    key = (style, brems_multiplier)
+    if key not in _propagator_cache:
+        _propagator_cache.clear()
+        path = settings_dict["path_interpolation_tables_{}".format(style)]
+        readonly = settings_dict.get("interpolation_tables_readonly", False)
+        cache_path = settings_dict.get("path_interpolation_tables_{}_cache".format(style))
+        if not path and cache_path:
+            # the tables of the not stored multipliers are kept in a scratch cache,
+            # the permanent tables are only read
+            cache = it.TableCache(cache_path, settings_dict["table_cache_max_size"])
+            _propagator_cache[key] = cache.use("{}_{!r}".format(style, brems_multiplier),
+                                               partial(create_propagator,
+                                                       cache_path,
+                                                       brems_multiplier,
+                                                       readonly_path=settings_dict["path_interpolation_tables_buildup"]))
+        else:
+            # the workers would build the same tables at the same time without the lock,
+            # the tables marked as built by the warm-up are read with a shared lock
+            with it.tables_lock(it.propagator_job("" if readonly else path, brems_multiplier)):
+                _propagator_cache[key] = create_propagator(path, brems_multiplier, readonly=readonly)
+    return _propagator_cache[key]
+
+_brems_cache = {}
+
+def get_brems_calculator(settings_dict, style):
+    if style not in _brems_cache:
+        path = settings_dict["path_interpolation_tables_{}".format(style)]
+        readonly = settings_dict.get("interpolation_tables_readonly", False)
+        with it.tables_lock(it.brems_job("" if readonly else path)):
+            _brems_cache[style] = create_brems_calculator(path, readonly=readonly)
+    return _brems_cache[style]
+
+def quarantine_chunk_file(settings_dict, style, brems_multiplier, chunk_idx):
+    return os.path.join(settings_dict["step01_path_{}_quarantine".format(style)],
+                        "chunk_{!r}_{:06d}.jsonl".format(brems_multiplier, chunk_idx))
+
+def write_quarantine(path, quarantine):
+    # every chunk writes its file, also without quarantined muons,
+    # so no file of an earlier run is collected
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        for muon in quarantine:
+            file.write(json.dumps(muon) + "\n")
+
+def collect_quarantine(settings_dict, style, brems_multiplier, n_chunks):
+    # concatenate the quarantined muons of the chunks in chunk order, returns their number
+    quarantine = []
+    for chunk_idx in range(n_chunks):
+        path = quarantine_chunk_file(settings_dict, style, brems_multiplier, chunk_idx)
+        if os.path.isfile(path):
+            with open(path) as file:
+                quarantine += [dict(json.loads(line), chunk_idx=chunk_idx) for line in file]
+            os.remove(path)
+    path = settings_dict["step01_file_{}_quarantine".format(style)].format(brems_multiplier)
+    if len(quarantine) > 0:
+        write_quarantine(path, quarantine)
+    elif os.path.isfile(path):
+        os.remove(path)
+    return len(quarantine)
+
+def propagate_chunk(settings_dict, task):
+    style = task["style"]
+    brems_multiplier = task["brems_multiplier"]
+    store_path = task["store_path"]
+
+    len_bins = np.arange(start=0,
+                        stop=settings_dict["propagation_length_max"],
+                        step=settings_dict["bin_len_step"])
+    loss_bin_edges = np.array(settings_dict["energy_loss_bin_edges"])
+
+    timer = PhaseTimer(settings_dict["n_slowest_muons"])
+    quarantine = []
+    # the stored muons get their bremsstrahlung exposure to reweight them to other multipliers
+    if store_path is not None:
+        with timer.phase("propagator"):
+            brems = get_brems_calculator(settings_dict, style)
+    else:
+        brems = None
+    # the losses are also kept in memory to fill the additional binnings
+    binnings = additional_binnings(settings_dict)
+    if store_path is not None or len(binnings) > 0:
+        loss_store = ls.LossStoreWriter(task["first_muon_id"])
+    else:
+        loss_store = None
+
+    # the propagator is only built for the first chunk of a multiplier in a process
+    with timer.phase("propagator"):
+        prop = get_propagator(settings_dict, style, brems_multiplier)
+    spilled_mupairs = []
+    secondary_hist = propagate_and_fill_hist(prop,
+                                             task["muon_energies"],
+                                             task["propagation_lengths"],
+                                             task["muon_seeds"],
+                                             sh.SecondaryHistAccumulator(loss_bin_edges,
+                                                                         primary_bin_edges=primary_energy_bin_edges(settings_dict),
+                                                                         error_groups=error_groups(settings_dict)),
+                                             len_bins,
+                                             show_progress=False,
+                                             loss_store=loss_store,
+                                             muon_weights=task["muon_weights"],
+                                             mupair_max_depth=settings_dict.get("mupair_max_depth"),
+                                             mupair_min_energy=settings_dict.get("mupair_min_energy", 0.),
+                                             brems=brems,
+                                             timer=timer,
+                                             watchdog=muon_watchdog(settings_dict),
+                                             quarantine=quarantine,
+                                             mupair_tracks_per_task=settings_dict.get("mupair_tracks_per_task"),
+                                             spilled_mupairs=spilled_mupairs,
+                                             first_muon_id=task["first_muon_id"])
+    write_quarantine(quarantine_chunk_file(settings_dict, style, brems_multiplier, task["chunk_idx"]), quarantine)
+    if store_path is not None:
+        with timer.phase("store"):
+            # the mupair parts of an interrupted run are written again by the mupair tasks
+            ls.remove_mupair_parts(store_path, task["chunk_idx"])
+            loss_store.write(ls.chunk_path(store_path, task["chunk_idx"]))
+
+    binning_hists = {}
+    if len(binnings) > 0:
+        with timer.phase("binnings"):
+            store = loss_store.to_arrays()
+            for bin_len_step, n_energy_loss_bins in binnings:
+                binning_dict = binning_settings(settings_dict, style, bin_len_step, n_energy_loss_bins)
+                binning_len_bins = np.arange(start=0,
+                                             stop=settings_dict["propagation_length_max"],
+                                             step=bin_len_step)
+                binning_hists[binning_key(bin_len_step, n_energy_loss_bins)] = \
+                    ls.histogram_store(store, binning_dict["energy_loss_bin_edges"], binning_len_bins,
+                                       error_groups=error_groups(settings_dict),
+                                       open_muon_ids=[task["first_muon_id"] + idx for idx, _ in spilled_mupairs])
+
+    # the rest of the long mupair cascades is propagated by further tasks
+    mupair_tasks = [{"kind": "mupair",
+                     "style": style,
+                     "brems_multiplier": brems_multiplier,
+                     "chunk_idx": task["chunk_idx"],
+                     "store_path": store_path,
+                     "muon_id": task["first_muon_id"] + idx,
+                     "muon_energy": float(task["muon_energies"][idx]),
+                     "propagation_length": float(task["propagation_lengths"][idx]),
+                     "muon_weight": float(task["muon_weights"][idx]),
+                     "muon_seed": int(task["muon_seeds"][idx]),
+                     "mupairs": batch}
+                    for idx, mupairs in spilled_mupairs
+                    for batch in mupair_batches(mupairs, settings_dict["mupair_tracks_per_task"])]
+    timer.count("mupair_tasks", len(mupair_tasks))
+    return brems_multiplier, task["chunk_idx"], None, secondary_hist, binning_hists, timer, mupair_tasks
+
+def propagate_mupair_task(settings_dict, task):
+    r"""
+    Propagate a batch of mupair muons handed over by the task of their chunk
+
+    The losses are filled without counting the muon again and are added to the
+    chunk as part with the key (muon id, path of the first mupair muon).
+    The mupair muons left after mupair_tracks_per_task tracks are handed over again.
+    The limits of the watchdog only apply to the tracks in the task of the muon.
+    """
+    style = task["style"]
+    brems_multiplier = task["brems_multiplier"]
+    store_path = task["store_path"]
+    queue = deque((energy, depth, tuple(path)) for energy, depth, path in task["mupairs"])
+    part_key = (task["muon_id"], queue[0][2])
 
     len_bins = np.arange(start=0,
                         stop=settings_dict["propagation_length_max"],
                         step=settings_dict["bin_len_step"])
+    loss_bin_edges = np.array(settings_dict["energy_loss_bin_edges"])
+
+    timer = PhaseTimer(settings_dict["n_slowest_muons"])
+    if store_path is not None:
+        with timer.phase("propagator"):
+            brems = get_brems_calculator(settings_dict, style)
+    else:
+        brems = None
+    binnings = additional_binnings(settings_dict)
+    if store_path is not None or len(binnings) > 0:
+        # the part holds the muon to add its exposure, its tracks are numbered from 1
+        # and get the following numbers of the muon when the parts are merged
+        loss_store = ls.LossStoreWriter(task["muon_id"])
+        loss_store.add_muon(task["muon_energy"], task["propagation_length"], task["muon_weight"])
+        loss_store.track_id = 1
+    else:
+        loss_store = None
+
+    with timer.phase("propagator"):
+        prop = get_propagator(settings_dict, style, brems_multiplier)
+    with timer.phase("mupair"):
+        child_energies, unpropagated, queue = propagate_mupair_queue(prop,
+                                                                     queue,
+                                                                     task["muon_seed"],
+                                                                     task["propagation_length"],
+                                                                     len_bins,
+                                                                     loss_store,
+                                                                     settings_dict.get("mupair_max_depth"),
+                                                                     settings_dict.get("mupair_min_energy", 0.),
+                                                                     brems,
+                                                                     max_tracks=settings_dict.get("mupair_tracks_per_task"))
+    sec_energies = attribute_mupair_energies([np.empty(0) for _ in range(sh.N_SEC_TYPES)], child_energies, unpropagated)
+    secondary_hist = sh.SecondaryHistAccumulator(loss_bin_edges,
+                                                 primary_bin_edges=primary_energy_bin_edges(settings_dict),
+                                                 error_groups=error_groups(settings_dict))
+    with timer.phase("fill"):
+        secondary_hist.fill(sec_energies,
+                            task["muon_weight"] * 1e4 / task["propagation_length"],
+                            task["muon_energy"],
+                            count_muon=False,
+                            muon_id=task["muon_id"],
+                            complete=False)
+    if store_path is not None:
+        with timer.phase("store"):
+            loss_store.write_part(ls.mupair_part_file(store_path, task["chunk_idx"], part_key))
+
+    binning_hists = {}
+    if len(binnings) > 0:
+        with timer.phase("binnings"):
+            store = loss_store.to_arrays()
+            for bin_len_step, n_energy_loss_bins in binnings:
+                binning_dict = binning_settings(settings_dict, style, bin_len_step, n_energy_loss_bins)
+                binning_len_bins = np.arange(start=0,
+                                             stop=settings_dict["propagation_length_max"],
+                                             step=bin_len_step)
+                binning_hists[binning_key(bin_len_step, n_energy_loss_bins)] = \
+                    ls.histogram_store(store, binning_dict["energy_loss_bin_edges"], binning_len_bins,
+                                       error_groups=error_groups(settings_dict), count_muons=False)
+
+    mupair_tasks = [dict(task, mupairs=batch) for batch in mupair_batches(queue, settings_dict["mupair_tracks_per_task"])]
+    timer.count("mupair_tasks", len(mupair_tasks))
+    return brems_multiplier, task["chunk_idx"], part_key, secondary_hist, binning_hists, timer, mupair_tasks
+
+def propagate_task(settings_dict, task):
+    # the tasks of the pool are chunks of muons and the mupair muons handed over by them
+    if task.get("kind") == "mupair":
+        return propagate_mupair_task(settings_dict, task)
+    return propagate_chunk(settings_dict, task)
+
+def merge_chunk_parts(brems_multiplier, chunk_idx, parts):
+    # the parts of the mupair tasks are added in the order of their keys after the chunk
+    parts = sorted(parts, key=lambda part: (-1, ()) if part[0] is None else part[0])
+    _, secondary_hist, binning_hists, timer = parts[0]
+    for _, part_hist, part_binning_hists, part_timer in parts[1:]:
+        secondary_hist.merge(part_hist)
+        for key, binning_hist in part_binning_hists.items():
+            binning_hists[key].merge(binning_hist)
+        timer.merge(part_timer)
+    return brems_multiplier, chunk_idx, secondary_hist, binning_hists, timer
+
+def imap_chunks(imap, worker_func, tasks):
+    r"""
+    Propagate the chunk tasks and the mupair tasks they hand over with imap
+
+    The mupair tasks are fed to the same imap while it runs, so they are
+    shared by all processes. A chunk is yielded as (brems_multiplier, chunk_idx,
+    secondary_hist, binning_hists, timer) when all its mupair tasks are done,
+    its sums do not depend on the order the tasks are finished in.
+    """
+    if len(tasks) == 0:
+        return
+    mupair_queue = Queue()
+
+    def task_stream():
+        for task in tasks:
+            yield task
+        # the stream ends with the last open task
+        for task in iter(mupair_queue.get, None):
+            yield task
+
+    parts = {(task["brems_multiplier"], task["chunk_idx"]): [] for task in tasks}
+    n_open = dict.fromkeys(parts, 1)
+    n_open_tasks = len(tasks)
+    for brems_multiplier, chunk_idx, part_key, secondary_hist, binning_hists, timer, mupair_tasks \
+            in imap(worker_func, task_stream()):
+        key = (brems_multiplier, chunk_idx)
+        parts[key].append((part_key, secondary_hist, binning_hists, timer))
+        n_open[key] += len(mupair_tasks) - 1
+        n_open_tasks += len(mupair_tasks) - 1
+        for mupair_task in mupair_tasks:
+            mupair_queue.put(mupair_task)
+        if n_open_tasks == 0:
+            mupair_queue.put(None)
+        if n_open[key] == 0:
+            del n_open[key]
+            yield merge_chunk_parts(brems_multiplier, chunk_idx, parts.pop(key))
+
+
+def create_chunk_tasks(style, brems_multiplier, muon_energies, propagation_lengths, muon_weights, muon_seeds,
+                       chunk_size, first_chunk_idx=0, first_muon_id=0, store_path=None):
+    tasks = []
+    for idx, start in enumerate(range(0, len(muon_energies), chunk_size)):
+        chunk = slice(start, start + chunk_size)
+        tasks.append({"style": style,
+                      "brems_multiplier": brems_multiplier,
+                      "chunk_idx": first_chunk_idx + idx,
+                      "first_muon_id": first_muon_id + start,
+                      "muon_energies": muon_energies[chunk],
+                      "propagation_lengths": propagation_lengths[chunk],
+                      "muon_weights": muon_weights[chunk],
+                      "muon_seeds": muon_seeds[chunk],
+                      "store_path": store_path})
+    return tasks
+
+def multiplier_tasks(settings_dict, style, brems_multiplier, store_path=None):
+    # the samples of all muons of a multiplier
+    n_muons = settings_dict["n_muons"]
+    muon_energies, propagation_lengths, muon_weights, muon_seeds = sample_muons(settings_dict,
+                                                                                n_muons,
+                                                                                muon_stream_key(settings_dict, brems_multiplier))
+    return create_chunk_tasks(style, brems_multiplier, muon_energies, propagation_lengths, muon_weights,
+                              muon_seeds, settings_dict.get("n_muons_per_chunk", n_muons), store_path=store_path)
+
+def merge_chunks(chunks, loss_bin_edges):
+    # the chunks are merged in a fixed order, so the result is the same
+    # for any number of workers or shards, it is bit-identical to the serial run
+    # with the same n_muons_per_chunk, another chunk size only sums in another order
+    secondary_hist = sh.SecondaryHistAccumulator(loss_bin_edges)
+    for idx in sorted(chunks):
+        secondary_hist.merge(chunks[idx])
+    return secondary_hist
+
+def merge_binning_chunks(binning_chunks):
+    # the chunks of every additional binning, keyed by the binning
+    binning_hists = {}
+    for idx in sorted(binning_chunks):
+        for key, secondary_hist in binning_chunks[idx].items():
+            if key not in binning_hists:
+                binning_hists[key] = sh.SecondaryHistAccumulator(secondary_hist.loss_bin_edges)
+            binning_hists[key].merge(secondary_hist)
+    return binning_hists
+
+def write_binnings(settings_dict, style, brems_multiplier, binning_hists):
+    for bin_len_step, n_energy_loss_bins in additional_binnings(settings_dict):
+        key = binning_key(bin_len_step, n_energy_loss_bins)
+        if key not in binning_hists:
+            continue
+        binning_dict = binning_settings(settings_dict, style, bin_len_step, n_energy_loss_bins)
+        sec_bins, sec_errs = binning_hists[key].finalize()
+        rc.write_multiplier(binning_dict, style, brems_multiplier, sec_bins, sec_errs,
+                            {"n_muons": binning_hists[key].n_muons})
+
+def create_binning_cubes(settings_dict, style, overwrite=False):
+    binnings = additional_binnings(settings_dict)
+    if len(binnings) > 0 and not os.path.isdir(settings_dict["step01_path_{}_binnings".format(style)]):
+        os.mkdir(settings_dict["step01_path_{}_binnings".format(style)])
+    for bin_len_step, n_energy_loss_bins in binnings:
+        binning_dict = binning_settings(settings_dict, style, bin_len_step, n_energy_loss_bins)
+        rc.create_cube(binning_dict, style, sh.N_SEC_TYPES, overwrite)
+        # the settings of the binning to plot and fit its cube
+        with open(os.path.splitext(binning_dict["step01_file_{}_cube".format(style)])[0] + "_settings.json", "w") as file:
+            json.dump(binning_dict, fp=file, indent=2, separators=(",", ":"))
+
+def write_batches(settings_dict, style, brems_multiplier, chunks, n_batches):
+    # batches of the same chunks contain the same muons for every multiplier
+    loss_bin_edges = np.array(settings_dict["energy_loss_bin_edges"])
+    batches = [sh.SecondaryHistAccumulator(loss_bin_edges) for _ in range(n_batches)]
+    for idx in sorted(chunks):
+        batches[idx % n_batches].merge(chunks[idx])
+    batch_bins = np.array([batch.finalize()[0] for batch in batches])
+    rc.write_batches(settings_dict, style, brems_multiplier, batch_bins)
+
+def adaptive_type_indices(settings_dict):
+    return [settings_dict["secondary_types"].index(sec_type)
+            for sec_type in settings_dict.get("adaptive_secondary_types", ["Binned Track"])]
+
+def replay_command(settings_file, style, brems_multiplier, store_losses, muon):
+    return "python replay_muon.py -c {} -s {} -m {!r} -e {!r} -l {!r} --seed {}{}".format(
+        settings_file, style, brems_multiplier, muon["energy"], muon["length"], muon["seed"], " --store" if store_losses else "")
+
+def finish_multiplier(settings_dict, style, brems_multiplier, secondary_hist, n_chunks, store_path, info=None, binning_hists=None, timer=None,
+                      settings_file="build/settings.json"):
+    if info is None:
+        info = {}
+    info["n_muons"] = secondary_hist.n_muons
+    info["n_quarantined"] = collect_quarantine(settings_dict, style, brems_multiplier, n_chunks)
+    if info["n_quarantined"] > 0:
+        print("brems_multiplier {}: {} muons exceeded the limits, they are written to the quarantine".format(
+            brems_multiplier, info["n_quarantined"]))
+    info["max_rel_error"] = secondary_hist.max_rel_error(adaptive_type_indices(settings_dict),
+                                                         settings_dict.get("adaptive_min_entries", 1.))
+
+    sec_bins, sec_errs = secondary_hist.finalize()
+    rc.write_multiplier(settings_dict, style, brems_multiplier, sec_bins, sec_errs, info)
+    if secondary_hist.primary_bin_edges is not None:
+        primary_bins, primary_errs = secondary_hist.finalize_primary()
+        rc.write_multiplier(settings_dict, style, brems_multiplier, primary_bins, primary_errs,
+                            {"primary_n_muons": secondary_hist.primary_n_muons.tolist()},
+                            rc.PRIMARY_CUBE)
+    if binning_hists is not None:
+        write_binnings(settings_dict, style, brems_multiplier, binning_hists)
+    if store_path is not None:
+        consolidate_chunks(settings_dict, style, brems_multiplier, store_path, n_chunks)
+    if timer is not None:
+        # the timed muons are only the ones propagated in this run, not the ones of a checkpoint
+        timer.write(settings_dict["step01_file_{}_timing".format(style)].format(brems_multiplier),
+                    replay=partial(replay_command, settings_file, style, brems_multiplier, store_path is not None),
+                    brems_multiplier=brems_multiplier)
+    cp.remove_checkpoint(settings_dict, style, brems_multiplier)
+    print("brems_multiplier {} done".format(brems_multiplier))
+
+def finish_chunks(settings_dict, style, brems_multiplier, chunks, binning_chunks, store_path=None, n_batches=None, timer=None,
+                  settings_file="build/settings.json"):
+    if n_batches is not None:
+        write_batches(settings_dict, style, brems_multiplier, chunks, n_batches)
+    secondary_hist = merge_chunks(chunks, np.array(settings_dict["energy_loss_bin_edges"]))
+    finish_multiplier(settings_dict, style, brems_multiplier, secondary_hist, len(chunks), store_path,
+                      binning_hists=merge_binning_chunks(binning_chunks), timer=timer, settings_file=settings_file)
+
+def save_checkpoint(settings_dict, style, brems_multiplier, store_path, chunks, binning_chunks, **info):
+    info["settings_hash"] = cp.checkpoint_hash(settings_dict, style, brems_multiplier, store_path)
+    info["style"] = style
+    info["brems_multiplier"] = brems_multiplier
+    info["n_muons"] = sum(secondary_hist.n_muons for secondary_hist in chunks.values())
+    info["n_chunks"] = len(chunks)
+    info["time"] = time.time()
+    cp.write_checkpoint(cp.checkpoint_file(settings_dict, style, brems_multiplier),
+                        chunks, binning_chunks, info)
+
+def consolidate_chunks(settings_dict, style, brems_multiplier, store_path, n_chunks):
+    ls.consolidate_store(store_path,
+                         n_chunks,
+                         {"style": style,
+                          "brems_multiplier": brems_multiplier,
+                          "settings": {key: settings_dict.get(key) for key in ls.STORE_KEYS}})
+
+def propagate_multiplier(settings_dict, style, brems_multiplier, workers=1, store_path=None):
+    # propagate the muons of a single multiplier and return the merged histograms
+    loss_bin_edges = np.array(settings_dict["energy_loss_bin_edges"])
+    tasks = multiplier_tasks(settings_dict, style, brems_multiplier, store_path)
+
+    worker_func = partial(propagate_task, settings_dict)
+    if workers > 1 and len(tasks) > 1:
+        pool = Pool(min(workers, len(tasks)))
+        results = list(tqdm(imap_chunks(pool.imap_unordered, worker_func, tasks), total=len(tasks)))
+        pool.close()
+        pool.join()
+    else:
+        results = list(tqdm(imap_chunks(map, worker_func, tasks), total=len(tasks)))
+
+    if store_path is not None:
+        consolidate_chunks(settings_dict, style, brems_multiplier, store_path, len(tasks))
+    return merge_chunks({chunk_idx: secondary_hist for _, chunk_idx, secondary_hist, _, _ in results}, loss_bin_edges)
+
+def discard_chunk(settings_dict, style, brems_multiplier, store_path, chunk_idx):
+    # a chunk propagated ahead of the stop leaves no files behind
+    path = quarantine_chunk_file(settings_dict, style, brems_multiplier, chunk_idx)
+    if os.path.isfile(path):
+        os.remove(path)
+    if store_path is not None and os.path.isdir(ls.chunk_path(store_path, chunk_idx)):
+        shutil.rmtree(ls.chunk_path(store_path, chunk_idx))
+    if store_path is not None:
+        ls.remove_mupair_parts(store_path, chunk_idx)
 
-    # init energy binning
-    nbins = settings_dict["n_energy_loss_bins"]
+def propagate_adaptive(settings_dict, style, brems_multiplier, worker_func, imap, n_parallel, store_path,
+                       settings_file="build/settings.json"):
+    # propagate rounds of chunks until the relative error of every filled bin
+    # of the chosen secondary types is below the target or the budget is used up,
+    # the rounds have a fixed size and the pool propagates as many of them as it holds at once,
+    # they are checked one after the other and the ones after the stop are discarded,
+    # so the result does not depend on the number of processes
     loss_bin_edges = np.array(settings_dict["energy_loss_bin_edges"])
+    chunk_size = settings_dict.get("n_muons_per_chunk", settings_dict["n_muons"])
+    chunks_per_round = settings_dict.get("adaptive_chunks_per_round", 1)
+    n_rounds_ahead = max(1, -(-n_parallel // chunks_per_round))
+    target_rel_error = settings_dict["adaptive_target_rel_error"]
+    max_muons = settings_dict.get("adaptive_max_muons", settings_dict["n_muons"])
+    max_time = settings_dict.get("adaptive_max_time")
+    type_indices = adaptive_type_indices(settings_dict)
+    min_entries = settings_dict.get("adaptive_min_entries", 1.)
+    checkpoint_interval = settings_dict.get("checkpoint_interval")
 
-    # interaction labels
-    n_sec_types = len(settings_dict["secondary_types"])
+    chunks = {}
+    binning_chunks = {}
+    timer = PhaseTimer(settings_dict["n_slowest_muons"])
+    n_muons = 0
+    elapsed_time = 0.
+    stream_key = muon_stream_key(settings_dict, brems_multiplier)
+    checkpoint = cp.resume_checkpoint(settings_dict, style, brems_multiplier, store_path)
+    if checkpoint is not None:
+        chunks, binning_chunks, checkpoint_info = checkpoint
+        # the quarantined muons are not in the histograms, the sampling goes on after all sampled muons
+        n_muons = checkpoint_info["n_sampled"]
+        elapsed_time = checkpoint_info["elapsed_time"]
+    # the accepted chunks are merged in chunk order like in merge_chunks
+    secondary_hist = merge_chunks(chunks, loss_bin_edges)
+    start_time = time.time() - elapsed_time
+    last_checkpoint = time.time()
+    stop_reason = None
+    while stop_reason is None:
+        # each round is sampled on its own, so the stratified samples stay balanced
+        rounds = []
+        tasks = []
+        first_muon_idx = n_muons
+        first_chunk_idx = len(chunks)
+        for _ in range(n_rounds_ahead):
+            n_round = min(chunks_per_round * chunk_size, max_muons - first_muon_idx)
+            if n_round <= 0:
+                break
+            muon_energies, propagation_lengths, muon_weights, muon_seeds = sample_muons(settings_dict,
+                                                                                        n_round,
+                                                                                        stream_key,
+                                                                                        first_muon_idx)
+            round_tasks = create_chunk_tasks(style, brems_multiplier, muon_energies, propagation_lengths, muon_weights,
+                                             muon_seeds, chunk_size, first_chunk_idx, first_muon_idx, store_path)
+            rounds.append((n_round, [task["chunk_idx"] for task in round_tasks]))
+            tasks.extend(round_tasks)
+            first_muon_idx += n_round
+            first_chunk_idx += len(round_tasks)
 
+        results = {}
+        for _, chunk_idx, chunk_hist, binning_hists, chunk_timer in imap_chunks(imap, worker_func, tasks):
+            results[chunk_idx] = (chunk_hist, binning_hists, chunk_timer)
 
+        for n_round, chunk_indices in rounds:
+            if stop_reason is not None:
+                for chunk_idx in chunk_indices:
+                    discard_chunk(settings_dict, style, brems_multiplier, store_path, chunk_idx)
+                continue
+            for chunk_idx in chunk_indices:
+                chunks[chunk_idx], binning_chunks[chunk_idx], chunk_timer = results[chunk_idx]
+                secondary_hist.merge(chunks[chunk_idx])
+                timer.merge(chunk_timer)
+            n_muons += n_round
+
+            rel_error = secondary_hist.max_rel_error(type_indices, min_entries)
+            print("brems_multiplier {}: {} muons, max rel. error {:.4}".format(brems_multiplier, n_muons, rel_error))
+            if rel_error <= target_rel_error:
+                stop_reason = "target"
+            elif n_muons >= max_muons:
+                stop_reason = "max_muons"
+            elif max_time is not None and time.time() - start_time >= max_time:
+                stop_reason = "max_time"
+
+        if stop_reason is None and checkpoint_interval is not None \
+           and time.time() - last_checkpoint >= checkpoint_interval:
+            save_checkpoint(settings_dict, style, brems_multiplier, store_path, chunks, binning_chunks,
+                            n_sampled=n_muons, elapsed_time=time.time() - start_time)
+            last_checkpoint = time.time()
+
+    info = {"target_rel_error": target_rel_error, "stop_reason": stop_reason}
+    finish_multiplier(settings_dict, style, brems_multiplier, secondary_hist, len(chunks), store_path, info,
+                      merge_binning_chunks(binning_chunks), timer, settings_file)
+
+def number_of_chunks(settings_dict):
+    n_muons = settings_dict["n_muons"]
+    return len(range(0, n_muons, settings_dict.get("n_muons_per_chunk", n_muons)))
+
+def create_outputs(settings_dict, style, overwrite=False):
+    if not os.path.isdir(settings_dict["step01_path_{}".format(style)]):
+        os.mkdir(settings_dict["step01_path_{}".format(style)])
+    if not os.path.isdir(settings_dict["step01_path_{}_data".format(style)]):
+        os.mkdir(settings_dict["step01_path_{}_data".format(style)])
+    cube_metadata = rc.create_cube(settings_dict, style, sh.N_SEC_TYPES, overwrite)
+    create_binning_cubes(settings_dict, style, overwrite)
+    # the histograms split by primary energy to reweight them to another spectrum
+    primary_bin_edges = primary_energy_bin_edges(settings_dict)
+    if primary_bin_edges is not None:
+        rc.create_primary_cube(settings_dict, style, sh.N_SEC_TYPES, primary_bin_edges,
+                               sampling_masses(settings_dict, primary_bin_edges), overwrite)
+    return cube_metadata
+
+def create_secondaries_hist(settings_dict, overwrite, style, workers=1, store_losses=False, write_text=False,
+                            settings_file="build/settings.json"):
+    cube_metadata = create_outputs(settings_dict, style, overwrite)
+
+    n_chunks = number_of_chunks(settings_dict)
+    adaptive = settings_dict.get("adaptive_target_rel_error") is not None
+
+    worker_func = partial(propagate_task, settings_dict)
+    if workers > 1:
+        pool = Pool(workers)
+        imap = pool.imap_unordered
+    else:
+        pool = None
+        imap = map
+
+    # with common random numbers every multiplier gets the same muons
+    # and the same random stream for each muon, see muon_stream_key
+    if settings_dict.get("common_random_numbers", False):
+        n_batches = min(settings_dict.get("n_common_random_batches", 10), n_chunks)
+        if not adaptive:
+            rc.create_cube(settings_dict, style, sh.N_SEC_TYPES, overwrite, n_batches)
+    else:
+        n_batches = None
+
+    tasks = []
+    store_paths = {}
+    chunk_hists = {}
+    binning_chunk_hists = {}
     for brems_multiplier in settings_dict["brems_multiplier_{}_arr".format(style)]:
-        print("brems_multiplier ", brems_multiplier)
-
-        # init muon propagation properties
-        if settings_dict["powerlaw_sampler"]:
-            muon_energies = random_powerlaw_sampler(settings_dict["muon_energy_min"],
-                                                    settings_dict["muon_energy_max"],
-                                                    settings_dict["n_muons"],
-                                                    settings_dict["spectral_index"])
+        if store_losses:
+            store_path = ls.store_path(settings_dict, style, brems_multiplier)
         else:
-            muon_energies = random_logspace_sampler(settings_dict["muon_energy_min"],
-                                                    settings_dict["muon_energy_max"],
-                                                    settings_dict["n_muons"])
-
-        propagation_lengths = np.random.uniform(settings_dict["propagation_length_min"],
-                                                settings_dict["propagation_length_max"],
-                                                settings_dict["n_muons"])
+            store_path = None
+        store_paths[brems_multiplier] = store_path
 
+        if adaptive:
+            if not rc.is_filled(cube_metadata, brems_multiplier):
+                propagate_adaptive(settings_dict, style, brems_multiplier, worker_func, imap, workers, store_path,
+                                   settings_file)
+            continue
 
-        bin_file_name = settings_dict["step01_file_{}_data".format(style)].format(brems_multiplier)
-        err_file_name = settings_dict["step01_file_{}_err_data".format(style)].format(brems_multiplier)
-        if os.path.isfile(bin_file_name) and os.path.isfile(err_file_name) and not overwrite:
+        if rc.is_filled(cube_metadata, brems_multiplier):
             continue
 
-        prop = create_propagator(settings_dict["path_interpolation_tables_{}".format(style)],
-                                brems_multiplier)
-        sec_bins, sec_errs = propagate_and_return_secondary_hist(prop,
-                                                                muon_energies,
-                                                                propagation_lengths,
-                                                                loss_bin_edges,
-                                                                len_bins)
-        np.savetxt(bin_file_name, sec_bins)
-        np.savetxt(err_file_name, sec_errs)
+        # the finished chunks of a checkpoint are not propagated again
+        checkpoint = cp.resume_checkpoint(settings_dict, style, brems_multiplier, store_path)
+        if checkpoint is not None:
+            chunk_hists[brems_multiplier], binning_chunk_hists[brems_multiplier], _ = checkpoint
+        finished_chunks = chunk_hists.get(brems_multiplier, {})
+        tasks.extend(task for task in multiplier_tasks(settings_dict, style, brems_multiplier, store_path)
+                     if task["chunk_idx"] not in finished_chunks)
+
+    # the run was interrupted after all chunks of these multipliers were checkpointed
+    for brems_multiplier in [brems_multiplier for brems_multiplier, chunks in chunk_hists.items()
+                             if len(chunks) == n_chunks]:
+        finish_chunks(settings_dict, style, brems_multiplier, chunk_hists.pop(brems_multiplier),
+                      binning_chunk_hists.pop(brems_multiplier), store_paths[brems_multiplier], n_batches)
+
+    checkpoint_interval = settings_dict.get("checkpoint_interval")
+    last_checkpoint = time.time()
+    updated = set()
+    timers = {}
+    for brems_multiplier, chunk_idx, secondary_hist, binning_hists, timer in tqdm(imap_chunks(imap, worker_func, tasks),
+                                                                                   total=len(tasks)):
+        chunk_hists.setdefault(brems_multiplier, {})[chunk_idx] = secondary_hist
+        binning_chunk_hists.setdefault(brems_multiplier, {})[chunk_idx] = binning_hists
+        timers.setdefault(brems_multiplier, PhaseTimer(settings_dict["n_slowest_muons"])).merge(timer)
+        updated.add(brems_multiplier)
+        if len(chunk_hists[brems_multiplier]) == n_chunks:
+            finish_chunks(settings_dict, style, brems_multiplier, chunk_hists.pop(brems_multiplier),
+                          binning_chunk_hists.pop(brems_multiplier), store_paths[brems_multiplier], n_batches,
+                          timers.pop(brems_multiplier), settings_file)
+            updated.discard(brems_multiplier)
+
+        if checkpoint_interval is not None and time.time() - last_checkpoint >= checkpoint_interval:
+            for brems_multiplier in updated:
+                save_checkpoint(settings_dict, style, brems_multiplier, store_paths[brems_multiplier],
+                                chunk_hists[brems_multiplier], binning_chunk_hists[brems_multiplier])
+            updated.clear()
+            last_checkpoint = time.time()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if write_text:
+        rc.export_text(settings_dict, style)
+
+    # the scratch tables are removed, when all multipliers are done
+    cache_path = settings_dict.get("path_interpolation_tables_{}_cache".format(style))
+    if cache_path and settings_dict.get("table_cache_cleanup", True) \
+       and all(rc.load_metadata(settings_dict, style)["filled"]):
+        it.TableCache(cache_path, settings_dict["table_cache_max_size"]).cleanup()
+
+
+def shard_hash(settings_dict, style, store_losses=False):
+    # all shards have to be propagated with the same muons and multipliers
+    return settings_hash(settings_dict,
+                         keys=cp.CHECKPOINT_KEYS + ["n_common_random_batches"],
+                         style=style,
+                         brems_multiplier_arr=settings_dict["brems_multiplier_{}_arr".format(style)],
+                         store_losses=store_losses)
+
+def shard_path(settings_dict, style, shard_idx, n_shards):
+    return os.path.join(settings_dict["step01_path_{}_shards".format(style)],
+                        "shard_{:04d}_of_{:04d}".format(shard_idx, n_shards))
+
+def propagate_shard(settings_dict, style, shard_idx, n_shards, workers=1, store_losses=False):
+    r"""
+    Propagate every n_shards-th chunk of all multipliers and write their sums
+
+    Every muon has its own random stream, so the chunks of a shard are the same
+    as in a single run and the merged shards give the same result.
+    The shard is complete, when its shard.json is written.
+    """
+    if settings_dict.get("adaptive_target_rel_error") is not None:
+        raise ValueError("the adaptive propagation can not be split into shards")
+    if not 0 <= shard_idx < n_shards:
+        raise ValueError("shard {} does not exist for {} shards".format(shard_idx, n_shards))
+
+    tasks = []
+    for brems_multiplier in settings_dict["brems_multiplier_{}_arr".format(style)]:
+        if store_losses:
+            store_path = ls.store_path(settings_dict, style, brems_multiplier)
+        else:
+            store_path = None
+        tasks.extend(multiplier_tasks(settings_dict, style, brems_multiplier, store_path))
+    tasks = tasks[shard_idx::n_shards]
+
+    worker_func = partial(propagate_task, settings_dict)
+    if workers > 1 and len(tasks) > 1:
+        pool = Pool(min(workers, len(tasks)))
+        results = list(tqdm(imap_chunks(pool.imap_unordered, worker_func, tasks), total=len(tasks)))
+        pool.close()
+        pool.join()
+    else:
+        results = list(tqdm(imap_chunks(map, worker_func, tasks), total=len(tasks)))
+
+    chunk_hists = {}
+    binning_chunk_hists = {}
+    timers = {}
+    for brems_multiplier, chunk_idx, secondary_hist, binning_hists, timer in results:
+        chunk_hists.setdefault(brems_multiplier, {})[chunk_idx] = secondary_hist
+        binning_chunk_hists.setdefault(brems_multiplier, {})[chunk_idx] = binning_hists
+        timers.setdefault(brems_multiplier, PhaseTimer(settings_dict["n_slowest_muons"])).merge(timer)
+
+    path = shard_path(settings_dict, style, shard_idx, n_shards)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    shard_files = {}
+    for idx, brems_multiplier in enumerate(sorted(chunk_hists)):
+        shard_files[repr(brems_multiplier)] = "chunks_{:04d}.npz".format(idx)
+        cp.write_checkpoint(os.path.join(path, shard_files[repr(brems_multiplier)]),
+                            chunk_hists[brems_multiplier],
+                            binning_chunk_hists[brems_multiplier],
+                            {"brems_multiplier": brems_multiplier,
+                             "timing": timers[brems_multiplier].to_dict()})
+    shard_info = {"shard": shard_idx,
+                  "n_shards": n_shards,
+                  "settings_hash": shard_hash(settings_dict, style, store_losses),
+                  "store_losses": store_losses,
+                  "files": shard_files}
+    with open(os.path.join(path, "shard.json"), "w") as file:
+        json.dump(shard_info, fp=file, indent=2, separators=(",", ":"))
+    print("shard {}/{}: {} chunks done".format(shard_idx, n_shards, len(results)))
+
+def parse_shard(value):
+    try:
+        shard_idx, n_shards = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise ArgumentTypeError("shard has to be given as i/N, not {}".format(value))
+    if not 0 <= shard_idx < n_shards:
+        raise ArgumentTypeError("shard index has to be between 0 and N-1, not {}".format(value))
+    return shard_idx, n_shards
 
 
 def main():
@@ -293,11 +1333,28 @@ def main():
                         type=bool,
                         dest='overwrite', default=False,
                         help='recalculate histogram and propagate')
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        dest='workers', default=1,
+                        help='number of worker processes propagating the muon chunks')
+    parser.add_argument('-s', '--store',
+                        action='store_true',
+                        dest='store_losses',
+                        help='store every loss to histogram it again with a different binning')
+    parser.add_argument('-t', '--text',
+                        action='store_true',
+                        dest='write_text',
+                        help='additionally write the histograms of each multiplier as text files')
+    parser.add_argument('--style',
+                        type=str,
+                        dest='style', default="buildup",
+                        help='buildup or testing')
+    parser.add_argument('--shard',
+                        type=parse_shard,
+                        dest='shard', default=None,
+                        help='propagate only the shard i/N of the chunks, merge them with merge_shards.py')
     args = parser.parse_args()
 
-    pp.RandomGenerator.get().set_seed(1234)
-    np.random.seed(123)
-
     with open(args.settings_file) as file:
         settings_dict = json.load(file)
 
@@ -305,10 +1362,16 @@ def main():
     if not os.path.isdir(settings_dict["step01_path"]):
         os.mkdir(settings_dict["step01_path"])
 
-    # simulate with different multiplier to param bin diffs
-    create_secondaries_hist(settings_dict, args.overwrite, style="buildup")
-    # create test multiplier datasets
-    # create_secondaries_hist(settings_dict, overwrite, style="testing")
+    if args.shard is not None:
+        propagate_shard(settings_dict, args.style, args.shard[0], args.shard[1],
+                        workers=args.workers, store_losses=args.store_losses)
+        return
+
+    # simulate with different multiplier to param bin diffs with the buildup style,
+    # the testing style creates the test multiplier datasets
+    create_secondaries_hist(settings_dict, args.overwrite, style=args.style,
+                            workers=args.workers, store_losses=args.store_losses,
+                            write_text=args.write_text, settings_file=args.settings_file)
 
 
 if __name__ == "__main__":
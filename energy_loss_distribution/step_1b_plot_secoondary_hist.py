@@ -1,6 +1,6 @@
 
-# import matplotlib as mpl
-# mpl.use('Agg')
+import matplotlib as mpl
+mpl.use('Agg')
 from matplotlib import gridspec
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mticker
@@ -9,12 +9,14 @@ import argparse
 import os
 import json
 
-def plot_dNdx(settings_dict, brems_multiplier, style='buildup'):
+import result_cube as rc
+import checkpoint as cp
+from plot_pages import render_pages
+
+def create_dNdx_figure(settings_dict, sec_bins, sec_errs):
     bin_mids = np.array(settings_dict["energy_loss_bin_mids"])
     bin_edges = np.array(settings_dict["energy_loss_bin_edges"])
 
-    sec_bins = np.genfromtxt(settings_dict["step01_file_{}_data".format(style)].format(brems_multiplier))
-    sec_errs = np.genfromtxt(settings_dict["step01_file_{}_err_data".format(style)].format(brems_multiplier))
     sum_bins = np.sum(sec_bins[:-1], axis=0)
     max_bin_height = max(sum_bins)
     min_bin_height = 1. / settings_dict["n_muons"] * \
@@ -52,25 +54,56 @@ def plot_dNdx(settings_dict, brems_multiplier, style='buildup'):
     ax.legend()#bbox_to_anchor=(1.02, 1), loc=2, borderaxespad=0.)
     # ax.grid()
     fig.tight_layout(pad=0, h_pad=1.02, w_pad=1.02)
+    return fig
+
+def plot_dNdx(settings_dict, brems_multiplier, style='buildup'):
+    cube, cube_metadata = rc.load_cube(settings_dict, style)
+    sec_bins, sec_errs = rc.multiplier_hist(cube, cube_metadata, brems_multiplier)
+    fig = create_dNdx_figure(settings_dict, sec_bins, sec_errs)
     fig.savefig(settings_dict["step01_file_{}_plots".format(style)].format(brems_multiplier))
-    plt.close()
+    plt.close(fig)
 
-def loop_brems_multiplier_plot(settings_dict, style='buildup'):
+def loop_brems_multiplier_plot(settings_dict, style='buildup', workers=1, single_pdf=False):
     if not os.path.isdir(settings_dict["step01_path_{}_plots".format(style)]):
         os.mkdir(settings_dict["step01_path_{}_plots".format(style)])
 
+    # the cube is read once, every page only gets its own histograms
+    cube, cube_metadata = rc.load_cube(settings_dict, style)
+    brems_multiplier_arr = settings_dict["brems_multiplier_{}_arr".format(style)]
+    page_args = []
+    for brems_multiplier in brems_multiplier_arr:
+        sec_bins, sec_errs = rc.multiplier_hist(cube, cube_metadata, brems_multiplier)
+        page_args.append((settings_dict, np.array(sec_bins), np.array(sec_errs)))
+    file_names = [settings_dict["step01_file_{}_plots".format(style)].format(brems_multiplier)
+                  for brems_multiplier in brems_multiplier_arr]
+
+    if single_pdf:
+        pdf_file = settings_dict["step01_file_{}_plots_all".format(style)]
+    else:
+        pdf_file = None
+    render_pages(create_dNdx_figure, page_args, file_names, workers, pdf_file)
+
+def plot_snapshots(settings_dict, style='buildup'):
+    # the checkpoints of a running propagation, the number of muons is the one propagated so far
+    if not os.path.isdir(settings_dict["step01_path_{}_plots".format(style)]):
+        os.mkdir(settings_dict["step01_path_{}_plots".format(style)])
     for brems_multiplier in settings_dict["brems_multiplier_{}_arr".format(style)]:
-        plot_dNdx(settings_dict, brems_multiplier, style)
+        checkpoint_file = cp.checkpoint_file(settings_dict, style, brems_multiplier)
+        if not os.path.isfile(checkpoint_file):
+            continue
+        secondary_hist, info = cp.load_snapshot(checkpoint_file)
+        sec_bins, sec_errs = secondary_hist.finalize()
+        fig = create_dNdx_figure(dict(settings_dict, n_muons=info["n_muons"]), sec_bins, sec_errs)
+        fig.savefig(settings_dict["step01_file_{}_snapshot_plots".format(style)].format(brems_multiplier))
+        plt.close(fig)
+        print("brems_multiplier {}: snapshot of {} muons".format(brems_multiplier, info["n_muons"]))
 
 def compare_multiplier_hist(settings_dict, style='buildup'):
-    sec_bins = np.empty((settings_dict['n_buildup_multiplier'], settings_dict['n_energy_loss_bins']))
-    sec_errs = np.empty((settings_dict['n_buildup_multiplier'], settings_dict['n_energy_loss_bins']))
-    brems_multiplier_arr = settings_dict['brems_multiplier_buildup_arr']
-    for idx, multiplier in enumerate(brems_multiplier_arr):
-        tmp = np.genfromtxt(settings_dict["step01_file_{}_data".format(style)].format(multiplier))
-        sec_bins[idx] = tmp[-1]
-        tmp = np.genfromtxt(settings_dict["step01_file_{}_err_data".format(style)].format(multiplier))
-        sec_errs[idx] = tmp[-1]
+    cube, cube_metadata = rc.load_cube(settings_dict, style)
+    brems_multiplier_arr = cube_metadata['multipliers']
+    # the binned track of all multipliers
+    sec_bins = cube[rc.VALUES, :, -1]
+    sec_errs = cube[rc.ERRORS, :, -1]
 
     bin_mids = np.array(settings_dict["energy_loss_bin_mids"])
     bin_edges = np.array(settings_dict["energy_loss_bin_edges"])
@@ -83,7 +116,7 @@ def compare_multiplier_hist(settings_dict, style='buildup'):
     # ax = fig.add_subplot(gs[:-1])
     ax = fig.add_subplot(111)
 
-    for idx in range(settings_dict['n_buildup_multiplier'])[::2]:
+    for idx in range(len(brems_multiplier_arr))[::2]:
         ax.errorbar(bin_mids,
                     sec_bins[idx],
                     yerr=sec_errs[idx],
@@ -101,20 +134,32 @@ def compare_multiplier_hist(settings_dict, style='buildup'):
     # ax.grid()
     fig.tight_layout(pad=0, h_pad=1.02, w_pad=1.02)
     fig.savefig(settings_dict["step01_file_multiplier_compare_{}_plot".format(style)])
-    plt.close()
+    plt.close(fig)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-f','--file', type=str,
                         dest='settings_file', default="build/settings.json",
                         help='json file containing the settings')
+    parser.add_argument('-w','--workers', type=int,
+                        dest='workers', default=1,
+                        help='number of processes rendering the plots')
+    parser.add_argument('-s','--single-pdf', action='store_true',
+                        dest='single_pdf',
+                        help='write all spectra into one multi-page pdf')
+    parser.add_argument('-p','--progress', action='store_true',
+                        dest='progress',
+                        help='plot the checkpoints of a running propagation')
     args = parser.parse_args()
 
     with open(args.settings_file) as file:
         settings_dict = json.load(file)
 
-        loop_brems_multiplier_plot(settings_dict, "buildup")
-        compare_multiplier_hist(settings_dict, "buildup")
+        if args.progress:
+            plot_snapshots(settings_dict, "buildup")
+        else:
+            loop_brems_multiplier_plot(settings_dict, "buildup", args.workers, args.single_pdf)
+            compare_multiplier_hist(settings_dict, "buildup")
         # loop_brems_multiplier_plot(settings_dict, "testing")
 
         # for testing
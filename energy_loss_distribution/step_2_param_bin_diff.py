@@ -1,6 +1,6 @@
 
-# import matplotlib as mpl
-# mpl.use('Agg')
+import matplotlib as mpl
+mpl.use('Agg')
 # from matplotlib import gridspec
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mticker
@@ -9,39 +9,130 @@ import argparse
 import os
 import json
 
+import result_cube as rc
+from plot_pages import render_pages
+
 
 def all_bins_errs(settings_dict):
-    sec_bins = np.empty((settings_dict["n_buildup_multiplier"],
-                        settings_dict["n_energy_loss_bins"]))
-    sec_errs = np.empty((settings_dict["n_buildup_multiplier"],
-                        settings_dict["n_energy_loss_bins"]))
-    for idx, brems_multiplier in enumerate(settings_dict["brems_multiplier_buildup_arr"]):
-        tmp = np.genfromtxt(settings_dict["step01_file_buildup_data"].format(brems_multiplier))
-        sec_bins[idx] = tmp[-1]
-        tmp = np.genfromtxt(settings_dict["step01_file_buildup_err_data"].format(brems_multiplier))
-        sec_errs[idx] = tmp[-1]
-    return sec_bins, sec_errs
+    # the binned track of all multipliers
+    cube, _ = rc.load_cube(settings_dict, "buildup")
+    return cube[rc.VALUES, :, -1], cube[rc.ERRORS, :, -1]
+
+def weighted_linear_fit(x, y, yerr):
+    r"""
+    Fit y = slope * x + intercept for all bins at once
+
+    Parameters
+    ----------
+    x : array-like
+        (n,) array of the multipliers
+    y, yerr : array-like
+        (n, ...) arrays of the bin contents and their errors
+
+    Returns
+    -------
+    slopes, intercepts : array-like
+        fit parameters with the shape of y[0]
+    covariances : array-like
+        covariance matrices of (slope, intercept) with the shape of y[0] + (2, 2)
+    """
+    x = np.asarray(x, dtype=float).reshape((-1,) + (1,) * (np.ndim(y) - 1))
+    y = np.asarray(y, dtype=float)
+    yerr = np.asarray(yerr, dtype=float)
+
+    # empty bins have no error, they get the error of an average single entry
+    # of their multiplier, otherwise the fit is biased to the filled bins
+    axes = tuple(range(1, np.ndim(y)))
+    sum_y = np.sum(y, axis=axes, keepdims=True)
+    entry_errs = np.zeros_like(sum_y)
+    np.divide(np.sum(yerr**2, axis=axes, keepdims=True), sum_y, out=entry_errs, where=sum_y > 0)
+    yerr = np.where(yerr > 0, yerr, entry_errs)
+
+    weights = np.zeros_like(yerr)
+    np.divide(1., yerr**2, out=weights, where=yerr > 0)
+    # bins with less than two errors are fitted unweighted,
+    # their covariance is estimated from the residuals like in np.polyfit
+    unweighted = np.count_nonzero(weights, axis=0) < 2
+    weights[:, unweighted] = 1.
+
+    sum_w = np.sum(weights, axis=0)
+    sum_wx = np.sum(weights * x, axis=0)
+    sum_wxx = np.sum(weights * x**2, axis=0)
+    sum_wy = np.sum(weights * y, axis=0)
+    sum_wxy = np.sum(weights * x * y, axis=0)
+    det = sum_w * sum_wxx - sum_wx**2
+
+    slopes = (sum_w * sum_wxy - sum_wx * sum_wy) / det
+    intercepts = (sum_wxx * sum_wy - sum_wx * sum_wxy) / det
+
+    covariances = np.empty(slopes.shape + (2, 2))
+    covariances[..., 0, 0] = sum_w / det
+    covariances[..., 0, 1] = - sum_wx / det
+    covariances[..., 1, 0] = - sum_wx / det
+    covariances[..., 1, 1] = sum_wxx / det
+
+    n_points = len(x)
+    chi2 = np.sum(weights * (y - slopes * x - intercepts)**2, axis=0)
+    scale = np.where(unweighted, chi2 / max(n_points - 2, 1), 1.)
+    covariances *= scale[..., np.newaxis, np.newaxis]
+    return slopes, intercepts, covariances
+
+def load_batch_cube(settings_dict, cube_metadata):
+    # the batches are only written by a propagation with a fixed number of muons,
+    # they have to belong to the same multipliers and bins as the cube
+    if settings_dict.get("adaptive_target_rel_error") is not None:
+        return None, "the adaptive propagation writes no batches"
+    cube_file, metadata_file = rc.cube_files(settings_dict, "buildup", rc.BATCH_CUBE)
+    if not (os.path.isfile(cube_file) and os.path.isfile(metadata_file)):
+        return None, "the batch cube does not exist"
+    batch_cube, batch_metadata = rc.load_cube(settings_dict, "buildup", rc.BATCH_CUBE)
+    if batch_metadata["multipliers"] != cube_metadata["multipliers"] \
+       or batch_metadata["energy_loss_bin_edges"] != cube_metadata["energy_loss_bin_edges"]:
+        return None, "the batch cube belongs to other settings"
+    if not all(batch_metadata["filled"]):
+        return None, "the batch cube is not filled"
+    if len(batch_cube) < 2:
+        return None, "the spread of a single batch is unknown"
+    return batch_cube, None
+
+def batch_covariances(multipliers, yerr, batch_cube):
+    # with common random numbers the multipliers are correlated, so the covariances
+    # are estimated from the spread of the fits to the batches of the same muons
+    n_batches = len(batch_cube)
+    batch_bins = np.moveaxis(np.asarray(batch_cube), 0, 1)
+    batch_errs = np.broadcast_to(np.asarray(yerr)[:, np.newaxis], batch_bins.shape) * np.sqrt(n_batches)
+    slopes, intercepts, _ = weighted_linear_fit(multipliers, batch_bins, batch_errs)
+
+    params = np.stack((slopes, intercepts), axis=-1)
+    deviations = params - np.mean(params, axis=0)
+    return np.einsum('b...i,b...j->...ij', deviations, deviations) / (n_batches * (n_batches - 1))
 
 def param_bin_diff(settings_dict):
-    bins_all, _ = all_bins_errs(settings_dict)
-
-    param_arr = np.empty((settings_dict["n_energy_loss_bins"], 2))
-    for idx in range(settings_dict["n_energy_loss_bins"]):
-        params, covariance_matrix = np.polyfit(settings_dict["brems_multiplier_buildup_arr"],
-                                               bins_all[:,idx],#/bins_all[5,idx],
-                                               deg=1,
-                                               cov=True)
-        param_arr[idx] = params
-
+    cube, cube_metadata = rc.load_cube(settings_dict, "buildup")
+
+    # fit every secondary type and loss bin in one go
+    slopes, intercepts, covariances = weighted_linear_fit(cube_metadata["multipliers"],
+                                                          cube[rc.VALUES],
+                                                          cube[rc.ERRORS])
+    if settings_dict.get("common_random_numbers", False):
+        batch_cube, reason = load_batch_cube(settings_dict, cube_metadata)
+        if batch_cube is None:
+            print("{}, the covariances neglect the correlation of the common random numbers".format(reason))
+        else:
+            covariances = batch_covariances(cube_metadata["multipliers"], cube[rc.ERRORS], batch_cube)
+    np.savez(settings_dict["step02_file_param_fit"],
+             slopes=slopes,
+             intercepts=intercepts,
+             covariances=covariances,
+             multipliers=cube_metadata["multipliers"],
+             secondary_types=cube_metadata["secondary_types"],
+             energy_loss_bin_edges=cube_metadata["energy_loss_bin_edges"])
+
+    # the binned track
+    param_arr = np.column_stack((slopes[-1], intercepts[-1]))
     np.savetxt(settings_dict["step02_file_param_bin_diff"], param_arr)
 
-def plot_param_bin_diff(settings_dict, bin_num):
-    if not os.path.isfile(settings_dict["step02_file_param_bin_diff"]):
-        param_bin_diff(settings_dict)
-
-    bins_all, errs_all = all_bins_errs(settings_dict)
-    param_arr = np.genfromtxt(settings_dict["step02_file_param_bin_diff"])
-
+def create_param_bin_diff_figure(settings_dict, bin_num, bins, errs, params):
     x_plot = np.linspace(min(settings_dict["brems_multiplier_buildup_arr"]),
                          max(settings_dict["brems_multiplier_buildup_arr"]),
                          100)
@@ -55,8 +146,8 @@ def plot_param_bin_diff(settings_dict, bin_num):
     fig = plt.figure()
     ax = fig.add_subplot(111)
     ax.errorbar(settings_dict["brems_multiplier_buildup_arr"],
-                bins_all[:,bin_num],
-                yerr=errs_all[:,bin_num],
+                bins,
+                yerr=errs,
                 xerr=None,
                 linestyle='',
                 marker='o',
@@ -66,20 +157,49 @@ def plot_param_bin_diff(settings_dict, bin_num):
                 label="Data",
                 )
 
-    ax.plot(x_plot, param_arr[bin_num, 0] * x_plot + param_arr[bin_num, 1], label='Lin. Reg.')
+    ax.plot(x_plot, params[0] * x_plot + params[1], label='Lin. Reg.')
     ax.set_xlabel(r'Bremsstrahlung Multiplier')
     ax.set_ylabel(r'd$N$ / 100 m / muon')
     ax.set_title('Energy bin {} - {} MeV'.format(fformat(bin_edges[bin_num]), fformat(bin_edges[bin_num+1])))
     ax.legend(loc="best")
     fig.tight_layout(pad=0, h_pad=1.02, w_pad=1.02)
+    return fig
+
+def plot_param_bin_diff(settings_dict, bin_num):
+    if not os.path.isfile(settings_dict["step02_file_param_bin_diff"]):
+        param_bin_diff(settings_dict)
+
+    bins_all, errs_all = all_bins_errs(settings_dict)
+    param_arr = np.genfromtxt(settings_dict["step02_file_param_bin_diff"])
+
+    fig = create_param_bin_diff_figure(settings_dict,
+                                       bin_num,
+                                       bins_all[:,bin_num],
+                                       errs_all[:,bin_num],
+                                       param_arr[bin_num])
     fig.savefig(settings_dict["step02_file_plots"].format(bin_num))
+    plt.close(fig)
 
-def plot_for_each_bin(settings_dict):
+def plot_for_each_bin(settings_dict, workers=1, single_pdf=False):
     if not os.path.isdir(settings_dict["step02_path_plots"]):
         os.mkdir(settings_dict["step02_path_plots"])
 
-    for idx in range(settings_dict["n_energy_loss_bins"]):
-        plot_param_bin_diff(settings_dict, idx)
+    if not os.path.isfile(settings_dict["step02_file_param_bin_diff"]):
+        param_bin_diff(settings_dict)
+
+    # the data is read once, every page only gets its own bin
+    bins_all, errs_all = all_bins_errs(settings_dict)
+    param_arr = np.genfromtxt(settings_dict["step02_file_param_bin_diff"])
+    page_args = [(settings_dict, idx, np.array(bins_all[:,idx]), np.array(errs_all[:,idx]), param_arr[idx])
+                 for idx in range(settings_dict["n_energy_loss_bins"])]
+    file_names = [settings_dict["step02_file_plots"].format(idx)
+                  for idx in range(settings_dict["n_energy_loss_bins"])]
+
+    if single_pdf:
+        pdf_file = settings_dict["step02_file_plots_all"]
+    else:
+        pdf_file = None
+    render_pages(create_param_bin_diff_figure, page_args, file_names, workers, pdf_file)
 
 
 if __name__ == "__main__":
@@ -87,6 +207,12 @@ if __name__ == "__main__":
     parser.add_argument('-f','--file', type=str,
                         dest='settings_file', default="build/settings.json",
                         help='json file containing the settings')
+    parser.add_argument('-w','--workers', type=int,
+                        dest='workers', default=1,
+                        help='number of processes rendering the plots')
+    parser.add_argument('-s','--single-pdf', action='store_true',
+                        dest='single_pdf',
+                        help='write the fits of all bins into one multi-page pdf')
     args = parser.parse_args()
     np.random.seed(123)
 
@@ -98,6 +224,6 @@ if __name__ == "__main__":
             os.mkdir(settings_dict["step02_path"])
 
         # param_bin_diff(settings_dict)
-        plot_for_each_bin(settings_dict)
+        plot_for_each_bin(settings_dict, args.workers, args.single_pdf)
 
 
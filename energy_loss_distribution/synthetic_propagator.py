@@ -0,0 +1,155 @@
+
+import numpy as np
+import types
+import sys
+
+# the benchmarks run without pyPROPOSAL, then a minimal stand-in module provides
+# the secondary ids and particle definitions step_1_propagate reads at import,
+# with pyPROPOSAL only its random generator is replaced
+try:
+    import pyPROPOSAL as pp
+except ImportError:
+    pp = None
+
+
+class ParticleDef(object):
+    def __init__(self, name, mass):
+        self.name = name
+        self.mass = mass
+
+class Vector3D(object):
+    __slots__ = ("x", "y", "z")
+
+    def __init__(self, x=0., y=0., z=0.):
+        self.x = x
+        self.y = y
+        self.z = z
+
+class Secondary(object):
+    # the attributes of a pyPROPOSAL DynamicData read by step_1_propagate
+    __slots__ = ("id", "energy", "position", "particle_def", "parent_particle_energy")
+
+    def __init__(self, id, energy, position, particle_def=None, parent_particle_energy=0.):
+        self.id = id
+        self.energy = energy
+        self.position = position
+        self.particle_def = particle_def
+        self.parent_particle_energy = parent_particle_energy
+
+class RandomGenerator(object):
+    # seeds the generator of all synthetic propagators like pp.RandomGenerator
+    rng = np.random.default_rng(0)
+
+    def set_seed(self, seed):
+        RandomGenerator.rng = np.random.default_rng(seed)
+
+_random_generator = RandomGenerator()
+
+
+def particle_def_getter(name, mass):
+    particle_def = ParticleDef(name, mass)
+    return types.SimpleNamespace(get=lambda: particle_def)
+
+def stand_in_module():
+    module = types.ModuleType("pyPROPOSAL")
+    module.particle = types.SimpleNamespace(
+        Data=types.SimpleNamespace(Particle=1000000001,
+                                   Brems=1000000002,
+                                   DeltaE=1000000003,
+                                   Epair=1000000004,
+                                   NuclInt=1000000005,
+                                   MuPair=1000000006,
+                                   WeakInt=1000000008),
+        MuMinusDef=particle_def_getter("MuMinus", 105.6583745),
+        MuPlusDef=particle_def_getter("MuPlus", 105.6583745),
+        EMinusDef=particle_def_getter("EMinus", 0.5109989461),
+        EPlusDef=particle_def_getter("EPlus", 0.5109989461),
+        NuMuDef=particle_def_getter("NuMu", 0.),
+        NuEBarDef=particle_def_getter("NuEBar", 0.))
+    module.Vector3D = Vector3D
+    module.RandomGenerator = random_generator_getter()
+    return module
+
+def random_generator_getter():
+    return types.SimpleNamespace(get=lambda: _random_generator)
+
+def use_stand_in():
+    # before step_1_propagate is imported, the module only if pyPROPOSAL is not installed,
+    # the random generator in any case, so the seeds of the muons reach the synthetic propagators
+    global pp
+    if pp is None:
+        pp = stand_in_module()
+        sys.modules["pyPROPOSAL"] = pp
+    else:
+        pp.RandomGenerator = random_generator_getter()
+    return pp
+
+
+# number fractions of the stochastic losses above the cut
+DEFAULT_TYPE_FRACTIONS = {"Epair": 0.6, "DeltaE": 0.2, "Brems": 0.15, "NuclInt": 0.05}
+
+class SyntheticPropagator(object):
+    r"""
+    Stand-in propagator emitting synthetic secondary lists
+
+    The number of losses is poisson distributed with the given rate along
+    the propagated length, the types are drawn from the number fractions,
+    the relative losses log uniformly between the cut and the maximal
+    relative loss. A fraction of the losses are mupairs, whose muons are
+    propagated by step_1_propagate like the ones of PROPOSAL. A muon below
+    the decay energy decays into an electron and neutrinos.
+    Its propagate has the signature and the results step_1_propagate uses.
+    """
+    def __init__(self,
+                 losses_per_meter=1.5,
+                 type_fractions=None,
+                 mupair_fraction=1e-3,
+                 ecut=500.,
+                 max_rel_loss=0.2,
+                 decay_energy=1e3,
+                 seed=0):
+        if pp is None:
+            raise ImportError("call use_stand_in before creating a SyntheticPropagator without pyPROPOSAL")
+        if type_fractions is None:
+            type_fractions = DEFAULT_TYPE_FRACTIONS
+        self.losses_per_cm = losses_per_meter * 1e-2
+        self.type_ids = np.array([getattr(pp.particle.Data, name) for name in type_fractions])
+        fractions = np.array(list(type_fractions.values()), dtype=float)
+        self.type_probabilities = fractions / np.sum(fractions)
+        self.mupair_fraction = mupair_fraction
+        self.ecut = ecut
+        self.max_rel_loss = max_rel_loss
+        self.decay_energy = decay_energy
+        self.decay_defs = [pp.particle.EMinusDef.get(), pp.particle.NuMuDef.get(), pp.particle.NuEBarDef.get()]
+        self.particle = types.SimpleNamespace(position=None, direction=None, propagated_distance=0.,
+                                              energy=0., time=0.)
+        _random_generator.set_seed(seed)
+
+    def propagate(self, max_len):
+        rng = RandomGenerator.rng
+        energy = self.particle.energy
+        n_losses = rng.poisson(self.losses_per_cm * max_len)
+        distances = np.sort(rng.uniform(0., max_len, n_losses))
+        type_ids = rng.choice(self.type_ids, size=n_losses, p=self.type_probabilities)
+        is_mupair = rng.random(n_losses) < self.mupair_fraction
+        rel_losses = np.exp(rng.uniform(np.log(min(self.ecut / energy, self.max_rel_loss)), np.log(self.max_rel_loss), n_losses))
+
+        secondaries = []
+        distance = max_len
+        for idx in range(n_losses):
+            if energy < self.decay_energy:
+                break
+            loss = min(max(rel_losses[idx] * energy, self.ecut), 0.5 * energy)
+            sec_id = pp.particle.Data.MuPair if is_mupair[idx] else int(type_ids[idx])
+            secondaries.append(Secondary(sec_id, loss, Vector3D(distances[idx], 0., 0.), None, energy))
+            energy -= loss
+
+        if energy < self.decay_energy:
+            # the muon decays somewhere after its last loss, the energy is shared by the decay products
+            distance = rng.uniform(secondaries[-1].position.x, max_len) if len(secondaries) > 0 else 0.
+            for particle_def, fraction in zip(self.decay_defs, rng.dirichlet(np.ones(len(self.decay_defs)))):
+                secondaries.append(Secondary(pp.particle.Data.Particle, fraction * energy,
+                                             Vector3D(distance, 0., 0.), particle_def, energy))
+        self.particle.energy = energy
+        self.particle.propagated_distance = distance
+        return secondaries
@@ -0,0 +1,159 @@
+
+import numpy as np
+from argparse import ArgumentParser
+from multiprocessing import Pool
+import time
+import sys
+import os
+import json
+
+import interpolation_tables as it
+import step_1_propagate as s1
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "range_distribution"))
+import calculate_dedx
+import calculate_propagated_ranges
+
+
+# the jobs which build all tables of a propagator, not only the ones of a cross section
+PROPAGATOR_KINDS = ["propagator", "range_propagator"]
+
+
+def energy_loss_jobs(settings_dict, styles):
+    # the tables of the propagator of every multiplier and of the brems cross section
+    jobs = []
+    for style in styles:
+        path = settings_dict["path_interpolation_tables_{}".format(style)]
+        if not path:
+            print("the {} tables are kept in memory, they are not build".format(style))
+            continue
+        for brems_multiplier in settings_dict["brems_multiplier_{}_arr".format(style)]:
+            jobs.append(it.propagator_job(path, brems_multiplier))
+        jobs.append(it.brems_job(path))
+    return jobs
+
+def range_jobs(settings_dict):
+    # the tables of the range propagation and of the dEdx calculation
+    params = [settings_dict["brems_param_name"],
+              settings_dict["epair_param_name"],
+              settings_dict["photo_param_name"]]
+    path = settings_dict["path_to_inerpolation_tables"]
+    return [{"kind": "range_propagator", "path": path, "params": params},
+            {"kind": "dedx", "path": path, "params": params}]
+
+def create_tables(job):
+    if job["kind"] == "propagator":
+        s1.create_propagator(job["path"], job["brems_multiplier"])
+    elif job["kind"] == "brems":
+        s1.create_brems_calculator(job["path"])
+    elif job["kind"] == "range_propagator":
+        calculate_propagated_ranges.create_propagator(job["path"], *job["params"])
+    elif job["kind"] == "dedx":
+        calculate_dedx.create_cross_section_calculators(job["path"], *job["params"])
+    else:
+        raise KeyError("unknown table job {}".format(job["kind"]))
+
+def build_job(job, force=False, exclusive=False):
+    key = it.job_key(job)
+    marker = it.marker_file(job["path"], key)
+    # the builders share the directory lock, the propagation waits for all of them
+    with it.table_lock(job["path"], shared=not exclusive):
+        with it.table_lock(job["path"], key):
+            # another process may have build the tables while waiting for the lock
+            if os.path.isfile(marker) and not force:
+                with open(marker) as file:
+                    return job, "skipped", json.load(file)["build_time"]
+            start = time.time()
+            create_tables(job)
+            build_time = time.time() - start
+            with open(marker, "w") as file:
+                json.dump({"job": job, "build_time": build_time}, fp=file)
+    return job, "built", build_time
+
+def build_job_star(args):
+    return build_job(*args)
+
+def warmup(jobs, workers=1, force=False):
+    # jobs are only build once, also if several settings files need them
+    unique_jobs = []
+    for job in jobs:
+        if job not in unique_jobs:
+            unique_jobs.append(job)
+
+    # a full propagator of every directory is build alone first, it also builds the tables
+    # which are shared by all sets, e.g. of the pair production, the brems set only has its own tables
+    results = []
+    first_jobs = []
+    for job in sorted(unique_jobs, key=lambda job: job["kind"] not in PROPAGATOR_KINDS):
+        if not any(first["path"] == job["path"] for first in first_jobs):
+            first_jobs.append(job)
+    other_jobs = [job for job in unique_jobs if job not in first_jobs]
+    for job in first_jobs:
+        results.append(build_job(job, force, exclusive=True))
+        print("{} {} in {:.1f} s".format(results[-1][1], job, results[-1][2]))
+
+    tasks = [(job, force) for job in other_jobs]
+    if workers > 1 and len(tasks) > 1:
+        pool = Pool(min(workers, len(tasks)))
+        iterator = pool.imap_unordered(build_job_star, tasks)
+    else:
+        pool = None
+        iterator = map(build_job_star, tasks)
+    for result in iterator:
+        results.append(result)
+        print("{} {} in {:.1f} s".format(result[1], result[0], result[2]))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return results
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config',
+                        type=str, nargs='+',
+                        dest='settings_files', default=["build/settings.json"],
+                        help='json files containing the energy loss or range settings')
+    parser.add_argument('-s', '--styles',
+                        type=str, nargs='+',
+                        dest='styles', default=["buildup", "testing"],
+                        help='multiplier arrays of the energy loss settings')
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        dest='workers', default=1,
+                        help='number of processes building tables')
+    parser.add_argument('-f', '--force',
+                        action='store_true',
+                        dest='force',
+                        help='build the tables again, also if they are marked as built')
+    args = parser.parse_args()
+
+    jobs = []
+    report_files = {}
+    for settings_file in args.settings_files:
+        with open(settings_file) as file:
+            settings_dict = json.load(file)
+        if "brems_multiplier_buildup_arr" in settings_dict:
+            settings_jobs = energy_loss_jobs(settings_dict, args.styles)
+            report_file = settings_dict.get("file_table_warmup",
+                                            os.path.join(settings_dict["build_path"], "table_warmup.json"))
+        else:
+            settings_jobs = range_jobs(settings_dict)
+            report_file = os.path.join(settings_dict["build_path"], "table_warmup.json")
+        jobs.extend(settings_jobs)
+        report_files.setdefault(report_file, []).extend(it.job_key(job) for job in settings_jobs)
+
+    results = warmup(jobs, args.workers, args.force)
+
+    # the build time of every table set, for every settings file
+    for report_file, keys in report_files.items():
+        report = [{"job": job, "status": status, "build_time": build_time}
+                  for job, status, build_time in results if it.job_key(job) in keys]
+        with open(report_file, "w") as file:
+            json.dump(report, fp=file, indent=2, separators=(",", ":"))
+    built_times = [build_time for _, status, build_time in results if status == "built"]
+    print("{} table sets built in {:.1f} s".format(len(built_times), np.sum(built_times)))
+
+
+if __name__ == "__main__":
+    main()
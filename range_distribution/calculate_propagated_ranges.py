@@ -1,14 +1,21 @@
 import os
 import json
+import time
+import hashlib
 import numpy as np
 from tqdm import tqdm
 import pyPROPOSAL as pp
 from argparse import ArgumentParser
+from functools import partial
+from multiprocessing import Pool
+
+from latency_log import LatencyLog
 
 def create_propagator(path_to_inerpolation_tables='~/.local/share/PROPOSAL/tables',
                       brems_param_name='BremsKelnerKokoulinPetrukhin',
                       epair_param_name='EpairKelnerKokoulinPetrukhin',
-                      photo_param_name='PhotoAbramowiczLevinLevyMaor97'):
+                      photo_param_name='PhotoAbramowiczLevinLevyMaor97',
+                      readonly=False):
     mu_def = pp.particle.MuMinusDef.get()
     geometry = pp.geometry.Sphere(pp.Vector3D(), 1.e20, 0.0)
     ecut = 500
@@ -30,16 +37,33 @@ def create_propagator(path_to_inerpolation_tables='~/.local/share/PROPOSAL/table
     detector = geometry
 
     interpolation_def = pp.InterpolationDef()
-    interpolation_def.path_to_tables = path_to_inerpolation_tables
+    # read only tables are never written, missing tables are build in memory
+    interpolation_def.path_to_tables = '' if readonly else path_to_inerpolation_tables
     interpolation_def.path_to_tables_readonly = path_to_inerpolation_tables
 
     return pp.Propagator(mu_def, [sector_def], detector, interpolation_def)
 
-def propagate(prop, energy, oversampling):
+def stream_entropy(settings_dict):
+    # the settings which change the ranges, the oversampling only extends the sample
+    keys = ['prop_random_seed', 'brems_param_name', 'epair_param_name', 'photo_param_name']
+    hash_str = json.dumps({key: settings_dict.get(key) for key in keys}, sort_keys=True, separators=(',', ':'))
+    return int(hashlib.sha1(hash_str.encode('utf-8')).hexdigest(), 16)
+
+def muon_seeds(entropy, energy, n_muons):
+    # every muon gets its own seed derived from the settings, its energy and its index,
+    # so the ranges do not depend on the number of processes
+    energy_word = int(np.float64(energy).view(np.uint64))
+    return [int(np.random.SeedSequence(entropy, spawn_key=(energy_word, idx)).generate_state(1)[0] % (2**31 - 1))
+            for idx in range(n_muons)]
+
+def propagate(prop, energy, oversampling, seeds=None, show_progress=True, latency=None):
     propagation_length = 1e9 # cm
     muon_ranges = np.empty(oversampling)
 
-    for idx in tqdm(range(oversampling)):
+    for idx in tqdm(range(oversampling), disable=not show_progress):
+        start = time.perf_counter()
+        if seeds is not None:
+            pp.RandomGenerator.get().set_seed(seeds[idx])
         prop.particle.position = pp.Vector3D(0, 0, 0)
         prop.particle.direction = pp.Vector3D(1, 0, 0)
         prop.particle.propagated_distance = 0
@@ -49,9 +73,61 @@ def propagate(prop, energy, oversampling):
         secondarys = prop.propagate(propagation_length)
 
         muon_ranges[idx] = prop.particle.propagated_distance
+        if latency is not None:
+            latency.record(time.perf_counter() - start,
+                           energy=energy,
+                           length=muon_ranges[idx],
+                           seed=None if seeds is None else int(seeds[idx]),
+                           n_secondaries=len(secondarys))
 
     return muon_ranges
 
+def replay_command(settings_file, muon):
+    return 'python calculate_propagated_ranges.py -f {} --replay {!r} {}'.format(settings_file, muon['energy'], muon['seed'])
+
+
+# the propagator is built once per process
+_propagator_cache = {}
+
+def get_propagator(settings_dict):
+    if 'prop' not in _propagator_cache:
+        _propagator_cache['prop'] = create_propagator(settings_dict['path_to_inerpolation_tables'],
+                                                      settings_dict['brems_param_name'],
+                                                      settings_dict['epair_param_name'],
+                                                      settings_dict['photo_param_name'],
+                                                      settings_dict.get('interpolation_tables_readonly', False))
+    return _propagator_cache['prop']
+
+def propagate_energy_bin(settings_dict, entropy, energy_idx):
+    energy = settings_dict['prop_energy_bin_mids'][energy_idx]
+    oversampling = settings_dict['prop_oversampling']
+    latency = LatencyLog(settings_dict['prop_n_slowest_muons'])
+    ranges = propagate(get_propagator(settings_dict),
+                       energy,
+                       oversampling,
+                       muon_seeds(entropy, energy, oversampling),
+                       show_progress=False,
+                       latency=latency)
+    return ranges, latency
+
+def write_latency(settings_dict, latencies, settings_file):
+    # the latency of every energy bin and of all muons together
+    latency = LatencyLog(settings_dict['prop_n_slowest_muons'])
+    for energy_latency in latencies:
+        latency.merge(energy_latency)
+    summary = latency.summary(partial(replay_command, settings_file))
+    summary['energy_bins'] = [{key: value for key, value in energy_latency.summary().items() if key != 'slowest'}
+                              for energy_latency in latencies]
+    with open(settings_dict['prop_data_latency'], 'w') as file:
+        json.dump(summary, fp=file, indent=2, separators=(',', ':'))
+
+def replay_muon(settings_dict, energy, seed):
+    # propagate a single muon again, e.g. a slow muon of the latency file
+    latency = LatencyLog(1)
+    muon_range = propagate(get_propagator(settings_dict), energy, 1, [seed], show_progress=False, latency=latency)[0]
+    muon = latency.summary()['slowest'][0]
+    print('range {:.6g} cm, {} secondaries in {:.4g} s'.format(muon_range, muon['n_secondaries'], muon['time']))
+
 
 def main():
     parser = ArgumentParser()
@@ -60,23 +136,39 @@ def main():
                         dest='settings_file',
                         default="build/settings.json",
                         help='json file containing the settings')
+    parser.add_argument('-w','--workers',
+                        type=int,
+                        dest='workers',
+                        default=1,
+                        help='number of processes propagating the energy bins')
+    parser.add_argument('--replay',
+                        type=float,
+                        nargs=2,
+                        dest='replay', default=None, metavar=('ENERGY', 'SEED'),
+                        help='only propagate the muon of this energy and seed again')
     args = parser.parse_args()
 
     with open(args.settings_file) as file:
         settings_dict = json.load(file)
 
-    pp.RandomGenerator.get().set_seed(1234)
-
-    ranges = np.empty((settings_dict['prop_n_muon_energy_bins'], settings_dict['prop_oversampling']))
-    prop = create_propagator(settings_dict['path_to_inerpolation_tables'],
-                            settings_dict['brems_param_name'],
-                            settings_dict['epair_param_name'],
-                            settings_dict['photo_param_name'],)
-    for jdx in tqdm(range(settings_dict['prop_n_muon_energy_bins'])):
-        ranges[jdx] = propagate(prop,
-                                settings_dict['prop_energy_bin_mids'][jdx],
-                                settings_dict['prop_oversampling'])
+    if args.replay is not None:
+        replay_muon(settings_dict, args.replay[0], int(args.replay[1]))
+        return
+
+    # the tables are built before the workers start, they read them or inherit the propagator
+    get_propagator(settings_dict)
+    worker_func = partial(propagate_energy_bin, settings_dict, stream_entropy(settings_dict))
+    energy_indices = range(settings_dict['prop_n_muon_energy_bins'])
+    if args.workers > 1:
+        pool = Pool(args.workers)
+        results = list(tqdm(pool.imap(worker_func, energy_indices), total=len(energy_indices)))
+        pool.close()
+        pool.join()
+    else:
+        results = [worker_func(energy_idx) for energy_idx in tqdm(energy_indices)]
+    ranges = np.array([energy_ranges for energy_ranges, _ in results])
     np.savetxt(settings_dict['prop_data_ranges'], ranges)
+    write_latency(settings_dict, [latency for _, latency in results], args.settings_file)
 
 if __name__ == '__main__':
     main()
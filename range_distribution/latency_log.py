@@ -0,0 +1,99 @@
+import heapq
+import numpy as np
+
+# a copy of the LatencyLog of energy_loss_distribution/phase_timer.py,
+# the scripts of both directories are run from their own directory
+
+# log binned latencies between 1 us and 10^4 s, the quantiles are exact to about 2 %
+LATENCY_MIN_EXP = -6
+LATENCY_MAX_EXP = 4
+LATENCY_BINS_PER_DECADE = 100
+
+
+class LatencyLog(object):
+    r"""
+    Distribution of the time per muon and the slowest muons
+
+    The histogram of the latencies and the slowest muons of independent
+    chunks can be merged. Every slow muon keeps the information given
+    to record, e.g. its energy, length and seed to replay it.
+    """
+    def __init__(self, n_slowest=10):
+        self.n_slowest = n_slowest
+        self.counts = np.zeros((LATENCY_MAX_EXP - LATENCY_MIN_EXP) * LATENCY_BINS_PER_DECADE + 2, dtype=np.int64)
+        self.max_time = 0.
+        self.slowest = []
+        self.n_pushed = 0
+
+    def bin_index(self, seconds):
+        if seconds <= 0:
+            return 0
+        idx = int(np.floor((np.log10(seconds) - LATENCY_MIN_EXP) * LATENCY_BINS_PER_DECADE)) + 1
+        return min(max(idx, 0), len(self.counts) - 1)
+
+    def record(self, seconds, **muon):
+        self.counts[self.bin_index(seconds)] += 1
+        self.max_time = max(self.max_time, seconds)
+        self.push(seconds, muon)
+
+    def push(self, seconds, muon):
+        # min heap of the slowest muons, the counter avoids comparing the dicts of equal times
+        entry = (seconds, self.n_pushed, muon)
+        self.n_pushed += 1
+        if len(self.slowest) < self.n_slowest:
+            heapq.heappush(self.slowest, entry)
+        elif self.slowest and seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.max_time = max(self.max_time, other.max_time)
+        for seconds, _, muon in sorted(other.slowest, key=lambda entry: entry[:2]):
+            self.push(seconds, muon)
+        return self
+
+    def quantile(self, q):
+        n_muons = self.counts.sum()
+        if n_muons == 0:
+            return 0.
+        idx = np.searchsorted(np.cumsum(self.counts), q * n_muons)
+        # the upper edge of the bin, but never above the slowest muon
+        upper_edge = 10**(LATENCY_MIN_EXP + idx / float(LATENCY_BINS_PER_DECADE))
+        return min(upper_edge, self.max_time)
+
+    def to_dict(self):
+        return {"n_slowest": self.n_slowest,
+                "counts": self.counts.tolist(),
+                "max_time": self.max_time,
+                "slowest": [[seconds, muon] for seconds, _, muon in sorted(self.slowest, key=lambda entry: entry[:2])]}
+
+    @classmethod
+    def from_dict(cls, state):
+        latency = cls(state["n_slowest"])
+        latency.counts = np.array(state["counts"], dtype=np.int64)
+        latency.max_time = state["max_time"]
+        for seconds, muon in state["slowest"]:
+            latency.push(seconds, muon)
+        return latency
+
+    def summary(self, replay=None):
+        r"""
+        Quantiles of the time per muon and the slowest muons, slowest first
+
+        Parameters
+        ----------
+        replay : callable, optional
+            returns the command to replay a slow muon from its information
+        """
+        slowest = []
+        for seconds, _, muon in sorted(self.slowest, key=lambda entry: (-entry[0], entry[1])):
+            muon = dict(muon, time=seconds)
+            if replay is not None:
+                muon["replay"] = replay(muon)
+            slowest.append(muon)
+        return {"n_muons": int(self.counts.sum()),
+                "p50": self.quantile(0.5),
+                "p99": self.quantile(0.99),
+                "p999": self.quantile(0.999),
+                "max": self.max_time,
+                "slowest": slowest}
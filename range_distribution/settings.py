@@ -26,6 +26,8 @@ def create_settings_dict(cross_section_type):
         os.mkdir(set_dict['build_path'])
 
     set_dict['path_to_inerpolation_tables'] = '~/.local/share/PROPOSAL/tables'
+    # only read the tables, e.g. after they are build with the table warm-up
+    set_dict['interpolation_tables_readonly'] = False
     if cross_section_type == 'baseline':
         set_dict['brems_param_name'] = 'BremsKelnerKokoulinPetrukhin'
         set_dict['epair_param_name'] = 'EpairKelnerKokoulinPetrukhin'
@@ -67,6 +69,8 @@ def create_settings_dict(cross_section_type):
 
     # step3 propagate muons for range distribution
     set_dict['prop_oversampling'] = 2000
+    # the seed of every muon is derived from this seed, the cross sections, its energy and its index
+    set_dict['prop_random_seed'] = 1234
     set_dict['prop_n_muon_energy_bins'] = 100
     set_dict['prop_muon_energy_min'] = 1e4 # MeV
     set_dict['prop_muon_energy_max'] = 1e11 # MeV
@@ -77,6 +81,9 @@ def create_settings_dict(cross_section_type):
     set_dict['prop_energy_bin_edges'] = bin_edges.tolist()
     set_dict['prop_energy_bin_mids'] = bin_mids.tolist()
     set_dict['prop_data_ranges'] = os.path.join(build_folder, 'data_prop_ranges.txt')
+    # the quantiles of the time per muon and the slowest muons with their replay command
+    set_dict['prop_n_slowest_muons'] = 10
+    set_dict['prop_data_latency'] = os.path.join(build_folder, 'data_prop_latency.json')
 
     # step 4 plot range
     set_dict['prop_plot_ranges'] = os.path.join(build_folder, 'plot_range_distribution.png')